@@ -1,18 +1,36 @@
+import json
 import os
-import vecs
+import signal
+import sys
+import time
 
 from dotenv import load_dotenv
-from fastapi import FastAPI, Depends, Header
+from loguru import logger
+from fastapi import FastAPI, Depends, Header, Request
+from typing import Optional
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from mangum import Mangum
 
 from sqlalchemy import create_engine
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
 from sqlalchemy.orm import Session, sessionmaker
 
-from app.src.llm.qa.postgres_qa_engine import PostgresQAEngine, EmbeddingModel
-from app.src.db.util import create_question_instance, add_recommended_resources, add_answer
+from app.src.llm.qa.postgres_qa_engine import PostgresQAEngine, RequestOptions, SearchMode, GradingMode, EmbeddingModel
+from app.src.llm.qa.engine_registry import EngineRegistry
+from app.src.llm.cache import InMemoryLLMCache, SQLLLMCache
+from app.src.llm.dispatcher import LLMDispatcher
+from app.src.llm.qa.semantic_cache import LocalSemanticCache, VecsSemanticCache
+from app.src.llm.qa.single_flight import SingleFlight
+from app.src.llm.qa.candidate_selector import load_candidate_selector
+from app.src.db.activity_log import QuestionLogRecord, WriteBehindActivityLogger
+from app.src.db.util import get_resources
 from app.src.db.models import ResourcesHubermanLab
+from app.src.constants import CANDIDATE_SELECTOR_PATH, DF_SUMMARY_PATH, VECTOR_SEARCH_SETTINGS_PATH
+from app.src.store.bm25_index import BM25Index, load_segment_keywords
+from app.src.store.index_manager import load_search_settings
+from app.src.tracing import current_trace, enable_opentelemetry, metrics, start_trace
 
-from app.src.api.models import ResourceResponse, AnswerResponse, EmbedQuestionResponse
+from app.src.api.models import ResourceResponse, AnswerResponse, EmbedQuestionResponse, EmbedQuestionsRequest, EmbedQuestionsResponse, BatchQuestionsRequest, BatchResourceResponse, BatchAnswerResponse
 
 load_dotenv()
 
@@ -20,8 +38,168 @@ DB_CONNECTION = f"postgresql://postgres:{os.environ['POSTGRES_DB_PASS']}@{os.env
 engine = create_engine(DB_CONNECTION)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+# The single-question routes are async end to end, on asyncpg
+ASYNC_DB_CONNECTION = f"postgresql+asyncpg://postgres:{os.environ['POSTGRES_DB_PASS']}@{os.environ['POSTGRES_DB_HOST']}:5432/postgres"
+async_engine = create_async_engine(ASYNC_DB_CONNECTION, pool_size=int(
+    os.getenv("ASYNC_DB_POOL_SIZE", 20)))
+AsyncSessionLocal = async_sessionmaker(
+    async_engine, autoflush=False, expire_on_commit=False)
+
+# Question, recommendation and answer rows are batched across requests and written
+# off the request path
+activity_logger = WriteBehindActivityLogger(SessionLocal,
+                                            max_batch_size=int(
+                                                os.getenv("ACTIVITY_LOG_BATCH_SIZE", 100)),
+                                            flush_interval=float(os.getenv("ACTIVITY_LOG_FLUSH_INTERVAL", 5)))
+
+# Deterministic (temperature=0) segment checks and final answers are answered from
+# the cache when the same inputs were seen before
+LLM_CACHE_BACKEND = os.getenv("LLM_CACHE_BACKEND", "memory")
+LLM_CACHE_TTL = float(os.environ["LLM_CACHE_TTL"]) if os.getenv(
+    "LLM_CACHE_TTL") else None
+if LLM_CACHE_BACKEND == "memory":
+    llm_cache = InMemoryLLMCache(max_size=int(
+        os.getenv("LLM_CACHE_SIZE", 10000)), ttl=LLM_CACHE_TTL)
+elif LLM_CACHE_BACKEND == "sql":
+    llm_cache = SQLLLMCache(engine, max_size=int(
+        os.getenv("LLM_CACHE_SIZE", 100000)), ttl=LLM_CACHE_TTL)
+else:
+    llm_cache = None
+
+# Paraphrases of already answered questions get the stored answer
+SEMANTIC_CACHE_BACKEND = os.getenv("SEMANTIC_CACHE_BACKEND", "memory")
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", 0.9))
+if SEMANTIC_CACHE_BACKEND == "vecs":
+    semantic_cache = VecsSemanticCache(
+        DB_CONNECTION, collection_name="questions", threshold=SEMANTIC_CACHE_THRESHOLD)
+elif SEMANTIC_CACHE_BACKEND == "memory":
+    semantic_cache = LocalSemanticCache(threshold=SEMANTIC_CACHE_THRESHOLD)
+else:
+    semantic_cache = None
+
+# Chat calls of all requests share their clients and the rate limits of the OpenAI
+# organization, with final answers ahead of segment checks
+if os.getenv("LLM_DISPATCHER", "1") == "1":
+    llm_dispatcher = LLMDispatcher(requests_per_minute=float(os.getenv("LLM_REQUESTS_PER_MINUTE", 3500)),
+                                   tokens_per_minute=float(
+                                       os.getenv("LLM_TOKENS_PER_MINUTE", 90000)),
+                                   max_retries=int(os.getenv("LLM_MAX_RETRIES", 5)))
+else:
+    llm_dispatcher = None
+
+
+def build_lexical_index() -> BM25Index:
+    """
+    Indexes the segment titles, summaries and topics of the database. The keywords
+    of the summary CSV are added when the file is there; the data directory isn't
+    part of the image.
+    """
+    with SessionLocal() as session:
+        resources = session.query(ResourcesHubermanLab).all()
+    keywords = load_segment_keywords(
+        DF_SUMMARY_PATH) if DF_SUMMARY_PATH.exists() else None
+    return BM25Index.from_resources(resources, keywords=keywords)
+
+
+# ef_search / probes of the ANN index, see app/src/store/index_manager.py
+search_settings = load_search_settings()
+if search_settings is None:
+    logger.warning(f"{VECTOR_SEARCH_SETTINGS_PATH} is missing, so vector queries use the vecs default of 10 IVFFlat probes. "
+                   "Tune it and copy it into app/settings before building the image")
+
+# Similarity cut-offs of the segment checks, see app/src/llm/qa/candidate_selector.py
+CANDIDATE_SELECTOR = os.getenv("CANDIDATE_SELECTOR", "1") == "1"
+candidate_selector = load_candidate_selector() if CANDIDATE_SELECTOR else None
+if CANDIDATE_SELECTOR and candidate_selector is None:
+    logger.warning(f"CANDIDATE_SELECTOR is on but {CANDIDATE_SELECTOR_PATH} is missing, so every found segment is checked. "
+                   "Calibrate it and copy it into app/settings before building the image")
+
+# Concurrent single questions arriving within MICRO_BATCH_WAIT_MS of each other are
+# encoded together; off by default, since the wait adds to every question's latency
+MICRO_BATCH_WAIT_MS = float(os.getenv("MICRO_BATCH_WAIT_MS", 0))
+# Questions of a batch request answered at once
+N_CONCURRENT_QUESTIONS = int(os.getenv("N_CONCURRENT_QUESTIONS", 4))
+
+# The encoder and the vecs collection are loaded once per process (Lambda container)
+registry = EngineRegistry(DB_CONNECTION,
+                          vecs_collection_name="docs",
+                          # sbert_onnx / sbert_onnx_int8 embed questions without torch
+                          embedding_model=EmbeddingModel(
+                              os.getenv("EMBEDDING_MODEL", "sbert")),
+                          n_search=int(os.getenv("N_SEARCH", 20)),
+                          n_resources=int(os.getenv("N_RESOURCES", 7)),
+                          n_concurrent_checks=int(
+                              os.getenv("N_CONCURRENT_CHECKS", 4)),
+                          resource_cache_size=int(
+                              os.getenv("RESOURCE_CACHE_SIZE", 10000)),
+                          llm_cache=llm_cache,
+                          semantic_cache=semantic_cache,
+                          lexical_index_factory=build_lexical_index if os.getenv(
+                              "LEXICAL_INDEX", "1") == "1" else None,
+                          partition_by_topic=os.getenv(
+                              "PARTITION_BY_TOPIC", "1") == "1",
+                          micro_batch_size=int(
+                              os.getenv("MICRO_BATCH_SIZE", 32)),
+                          micro_batch_wait_ms=MICRO_BATCH_WAIT_MS if MICRO_BATCH_WAIT_MS > 0 else None,
+                          search_settings=search_settings,
+                          candidate_selector=candidate_selector,
+                          # Near-duplicate segments of different episodes are checked once
+                          mmr_lambda=float(os.getenv("MMR_LAMBDA", 0.7)) if os.getenv(
+                              "MMR", "1") == "1" else None,
+                          duplicate_similarity=float(
+                              os.getenv("DUPLICATE_SIMILARITY", 0.95)),
+                          # Identical questions in flight at once are answered once
+                          single_flight=SingleFlight() if os.getenv(
+                              "SINGLE_FLIGHT", "1") == "1" else None,
+                          llm_dispatcher=llm_dispatcher,
+                          activity_logger=activity_logger)
+if os.getenv("WARM_UP_ENGINE", "1") == "1":
+    registry.warm_up()
+
+if os.getenv("OTEL_TRACING", "0") == "1":
+    enable_opentelemetry()
+
 app = FastAPI()
-handler = Mangum(app)
+mangum_handler = Mangum(app)
+
+
+@app.middleware("http")
+async def trace_requests(request: Request, call_next):
+    # The stage spans of the request are collected in its trace
+    with start_trace():
+        start_time = time.perf_counter()
+        response = await call_next(request)
+    # The route template, so unknown paths don't add label values
+    route = request.scope.get("route")
+    metrics.observe("http_request_duration_seconds", time.perf_counter() - start_time,
+                    method=request.method, path=route.path if route is not None else "unmatched",
+                    status=response.status_code)
+    return response
+
+
+def handler(event, context):
+    # Lambda freezes the container once the handler returns, which can leave rows
+    # of the previous invocation queued. The worker writes them while this one runs.
+    activity_logger.request_flush()
+    return mangum_handler(event, context)
+
+
+def _close_on_sigterm(signum, frame):
+    activity_logger.close()
+    sys.exit(0)
+
+
+# Lambda sends SIGTERM before shutting a container down (when an extension is
+# registered), so the queued activity log rows are written then. Under uvicorn, the
+# shutdown event closes the logger.
+if os.getenv("AWS_LAMBDA_FUNCTION_NAME"):
+    signal.signal(signal.SIGTERM, _close_on_sigterm)
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    activity_logger.close()
+    await async_engine.dispose()
 
 
 def get_db():
@@ -33,16 +211,16 @@ def get_db():
 
 
 def get_engine(db: Session = Depends(get_db)):
+    return registry.get_engine(db)
 
-    embedding_model = EmbeddingModel("sbert")
 
-    # create vector store client
-    vx = vecs.create_client(DB_CONNECTION)
-    qa_engine = PostgresQAEngine(embedding_model=embedding_model,
-                                 sql_session=db,
-                                 vecs_client=vx,
-                                 vecs_collection_name="docs")
-    return qa_engine
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
+        yield db
+
+
+def get_async_engine(db: AsyncSession = Depends(get_async_db)):
+    return registry.get_engine(None, async_sql_session=db)
 
 
 @app.get("/")
@@ -50,72 +228,167 @@ def hello():
     return {"message": "hello"}
 
 
+@app.get("/metrics", response_class=PlainTextResponse)
+def prometheus_metrics():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+
+@app.get("/cache/stats")
+def cache_stats():
+    return {"llm_cache": llm_cache.stats() if llm_cache is not None else None}
+
+
 @app.post("/embed_question", response_model=EmbedQuestionResponse)
-def embed_question(question: str, engine: PostgresQAEngine = Depends(get_engine)) -> EmbedQuestionResponse:
-    return EmbedQuestionResponse(embedded_question=engine.embed_question(question))
+async def embed_question(question: str, engine: PostgresQAEngine = Depends(get_async_engine)) -> EmbedQuestionResponse:
+    return EmbedQuestionResponse(embedded_question=await engine.embed_question_async(question))
+
+
+@app.post("/embed_questions", response_model=EmbedQuestionsResponse)
+def embed_questions(request: EmbedQuestionsRequest, engine: PostgresQAEngine = Depends(get_engine)) -> EmbedQuestionsResponse:
+    return EmbedQuestionsResponse(embedded_questions=engine.embed_questions(request.questions))
 
 
 @app.post("/hubermanlab/answer", response_model=AnswerResponse)
-def answer_hubermanlab(user_id: int, question: str, api_key: str = Header(...), engine: PostgresQAEngine = Depends(get_engine)) -> AnswerResponse:
+async def answer_hubermanlab(user_id: int, question: str, search_mode: SearchMode = SearchMode.VECTOR, grading_mode: GradingMode = GradingMode.SEQUENTIAL, topic: Optional[str] = None, episode_name: Optional[str] = None, api_key: str = Header(...), x_debug_timings: Optional[str] = Header(None), engine: PostgresQAEngine = Depends(get_async_engine)) -> AnswerResponse:
 
-    os.environ["OPENAI_API_KEY"] = api_key
+    options = RequestOptions(search_mode=search_mode, grading_mode=grading_mode,
+                             topic=topic, episode_name=episode_name, openai_api_key=api_key)
 
-    # Create a new question instance
-    question_id = create_question_instance(
-        engine.session, user_id, question, "answer")
+    # Create a new question log record, written once the request is finished
+    record = QuestionLogRecord(
+        user_id=user_id, question=question, mode="answer")
 
-    # Encoding question to embedding space
-    embedded_question = engine.embed_question(question)
+    try:
+        result = await engine.answer_question_async(question, record, options=options)
+    finally:
+        engine.activity_logger.log(record)
 
-    # Finding relevant segments
-    indices = engine.search_segments(embedded_question, 20)
+    resources = [{"summary": value["summary"], "episode_name": value["episode_name"],
+                  "segment_title": value["segment_title"], "url": value["url"], "topic": value["topic"]} for value in result.relevant_segments.values()]
 
-    # Create new recommended resource instances and add them to the session
-    add_recommended_resources(engine.session, question_id, indices)
+    # The stage timings of the request, when asked for with the debug header
+    trace = current_trace()
+    timings = trace.timings() if x_debug_timings not in (None, "0") and trace is not None else None
+    return AnswerResponse(answer=result.answer, resources=resources, timings=timings)
 
-    # Getting answers from segments
-    relevant_summaries, n_relevant, n_non_relevant = engine.process_found_segments(
-        question, indices)
 
-    # Getting the final answer
-    answer = engine.get_final_answer(question, relevant_summaries)
+@app.post("/hubermanlab/answer/stream")
+async def answer_hubermanlab_stream(user_id: int, question: str, search_mode: SearchMode = SearchMode.VECTOR, grading_mode: GradingMode = GradingMode.SEQUENTIAL, topic: Optional[str] = None, episode_name: Optional[str] = None, api_key: str = Header(...), engine: PostgresQAEngine = Depends(get_async_engine)) -> StreamingResponse:
+    """
+    Streams the answer as server-sent events: "resources" once the vector search
+    returns, a "segment" per relevant segment, the final answer "token" by token
+    and a closing "done" (or "error") event.
 
-    # Adding the answer to the AnswersHubermanLab table
-    add_answer(engine.session, user_id, question_id,
-               answer, n_relevant, n_non_relevant)
+    The events only arrive progressively when the app runs under uvicorn. Behind
+    Mangum on Lambda the response is buffered, so the whole stream arrives at
+    once after the answer is finished.
+    """
+    options = RequestOptions(search_mode=search_mode, grading_mode=grading_mode,
+                             topic=topic, episode_name=episode_name, openai_api_key=api_key)
 
-    resources = [{"summary": value["summary"], "episode_name": value["episode_name"],
-                  "segment_title": value["segment_title"], "url": value["url"], "topic": value["topic"]} for value in relevant_summaries.values()]
+    # Create a new question log record, written once the stream is finished
+    record = QuestionLogRecord(
+        user_id=user_id, question=question, mode="answer")
 
-    return AnswerResponse(answer=answer, resources=resources)
+    async def event_stream():
+        try:
+            async for event, data in engine.stream_answer_async(question, record, options):
+                yield f"event: {event}\ndata: {json.dumps(data)}\n\n"
+        finally:
+            engine.activity_logger.log(record)
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream")
 
 
 @app.post("/hubermanlab/resource", response_model=ResourceResponse)
-def resource_hubermanlab(user_id: int, question: str, engine: PostgresQAEngine = Depends(get_engine)) -> ResourceResponse:
+async def resource_hubermanlab(user_id: int, question: str, search_mode: SearchMode = SearchMode.VECTOR, topic: Optional[str] = None, episode_name: Optional[str] = None, engine: PostgresQAEngine = Depends(get_async_engine)) -> ResourceResponse:
     """
     Returns resources that are most relevant to a given question.
     """
-    # Create a new question instance
-    question_id = create_question_instance(
-        engine.session, user_id, question, "resources")
+    options = RequestOptions(search_mode=search_mode,
+                             topic=topic, episode_name=episode_name)
 
-    # Encoding question to embedding space
-    embedded_question = engine.embed_question(question)
+    # Create a new question log record, written once the request is finished
+    record = QuestionLogRecord(
+        user_id=user_id, question=question, mode="resources")
 
-    # Finding relevant segments
-    indices = engine.search_segments(embedded_question, 7)
+    try:
+        # Encoding question to embedding space
+        embedded_question = await engine.embed_question_async(question)
 
-    # Create new recommended resource instances and add them to the session
-    add_recommended_resources(engine.session, question_id, indices)
+        # Finding relevant segments
+        indices = await engine.find_segments_async(question, embedded_question, engine.n_resources, options)
+        record.recommended_resources = indices
+    finally:
+        engine.activity_logger.log(record)
 
     resources = []
-    for ind in indices:
-        resource = engine.session.query(ResourcesHubermanLab).get(ind)
+    for resource in await engine.get_resources_async(indices):
         resources.append({"summary": resource.summary, "episode_name": resource.episode_name,
                          "segment_title": resource.segment_title, "url": resource.url, "topic": resource.topic})
     return ResourceResponse(resources=resources)
 
 
+@app.post("/hubermanlab/resource/batch", response_model=BatchResourceResponse)
+def resource_hubermanlab_batch(request: BatchQuestionsRequest, search_mode: SearchMode = SearchMode.VECTOR, topic: Optional[str] = None, episode_name: Optional[str] = None, engine: PostgresQAEngine = Depends(get_engine)) -> BatchResourceResponse:
+    """
+    Returns the most relevant resources of every question, in the order of the
+    questions. The questions are encoded and searched together.
+    """
+    options = RequestOptions(search_mode=search_mode,
+                             topic=topic, episode_name=episode_name)
+
+    # Create a question log record per question, written once the request is finished
+    records = [QuestionLogRecord(user_id=request.user_id, question=question, mode="resources")
+               for question in request.questions]
+
+    try:
+        found = engine.resources_for_questions(
+            request.questions, records, options=options)
+    finally:
+        for record in records:
+            engine.activity_logger.log(record)
+
+    # Query the resources of all questions in a single round trip
+    resources = {resource.id: resource for resource in get_resources(
+        engine.session, {resource_id for indices in found for resource_id in indices}, engine.resource_cache)}
+
+    results = []
+    for indices in found:
+        results.append(ResourceResponse(resources=[{"summary": resources[resource_id].summary, "episode_name": resources[resource_id].episode_name,
+                                                    "segment_title": resources[resource_id].segment_title, "url": resources[resource_id].url, "topic": resources[resource_id].topic}
+                                                   for resource_id in indices if resource_id in resources]))
+    return BatchResourceResponse(results=results)
+
+
+@app.post("/hubermanlab/answer/batch", response_model=BatchAnswerResponse)
+def answer_hubermanlab_batch(request: BatchQuestionsRequest, search_mode: SearchMode = SearchMode.VECTOR, grading_mode: GradingMode = GradingMode.SEQUENTIAL, topic: Optional[str] = None, episode_name: Optional[str] = None, api_key: str = Header(...), engine: PostgresQAEngine = Depends(get_engine)) -> BatchAnswerResponse:
+    """
+    Answers every question, in the order of the questions. The questions are
+    encoded and searched together, then answered concurrently.
+    """
+    options = RequestOptions(search_mode=search_mode, grading_mode=grading_mode,
+                             topic=topic, episode_name=episode_name, openai_api_key=api_key)
+
+    # Create a question log record per question, written once the request is finished
+    records = [QuestionLogRecord(user_id=request.user_id, question=question, mode="answer")
+               for question in request.questions]
+
+    try:
+        answer_results = engine.answer_questions(
+            request.questions, records, n_concurrent_questions=N_CONCURRENT_QUESTIONS, options=options)
+    finally:
+        for record in records:
+            engine.activity_logger.log(record)
+
+    results = []
+    for result in answer_results:
+        resources = [{"summary": value["summary"], "episode_name": value["episode_name"],
+                      "segment_title": value["segment_title"], "url": value["url"], "topic": value["topic"]} for value in result.relevant_segments.values()]
+        results.append(AnswerResponse(answer=result.answer, resources=resources))
+    return BatchAnswerResponse(results=results)
+
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8000)
@@ -11,7 +11,9 @@ import pandas as pd
 
 # from src.llm.qa.local_qa_engine import LocalQAEngine, EmbeddingModel
 from src.llm.qa.postgres_qa_engine import PostgresQAEngine, EmbeddingModel
-from src.api.client import call_answer_hubermanlab, call_resource_hubermanlab
+from src.api.client import PodcastQAClient, PodcastQAClientError
+from src.api.models import AnswerResponse
+from src.constants import TOPICS
 from src.service.service import answer_response_to_html, resource_response_to_html
 from dotenv import load_dotenv, set_key
 
@@ -89,6 +91,44 @@ def create_db_engine():
     return qa_engine
 
 
+@st.cache_resource
+def get_api_client() -> PodcastQAClient:
+    # One client per server process, so the connections to the API are reused
+    return PodcastQAClient()
+
+
+def render_answer_stream(question: str, api_key: str, topic: str = None):
+    """
+    Renders the streamed answer: the found sections right away, every relevant
+    section once it's validated and the final answer as it's being written.
+    Against the Lambda deployment the stream is buffered and arrives at once.
+    """
+    resources_placeholder = st.empty()
+    segments_placeholder = st.empty()
+    answer_placeholder = st.empty()
+
+    relevant_segments = []
+    answer = ""
+    for event, data in get_api_client().stream_answer(USER_ID, question, api_key, topic=topic):
+        if event == "resources":
+            resources_placeholder.markdown(
+                "🔎 Searching through:\n" + "\n".join(f"- {resource['segment_title']} ({resource['episode_name']})" for resource in data))
+        elif event == "segment":
+            relevant_segments.append(data)
+            segments_placeholder.markdown(
+                "✅ Relevant sections:\n" + "\n".join(f"- {segment['segment_title']}" for segment in relevant_segments))
+        elif event == "token":
+            answer += data
+            answer_placeholder.markdown(answer)
+        elif event == "done":
+            resources_placeholder.empty()
+            segments_placeholder.empty()
+            answer_placeholder.markdown(answer_response_to_html(
+                answer_response=AnswerResponse(answer=data["answer"], resources=relevant_segments)), unsafe_allow_html=True)
+        elif event == "error":
+            st.error(f"🚫 Something went wrong: {data['detail']}")
+
+
 def on_api_key_change():
     os.environ['OPENAI_API_KEY'] = st.session_state.get('api_key')
 
@@ -245,6 +285,9 @@ def main_layout():
         input_text = st.text_area(label="🖋️ Ask a question:",
                                   placeholder="Your question, e.g. How to sleep better?", key="user_input")
 
+        topic = st.selectbox("🏷️ Search only in a topic:", ["All topics"] + TOPICS)
+        topic = None if topic == "All topics" else topic
+
         run_button = st.button("Run 🚀")
 
         if input_text and run_button:
@@ -253,19 +296,21 @@ def main_layout():
                     "🕓 Your question is being processed. It can take up to a minute.")
                 st.markdown(f"## {input_text}")
 
-                if mode.endswith("Question Mode") and st.session_state.get('api_key'):
-                    answer_response = call_answer_hubermanlab(
-                        USER_ID, input_text, st.session_state.get('api_key'))
-                    st.markdown(answer_response_to_html(
-                        answer_response=answer_response), unsafe_allow_html=True)
-                elif mode.endswith("Resource Mode"):
-                    resource_response = call_resource_hubermanlab(
-                        USER_ID, input_text)
-                    st.markdown(resource_response_to_html(
-                        resource_response=resource_response), unsafe_allow_html=True)
-                elif mode.endswith("Question Mode") and not st.session_state.get('api_key'):
-                    st.error(
-                        "🚫 For Question Mode, API Keys are required. Please provide them in the left panel.")
+                try:
+                    if mode.endswith("Question Mode") and st.session_state.get('api_key'):
+                        render_answer_stream(
+                            input_text, st.session_state.get('api_key'), topic=topic)
+                    elif mode.endswith("Resource Mode"):
+                        resource_response = get_api_client().resource(
+                            USER_ID, input_text, topic=topic)
+                        st.markdown(resource_response_to_html(
+                            resource_response=resource_response), unsafe_allow_html=True)
+                    elif mode.endswith("Question Mode") and not st.session_state.get('api_key'):
+                        st.error(
+                            "🚫 For Question Mode, API Keys are required. Please provide them in the left panel.")
+                except PodcastQAClientError as e:
+                    logger.error(e)
+                    st.error(f"🚫 Something went wrong: {e.detail}")
 
         st.markdown("---")
 
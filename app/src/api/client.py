@@ -1,73 +1,357 @@
+import asyncio
+import functools
+import json
 import os
+import random
 import requests
-from .models import AnswerResponse, EmbedQuestionResponse, ResourceResponse
+
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from .models import AnswerResponse, BatchAnswerResponse, BatchResourceResponse, EmbedQuestionResponse, EmbedQuestionsResponse, ResourceResponse
 from dotenv import load_dotenv
-from typing import Union
+from typing import AsyncIterator, Iterable, Iterator, List, Optional, Tuple
 
 load_dotenv()
 
+# Responses worth retrying: rate limiting and server or gateway errors
+RETRY_STATUSES = (429, 500, 502, 503, 504)
 
-def call_embed_question(question: str) -> Union[EmbedQuestionResponse, None]:
-    ENDPOINT = "embed_question"
-    url = f"{os.environ['LAMBDA_FUNCTION_URL']}{ENDPOINT}"
 
-    headers = {
-        "Content-Type": "application/json"
-    }
+class PodcastQAClientError(Exception):
+    """
+    A request to the API failed, after the retries: an error response (with its
+    status code and detail) or no response at all (without a status code).
+    """
 
-    data = {
-        "question": question
-    }
+    def __init__(self, detail: str, status_code: Optional[int] = None) -> None:
+        super().__init__(
+            f"Request failed with status code {status_code}: {detail}" if status_code else detail)
+        self.detail = detail
+        self.status_code = status_code
 
-    response = requests.post(url, params=data, headers=headers)
 
-    if response.status_code == 200:
-        return EmbedQuestionResponse(**response.json())
-    else:
-        print(f"Request failed with status code {response.status_code}")
-        return None
+def _error_detail(status_code: int, text: str) -> str:
+    try:
+        return json.loads(text).get("detail", text)
+    except (ValueError, AttributeError):
+        return text or f"HTTP {status_code}"
+
+
+class SSEDecoder:
+    """
+    Turns the lines of a server-sent events stream into (event, data) pairs.
+    """
+
+    def __init__(self) -> None:
+        self.event, self.data_lines = "message", []
+
+    def feed(self, line: str) -> Optional[Tuple[str, object]]:
+        if line:
+            if line.startswith("event:"):
+                self.event = line[len("event:"):].strip()
+            elif line.startswith("data:"):
+                self.data_lines.append(line[len("data:"):].strip())
+            return None
+        return self.flush()
+
+    def flush(self) -> Optional[Tuple[str, object]]:
+        if not self.data_lines:
+            return None
+        item = self.event, json.loads("\n".join(self.data_lines))
+        self.event, self.data_lines = "message", []
+        return item
+
+
+def iter_sse_events(lines: Iterable[str]) -> Iterator[Tuple[str, object]]:
+    decoder = SSEDecoder()
+    for line in lines:
+        item = decoder.feed(line)
+        if item is not None:
+            yield item
+    item = decoder.flush()
+    if item is not None:
+        yield item
+
+
+def _question_params(user_id: int, question: str, topic: Optional[str], episode_name: Optional[str], search_mode: Optional[str],
+                     grading_mode: Optional[str] = None) -> dict:
+    params = {"user_id": user_id, "question": question, "topic": topic,
+              "episode_name": episode_name, "search_mode": search_mode, "grading_mode": grading_mode}
+    return {key: value for key, value in params.items() if value is not None}
+
+
+def _chunks(items: List[str], size: int) -> Iterator[List[str]]:
+    for start in range(0, len(items), size):
+        yield items[start:start+size]
 
 
-def call_answer_hubermanlab(user_id: int, question: str, api_key: str) -> Union[AnswerResponse, None]:
-    ENDPOINT = "hubermanlab/answer"
-    url = f"{os.environ['LAMBDA_FUNCTION_URL']}{ENDPOINT}"
+class PodcastQAClient:
+    """
+    Client of the podcast QA API. One instance keeps a pool of HTTP keep-alive
+    connections, so it should be shared, e.g. for the lifetime of the Streamlit
+    server. Rate limited and failed requests (429/5xx) and connection errors are
+    retried with exponential backoff, honoring Retry-After. A request that was
+    sent but timed out or lost its connection is not retried, since the API may
+    still be answering it. Failed requests raise PodcastQAClientError.
+    """
 
-    headers = {
-        "Content-Type": "application/json",
-        "api-key": api_key
-    }
+    def __init__(self,
+                 base_url: str = None,
+                 connect_timeout: float = 5,
+                 read_timeout: float = 120,
+                 max_retries: int = 3,
+                 backoff_factor: float = 0.5,
+                 pool_size: int = 10) -> None:
+        self.base_url = base_url or os.environ["LAMBDA_FUNCTION_URL"]
+        self.timeout = (connect_timeout, read_timeout)
 
-    data = {
-        "user_id": user_id,
-        "question": question
-    }
+        # read=0: a POST whose response didn't arrive is not sent again
+        retry = Retry(total=max_retries,
+                      read=0,
+                      backoff_factor=backoff_factor,
+                      status_forcelist=RETRY_STATUSES,
+                      allowed_methods=frozenset({"GET", "POST"}),
+                      respect_retry_after_header=True,
+                      raise_on_status=False)
+        adapter = HTTPAdapter(max_retries=retry,
+                              pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session = requests.Session()
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
 
-    response = requests.post(url, params=data, headers=headers)
+    def __enter__(self) -> "PodcastQAClient":
+        return self
 
-    if response.status_code == 200:
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def close(self) -> None:
+        self.session.close()
+
+    def _url(self, endpoint: str) -> str:
+        return f"{self.base_url.rstrip('/')}/{endpoint}"
+
+    def _post(self, endpoint: str, params: dict = None, body: dict = None, headers: dict = None, stream: bool = False) -> requests.Response:
+        try:
+            response = self.session.post(self._url(endpoint), params=params, json=body, headers=headers,
+                                         timeout=self.timeout, stream=stream)
+        except requests.RequestException as e:
+            raise PodcastQAClientError(str(e)) from e
+
+        if response.status_code != 200:
+            detail = _error_detail(response.status_code, response.text)
+            response.close()
+            raise PodcastQAClientError(detail, response.status_code)
+        return response
+
+    def embed_question(self, question: str) -> EmbedQuestionResponse:
+        return EmbedQuestionResponse(**self._post("embed_question", params={"question": question}).json())
+
+    def embed_questions(self, questions: List[str]) -> EmbedQuestionsResponse:
+        return EmbedQuestionsResponse(**self._post("embed_questions", body={"questions": questions}).json())
+
+    def answer(self, user_id: int, question: str, api_key: str, topic: Optional[str] = None, episode_name: Optional[str] = None,
+               search_mode: Optional[str] = None, grading_mode: Optional[str] = None, debug_timings: bool = False) -> AnswerResponse:
+        headers = {"api-key": api_key}
+        if debug_timings:
+            headers["X-Debug-Timings"] = "1"
+        response = self._post("hubermanlab/answer", headers=headers,
+                              params=_question_params(user_id, question, topic, episode_name, search_mode, grading_mode))
         return AnswerResponse(**response.json())
-    else:
-        print(f"Request failed with status code {response.status_code}")
-        return None
 
+    def resource(self, user_id: int, question: str, topic: Optional[str] = None, episode_name: Optional[str] = None,
+                 search_mode: Optional[str] = None) -> ResourceResponse:
+        response = self._post("hubermanlab/resource",
+                              params=_question_params(user_id, question, topic, episode_name, search_mode))
+        return ResourceResponse(**response.json())
+
+    def stream_answer(self, user_id: int, question: str, api_key: str, topic: Optional[str] = None, episode_name: Optional[str] = None,
+                      search_mode: Optional[str] = None, grading_mode: Optional[str] = None) -> Iterator[Tuple[str, object]]:
+        """
+        Yields the (event, data) pairs of the streaming answer endpoint as they
+        arrive. Errors after the stream started arrive as an "error" event.
+        """
+        with self._post("hubermanlab/answer/stream", headers={"Accept": "text/event-stream", "api-key": api_key},
+                        params=_question_params(user_id, question, topic, episode_name, search_mode, grading_mode), stream=True) as response:
+            # SSE is always UTF-8, and iter_lines yields bytes without a declared charset
+            response.encoding = "utf-8"
+            yield from iter_sse_events(response.iter_lines(decode_unicode=True))
+
+    def answer_batch(self, user_id: int, questions: List[str], api_key: str, topic: Optional[str] = None, episode_name: Optional[str] = None,
+                     search_mode: Optional[str] = None, grading_mode: Optional[str] = None, batch_size: int = 16) -> List[AnswerResponse]:
+        """
+        Answers the questions with the batch endpoint, `batch_size` per request.
+        The answers are in the order of the questions.
+        """
+        params = _question_params(None, None, topic, episode_name, search_mode, grading_mode)
+        results = []
+        for batch in _chunks(list(questions), batch_size):
+            response = self._post("hubermanlab/answer/batch", params=params, headers={"api-key": api_key},
+                                  body={"user_id": user_id, "questions": batch})
+            results += BatchAnswerResponse(**response.json()).results
+        return results
+
+    def resource_batch(self, user_id: int, questions: List[str], topic: Optional[str] = None, episode_name: Optional[str] = None,
+                       search_mode: Optional[str] = None, batch_size: int = 64) -> List[ResourceResponse]:
+        """
+        Finds the resources of the questions with the batch endpoint, `batch_size`
+        per request, in the order of the questions.
+        """
+        params = _question_params(None, None, topic, episode_name, search_mode)
+        results = []
+        for batch in _chunks(list(questions), batch_size):
+            response = self._post("hubermanlab/resource/batch", params=params,
+                                  body={"user_id": user_id, "questions": batch})
+            results += BatchResourceResponse(**response.json()).results
+        return results
+
+
+class AsyncPodcastQAClient:
+    """
+    Async twin of PodcastQAClient on httpx, for batch jobs that keep many requests
+    in flight. Retries are done here, since httpx retries only failed connects;
+    like there, a request that was sent is not retried on a timeout or error.
+    """
 
-def call_resource_hubermanlab(user_id: int, question: str) -> Union[ResourceResponse, None]:
-    ENDPOINT = "hubermanlab/resource"
-    url = f"{os.environ['LAMBDA_FUNCTION_URL']}{ENDPOINT}"
+    def __init__(self,
+                 base_url: str = None,
+                 connect_timeout: float = 5,
+                 read_timeout: float = 120,
+                 max_retries: int = 3,
+                 backoff_factor: float = 0.5,
+                 max_connections: int = 20) -> None:
+        import httpx
 
-    headers = {
-        "Content-Type": "application/json"
-    }
+        self.httpx = httpx
+        self.base_url = (base_url or os.environ["LAMBDA_FUNCTION_URL"]).rstrip("/")
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.client = httpx.AsyncClient(timeout=httpx.Timeout(read_timeout, connect=connect_timeout),
+                                        limits=httpx.Limits(max_connections=max_connections,
+                                                            max_keepalive_connections=max_connections))
 
-    data = {
-        "user_id": user_id,
-        "question": question
-    }
+    async def __aenter__(self) -> "AsyncPodcastQAClient":
+        return self
 
-    response = requests.post(url, params=data, headers=headers)
+    async def __aexit__(self, *exc_info) -> None:
+        await self.close()
 
-    if response.status_code == 200:
+    async def close(self) -> None:
+        await self.client.aclose()
+
+    def _backoff(self, attempt: int, retry_after: Optional[str] = None) -> float:
+        if retry_after is not None:
+            try:
+                return float(retry_after)
+            except ValueError:
+                pass
+        # Full jitter, so clients that failed together don't retry together
+        return random.uniform(0, self.backoff_factor * 2 ** attempt)
+
+    async def _send(self, endpoint: str, params: dict = None, body: dict = None, headers: dict = None, stream: bool = False):
+        request = self.client.build_request("POST", f"{self.base_url}/{endpoint}",
+                                            params=params, json=body, headers=headers)
+        for attempt in range(self.max_retries + 1):
+            try:
+                response = await self.client.send(request, stream=stream)
+            except (self.httpx.ConnectError, self.httpx.ConnectTimeout, self.httpx.PoolTimeout) as e:
+                # The request wasn't sent
+                if attempt == self.max_retries:
+                    raise PodcastQAClientError(str(e)) from e
+                await asyncio.sleep(self._backoff(attempt))
+                continue
+            except self.httpx.TransportError as e:
+                raise PodcastQAClientError(str(e)) from e
+
+            if response.status_code == 200:
+                return response
+
+            if stream:
+                await response.aread()
+            await response.aclose()
+            if response.status_code not in RETRY_STATUSES or attempt == self.max_retries:
+                raise PodcastQAClientError(_error_detail(
+                    response.status_code, response.text), response.status_code)
+            await asyncio.sleep(self._backoff(attempt, response.headers.get("Retry-After")))
+
+    async def embed_question(self, question: str) -> EmbedQuestionResponse:
+        response = await self._send("embed_question", params={"question": question})
+        return EmbedQuestionResponse(**response.json())
+
+    async def answer(self, user_id: int, question: str, api_key: str, topic: Optional[str] = None, episode_name: Optional[str] = None,
+                     search_mode: Optional[str] = None, grading_mode: Optional[str] = None, debug_timings: bool = False) -> AnswerResponse:
+        headers = {"api-key": api_key}
+        if debug_timings:
+            headers["X-Debug-Timings"] = "1"
+        response = await self._send("hubermanlab/answer", headers=headers,
+                                    params=_question_params(user_id, question, topic, episode_name, search_mode, grading_mode))
+        return AnswerResponse(**response.json())
+
+    async def resource(self, user_id: int, question: str, topic: Optional[str] = None, episode_name: Optional[str] = None,
+                       search_mode: Optional[str] = None) -> ResourceResponse:
+        response = await self._send("hubermanlab/resource",
+                                    params=_question_params(user_id, question, topic, episode_name, search_mode))
         return ResourceResponse(**response.json())
-    else:
-        print(f"Request failed with status code {response.status_code}")
-        return None
+
+    async def stream_answer(self, user_id: int, question: str, api_key: str, topic: Optional[str] = None, episode_name: Optional[str] = None,
+                            search_mode: Optional[str] = None, grading_mode: Optional[str] = None) -> AsyncIterator[Tuple[str, object]]:
+        response = await self._send("hubermanlab/answer/stream", headers={"Accept": "text/event-stream", "api-key": api_key},
+                                    params=_question_params(user_id, question, topic, episode_name, search_mode, grading_mode), stream=True)
+        try:
+            decoder = SSEDecoder()
+            async for line in response.aiter_lines():
+                item = decoder.feed(line.rstrip("\r\n"))
+                if item is not None:
+                    yield item
+            item = decoder.flush()
+            if item is not None:
+                yield item
+        finally:
+            await response.aclose()
+
+    async def answer_many(self, user_id: int, questions: List[str], api_key: str, concurrency: int = 8, **kwargs) -> List[AnswerResponse]:
+        """
+        Answers the questions with up to `concurrency` single-question requests in
+        flight, in the order of the questions.
+        """
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def answer_one(question):
+            async with semaphore:
+                return await self.answer(user_id, question, api_key, **kwargs)
+
+        return await asyncio.gather(*[answer_one(question) for question in questions])
+
+    async def resource_many(self, user_id: int, questions: List[str], concurrency: int = 8, **kwargs) -> List[ResourceResponse]:
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def resource_one(question):
+            async with semaphore:
+                return await self.resource(user_id, question, **kwargs)
+
+        return await asyncio.gather(*[resource_one(question) for question in questions])
+
+
+@functools.lru_cache(maxsize=None)
+def default_client() -> PodcastQAClient:
+    # Shared by the functions below, so their connections are reused
+    return PodcastQAClient()
+
+
+def call_embed_question(question: str) -> EmbedQuestionResponse:
+    return default_client().embed_question(question)
+
+
+def call_answer_hubermanlab(user_id: int, question: str, api_key: str, topic: Optional[str] = None, episode_name: Optional[str] = None) -> AnswerResponse:
+    return default_client().answer(user_id, question, api_key, topic=topic, episode_name=episode_name)
+
+
+def stream_answer_hubermanlab(user_id: int, question: str, api_key: str, topic: Optional[str] = None, episode_name: Optional[str] = None) -> Iterator[Tuple[str, object]]:
+    """
+    Yields the (event, data) pairs of the streaming answer endpoint as they arrive.
+    """
+    return default_client().stream_answer(user_id, question, api_key, topic=topic, episode_name=episode_name)
+
+
+def call_resource_hubermanlab(user_id: int, question: str, topic: Optional[str] = None, episode_name: Optional[str] = None) -> ResourceResponse:
+    return default_client().resource(user_id, question, topic=topic, episode_name=episode_name)
@@ -1,5 +1,5 @@
 from pydantic import BaseModel
-from typing import List
+from typing import List, Optional
 
 
 class EmbedQuestionResponse(BaseModel):
@@ -18,6 +18,37 @@ class ResourceResponse(BaseModel):
     resources: List[Resource]
 
 
+class Timing(BaseModel):
+    name: str
+    parent: Optional[str]
+    start_ms: float
+    duration_ms: float
+    attributes: dict
+
+
 class AnswerResponse(BaseModel):
     answer: str
     resources: List[Resource]
+    # Per-stage timings of the request, with the X-Debug-Timings header
+    timings: Optional[List[Timing]] = None
+
+
+class EmbedQuestionsRequest(BaseModel):
+    questions: List[str]
+
+
+class BatchQuestionsRequest(BaseModel):
+    user_id: int
+    questions: List[str]
+
+
+class EmbedQuestionsResponse(BaseModel):
+    embedded_questions: List[List[float]]
+
+
+class BatchResourceResponse(BaseModel):
+    results: List[ResourceResponse]
+
+
+class BatchAnswerResponse(BaseModel):
+    results: List[AnswerResponse]
@@ -13,5 +13,36 @@ SBERT_SUMMARY_EMBEDDINGS = Path(
 OPENAI_SUMMARY_EMBEDDINGS = Path(
     '.') / 'data' / 'embeddings' / 'summary_embeddings.joblib'
 
+TRANSCRIPTS_DIR = Path('.') / 'data' / 'transcripts'
+SUMMARIES_DIR = Path('.') / 'data' / 'summaries'
+VIDEO_METADATA_PATH = Path('.') / 'data' / 'video_metadata.csv'
+INGESTION_MANIFEST = Path('.') / 'data' / 'ingestion_manifest.json'
+
 QA_OUTPUT_DIR = Path('.') / 'data' / 'qa-outputs'
 IMAGES_DIR = Path('.') / 'data' / 'images'
+
+ENCODER_PATH = Path('.') / 'app' / 'models' / 'all-MiniLM-L6-v2'
+ENCODER_SNAPSHOT_PATH = Path('.') / 'app' / 'models' / 'all-MiniLM-L6-v2.pt'
+ENCODER_ONNX_PATH = ENCODER_PATH / 'onnx' / 'model.onnx'
+ENCODER_ONNX_INT8_PATH = ENCODER_PATH / 'onnx' / 'model_int8.onnx'
+
+LOCAL_INDEX_DIR = Path('.') / 'data' / 'embeddings' / 'local_index_sbert'
+# The query-time ANN setting chosen by `python -m app.src.store.index_manager tune`,
+# under app/ so a copy in the build tree ends up in the image (data/ isn't part of the image)
+VECTOR_SEARCH_SETTINGS_PATH = Path('.') / 'app' / 'settings' / 'vector_search_settings.json'
+# The similarity cut-offs chosen by `python -m app.src.llm.qa.candidate_selector`
+CANDIDATE_SELECTOR_PATH = Path('.') / 'app' / 'settings' / 'candidate_selector.json'
+RESOURCES_PARQUET = Path('.') / 'data' / 'resources_hubermanlab.parquet'
+
+# ChatGPT labels of the summary clusters, stored as the resource topic
+TOPICS = [
+    "Meditation, Focus, and Cognitive Training",
+    "Physical Performance and Recovery",
+    "Nutrition, Supplements, and Metabolic Health",
+    "Mental Health and Emotional Resilience",
+    "Sleep, Circadian Rhythms and Light",
+    "Neuroscience, Biohacking, and Health Monitoring",
+    "Relationships, Social Dynamics, and Personal Development",
+    "Taste, Smell, and Perception",
+    "Gut Health and Microbiome"
+]
@@ -0,0 +1,191 @@
+import atexit
+import datetime
+import queue
+import threading
+import time
+
+from dataclasses import dataclass, field
+from loguru import logger
+from sqlalchemy import insert
+from sqlalchemy.orm import Session, sessionmaker
+from typing import List, Optional
+
+from .models import QuestionsHubermanLab, RecommendedResourcesHubermanLab, AnswersHubermanLab
+from ..tracing import span
+
+
+@dataclass
+class QuestionLogRecord:
+    """
+    Everything that is logged for one question: the QuestionsHubermanLab row, its
+    RecommendedResourcesHubermanLab rows and, in the answer mode, its
+    AnswersHubermanLab row.
+    """
+    user_id: int
+    question: str
+    mode: str
+    created_at: datetime.datetime = field(default_factory=datetime.datetime.now)
+    recommended_resources: dict = field(default_factory=dict)
+    # Whether the checked recommended resources were relevant, by resource id
+    relevance: dict = field(default_factory=dict)
+    answer: Optional[str] = None
+    n_relevant: Optional[int] = None
+    n_non_relevant: Optional[int] = None
+
+
+def write_question_logs(db: Session, records: List[QuestionLogRecord]) -> None:
+    """
+    Writes the records in one transaction: the questions with a single multi-row
+    INSERT ... RETURNING, then their recommended resources and answers in bulk.
+    """
+    if not records:
+        return
+
+    with span("question_log", n_records=len(records)):
+        question_ids = db.execute(
+            insert(QuestionsHubermanLab).returning(
+                QuestionsHubermanLab.id, sort_by_parameter_order=True),
+            [{"user_id": record.user_id, "created_at": record.created_at,
+              "question": record.question, "mode": record.mode} for record in records]
+        ).scalars().all()
+
+        recommended_resources = [{"question_id": question_id, "resource_id": resource_id, "similarity_score": similarity_score,
+                                  "is_relevant": record.relevance.get(resource_id)}
+                                 for question_id, record in zip(question_ids, records)
+                                 for resource_id, similarity_score in record.recommended_resources.items()]
+        if recommended_resources:
+            db.execute(insert(RecommendedResourcesHubermanLab),
+                       recommended_resources)
+
+        answers = [{"user_id": record.user_id, "question_id": question_id, "answer": record.answer,
+                    "n_relevant": record.n_relevant, "n_non_relevant": record.n_non_relevant}
+                   for question_id, record in zip(question_ids, records) if record.answer is not None]
+        if answers:
+            db.execute(insert(AnswersHubermanLab), answers)
+
+        db.commit()
+
+
+class ActivityLogger:
+    """
+    Writes every record immediately, with the bulk inserts of `write_question_logs`,
+    using the given session.
+    """
+
+    def __init__(self, session: Session) -> None:
+        self.session = session
+
+    def log(self, record: QuestionLogRecord) -> None:
+        write_question_logs(self.session, [record])
+
+    def flush(self) -> None:
+        pass
+
+
+class WriteBehindActivityLogger:
+    """
+    Queues records and writes them from a background thread, batched across
+    requests, once `max_batch_size` records are queued or `flush_interval` seconds
+    have passed. Logging never blocks the request. `flush` writes out everything
+    queued so far, and `close` is called at interpreter exit as well.
+    """
+
+    def __init__(self,
+                 session_factory: sessionmaker,
+                 max_batch_size: int = 100,
+                 flush_interval: float = 5.0) -> None:
+        self.session_factory = session_factory
+        self.max_batch_size = max_batch_size
+        self.flush_interval = flush_interval
+
+        self._queue = queue.Queue()
+        self._flush_requested = threading.Event()
+        self._closed = threading.Event()
+        self._worker = threading.Thread(
+            target=self._run, name="activity-log-writer", daemon=True)
+        self._worker.start()
+        atexit.register(self.close)
+
+    def log(self, record: QuestionLogRecord) -> None:
+        if self._closed.is_set():
+            raise RuntimeError("Activity logger is closed")
+        self._queue.put(record)
+
+    def flush(self) -> None:
+        """
+        Blocks until every record queued so far is written.
+        """
+        self._flush_requested.set()
+        self._queue.join()
+
+    def request_flush(self) -> None:
+        """
+        Has the worker write every record queued so far without waiting for the
+        batch to fill up or the interval to pass. Doesn't block.
+        """
+        self._flush_requested.set()
+
+    def close(self) -> None:
+        if self._closed.is_set():
+            return
+        self._closed.set()
+        self._queue.join()
+        self._worker.join()
+
+    def _next_batch(self) -> List[QuestionLogRecord]:
+        batch = []
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.max_batch_size:
+            if self._flush_requested.is_set() or self._closed.is_set():
+                # Drain what is queued without waiting for the interval
+                try:
+                    batch.append(self._queue.get_nowait())
+                    continue
+                except queue.Empty:
+                    self._flush_requested.clear()
+                    break
+
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                # Wake up regularly so flush requests are noticed
+                batch.append(self._queue.get(timeout=min(timeout, 0.1)))
+            except queue.Empty:
+                continue
+        return batch
+
+    def _write(self, batch: List[QuestionLogRecord]) -> None:
+        start_time = time.time()
+        try:
+            with self.session_factory() as session:
+                write_question_logs(session, batch)
+            logger.info(
+                f"Activity log flush of {len(batch)} records: {round(time.time()-start_time, 2)}")
+        except Exception:
+            logger.exception(
+                f"Failed to write {len(batch)} activity log records")
+
+    def _run(self) -> None:
+        while True:
+            batch = self._next_batch()
+            if batch:
+                try:
+                    self._write(batch)
+                finally:
+                    for _ in batch:
+                        self._queue.task_done()
+            elif self._closed.is_set():
+                return
+
+
+class NullActivityLogger:
+    """
+    Drops every record, for the engines that run without a database.
+    """
+
+    def log(self, record: QuestionLogRecord) -> None:
+        pass
+
+    def flush(self) -> None:
+        pass
@@ -0,0 +1,46 @@
+import threading
+
+from collections import OrderedDict
+from typing import Iterable, Optional
+
+from .models import ResourcesHubermanLab
+
+
+class ResourceCache:
+    """
+    In-process read-through cache of ResourcesHubermanLab rows. The corpus is a
+    few thousand static segments, so the rows are kept detached from any session
+    and shared between requests. With `max_size` set, the least recently used
+    rows are evicted first.
+    """
+
+    def __init__(self, max_size: Optional[int] = None) -> None:
+        self.max_size = max_size
+        self._rows = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._rows)
+
+    def get_many(self, resource_ids: Iterable[int]) -> dict:
+        found = {}
+        with self._lock:
+            for resource_id in resource_ids:
+                row = self._rows.get(resource_id)
+                if row is not None:
+                    self._rows.move_to_end(resource_id)
+                    found[resource_id] = row
+        return found
+
+    def put_many(self, rows: Iterable[ResourcesHubermanLab]) -> None:
+        with self._lock:
+            for row in rows:
+                self._rows[row.id] = row
+                self._rows.move_to_end(row.id)
+            if self.max_size is not None:
+                while len(self._rows) > self.max_size:
+                    self._rows.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._rows.clear()
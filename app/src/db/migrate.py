@@ -0,0 +1,43 @@
+"""
+Adds the columns of the models that the existing tables were created without,
+e.g. recommended_resources_hubermanlab.is_relevant. Run it once before deploying
+an API version that writes them:
+
+    python -m app.src.db.migrate
+"""
+import os
+
+from loguru import logger
+from sqlalchemy import inspect, text
+from sqlalchemy.engine import Engine
+
+from .models import Base
+
+
+def add_missing_columns(sql_engine: Engine) -> None:
+    """
+    Adds the nullable columns of the models missing from the existing tables.
+    IF NOT EXISTS makes concurrent runs safe.
+    """
+    inspector = inspect(sql_engine)
+    with sql_engine.begin() as connection:
+        for table in Base.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+            existing = {column["name"]
+                        for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in existing and column.nullable:
+                    logger.info(f"Adding column {table.name}.{column.name}")
+                    connection.execute(text(
+                        f"ALTER TABLE {table.name} ADD COLUMN IF NOT EXISTS {column.name} {column.type.compile(sql_engine.dialect)}"))
+
+
+if __name__ == "__main__":
+    from dotenv import load_dotenv
+    from sqlalchemy import create_engine
+
+    load_dotenv()
+    DB_CONNECTION = f"postgresql://postgres:{os.environ['POSTGRES_DB_PASS']}@{os.environ['POSTGRES_DB_HOST']}:5432/postgres"
+
+    add_missing_columns(create_engine(DB_CONNECTION))
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Float, ForeignKey, DateTime
+from sqlalchemy import Boolean, Column, Integer, String, Float, ForeignKey, DateTime
 from sqlalchemy.orm import relationship
 from sqlalchemy.ext.declarative import declarative_base
 
@@ -62,3 +62,13 @@ class RecommendedResourcesHubermanLab(Base):
     question_id = Column(Integer, ForeignKey('questions_hubermanlab.id'))
     resource_id = Column(Integer, ForeignKey('resources_hubermanlab.id'))
     similarity_score = Column(Float)
+    # The outcome of the relevance check of the segment, NULL if it wasn't checked
+    is_relevant = Column(Boolean)
+
+
+class LLMResponseCacheEntry(Base):
+    __tablename__ = 'llm_response_cache'
+
+    key = Column(String, primary_key=True)
+    response = Column(String)
+    created_at = Column(DateTime, index=True)
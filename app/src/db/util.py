@@ -1,27 +1,86 @@
-import datetime
+from loguru import logger
+from itertools import groupby
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
+from typing import Iterable, List, Optional, Tuple
 
-from .models import QuestionsHubermanLab, RecommendedResourcesHubermanLab, AnswersHubermanLab
+from .cache import ResourceCache
+from .models import RecommendedResourcesHubermanLab, ResourcesHubermanLab
 
 
-def create_question_instance(db: Session, user_id: int, question: str, mode: str):
-    new_question = QuestionsHubermanLab(
-        user_id=user_id, created_at=datetime.datetime.now(), question=question, mode=mode)
-    db.add(new_question)
-    db.commit()
-    return new_question.id
+def get_resources(db: Session, resource_ids: Iterable[int], cache: ResourceCache = None) -> List[ResourcesHubermanLab]:
+    """
+    Loads the resources for all ids in a single `IN (...)` query and returns them
+    in the order of `resource_ids`, i.e. the similarity order of search results.
+    The rows are detached from the session, so later commits don't expire them.
+    """
+    resource_ids = [int(resource_id) for resource_id in resource_ids]
+    resources = cache.get_many(resource_ids) if cache is not None else {}
 
+    missing_ids = [
+        resource_id for resource_id in resource_ids if resource_id not in resources]
+    if missing_ids:
+        rows = db.query(ResourcesHubermanLab).filter(
+            ResourcesHubermanLab.id.in_(missing_ids)).all()
+        for row in rows:
+            db.expunge(row)
+            resources[row.id] = row
+        if cache is not None:
+            cache.put_many(rows)
 
-def add_recommended_resources(db: Session, question_id: int, indices: dict):
-    for resource_id, similarity_score in indices.items():
-        new_recommended_resource = RecommendedResourcesHubermanLab(
-            question_id=question_id, resource_id=resource_id, similarity_score=similarity_score)
-        db.add(new_recommended_resource)
-    db.commit()
+    not_found = [
+        resource_id for resource_id in resource_ids if resource_id not in resources]
+    if not_found:
+        logger.warning(f"Resources not found: {not_found}")
 
+    return [resources[resource_id] for resource_id in resource_ids if resource_id in resources]
 
-def add_answer(db: Session, user_id: int, question_id: int, answer: str, n_relevant: int, n_non_relevant: int):
-    new_answer = AnswersHubermanLab(
-        user_id=user_id, question_id=question_id, answer=answer, n_relevant=n_relevant, n_non_relevant=n_non_relevant)
-    db.add(new_answer)
-    db.commit()
+
+def get_relevance_outcomes(db: Session, max_questions: int = None) -> List[List[Tuple[float, Optional[bool]]]]:
+    """
+    The (similarity, is_relevant) of the recommended resources of every question
+    with checked segments, most similar first, of the latest `max_questions`
+    questions. Unchecked resources have no outcome (None).
+    """
+    checked_questions = select(RecommendedResourcesHubermanLab.question_id).where(
+        RecommendedResourcesHubermanLab.is_relevant.is_not(None)).distinct().order_by(
+        RecommendedResourcesHubermanLab.question_id.desc())
+    if max_questions is not None:
+        checked_questions = checked_questions.limit(max_questions)
+
+    rows = db.execute(select(RecommendedResourcesHubermanLab.question_id,
+                             RecommendedResourcesHubermanLab.similarity_score,
+                             RecommendedResourcesHubermanLab.is_relevant)
+                      .where(RecommendedResourcesHubermanLab.question_id.in_(checked_questions.scalar_subquery()),
+                             RecommendedResourcesHubermanLab.similarity_score.is_not(None))
+                      .order_by(RecommendedResourcesHubermanLab.question_id,
+                                RecommendedResourcesHubermanLab.similarity_score.desc())).all()
+    return [[(similarity, is_relevant) for _, similarity, is_relevant in question_rows]
+            for _, question_rows in groupby(rows, key=lambda row: row[0])]
+
+
+async def get_resources_async(db: AsyncSession, resource_ids: Iterable[int], cache: ResourceCache = None) -> List[ResourcesHubermanLab]:
+    """
+    `get_resources` on an AsyncSession.
+    """
+    resource_ids = [int(resource_id) for resource_id in resource_ids]
+    resources = cache.get_many(resource_ids) if cache is not None else {}
+
+    missing_ids = [
+        resource_id for resource_id in resource_ids if resource_id not in resources]
+    if missing_ids:
+        rows = (await db.execute(select(ResourcesHubermanLab).where(
+            ResourcesHubermanLab.id.in_(missing_ids)))).scalars().all()
+        for row in rows:
+            db.expunge(row)
+            resources[row.id] = row
+        if cache is not None:
+            cache.put_many(rows)
+
+    not_found = [
+        resource_id for resource_id in resource_ids if resource_id not in resources]
+    if not_found:
+        logger.warning(f"Resources not found: {not_found}")
+
+    return [resources[resource_id] for resource_id in resource_ids if resource_id in resources]
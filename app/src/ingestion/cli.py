@@ -0,0 +1,106 @@
+"""
+Ingests new or changed transcript segments:
+
+    python -m app.src.ingestion.cli --bootstrap
+    python -m app.src.ingestion.cli --max-workers 8
+"""
+import argparse
+import os
+
+from dotenv import load_dotenv
+from loguru import logger
+from pathlib import Path
+
+from .manifest import Manifest, STAGES
+from .pipeline import IngestionPipeline, TopicClassifier
+from .segments import discover_segments, load_video_ids
+from ..constants import TRANSCRIPTS_DIR, SUMMARIES_DIR, VIDEO_METADATA_PATH, INGESTION_MANIFEST, DF_SUMMARY_PATH
+from ..llm.summary.summary_engine import SummaryEngine
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Ingests transcript segments into the resources table and the vector store.")
+    parser.add_argument('--transcripts-dir', type=Path, default=TRANSCRIPTS_DIR,
+                        help='Directory with the transcript segment files.')
+    parser.add_argument('--summaries-dir', type=Path, default=SUMMARIES_DIR,
+                        help='Directory the summaries are written to.')
+    parser.add_argument('--video-metadata', type=Path, default=VIDEO_METADATA_PATH,
+                        help='Playlist metadata CSV with the video ids of the episodes.')
+    parser.add_argument('--manifest', type=Path, default=INGESTION_MANIFEST,
+                        help='Manifest of the processed segments.')
+    parser.add_argument('--stages', nargs='+', default=list(STAGES), choices=STAGES,
+                        help='Stages to run. Default: all.')
+    parser.add_argument('--bootstrap', action='store_true',
+                        help='Adopt the segments that already are resources before running.')
+    parser.add_argument('--max-workers', type=int, default=4,
+                        help='Number of concurrent summary calls. Default: 4.')
+    parser.add_argument('--batch-size', type=int, default=64,
+                        help='Number of segments embedded and indexed at once. Default: 64.')
+    parser.add_argument('--llm_model', default='gpt-3.5-turbo',
+                        help='Summary model. Default: "gpt-3.5-turbo".')
+    parser.add_argument('--local-only', action='store_true',
+                        help='Only update the summaries and the summary CSV, without the database and vecs.')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='Only report what would be processed.')
+    args = parser.parse_args()
+
+    load_dotenv()
+
+    if args.video_metadata.exists():
+        video_ids = load_video_ids(args.video_metadata)
+    else:
+        logger.warning(
+            f"{args.video_metadata} not found, segments without a video id are not indexed")
+        video_ids = {}
+    segments = discover_segments(args.transcripts_dir, video_ids)
+    manifest = Manifest(args.manifest)
+
+    session_factory = None
+    vx = None
+    if not args.local_only:
+        import vecs
+        from sqlalchemy import create_engine
+        from sqlalchemy.orm import sessionmaker
+
+        db_connection = f"postgresql://postgres:{os.environ['POSTGRES_DB_PASS']}@{os.environ['POSTGRES_DB_HOST']}:5432/postgres"
+        session_factory = sessionmaker(bind=create_engine(db_connection))
+        vx = vecs.create_client(db_connection)
+
+    encoder = None
+    topic_classifier = None
+    if "index" in args.stages and not args.dry_run:
+        from ..llm.qa.postgres_qa_engine import EmbeddingModel, load_embedding_model
+
+        encoder = load_embedding_model(EmbeddingModel.SBERT)
+        topic_classifier = TopicClassifier.from_summary_csv(
+            encoder, DF_SUMMARY_PATH)
+
+    pipeline = IngestionPipeline(manifest,
+                                 summaries_dir=args.summaries_dir,
+                                 summary_engine=SummaryEngine(
+                                     model_name=args.llm_model, max_workers=args.max_workers),
+                                 encoder=encoder,
+                                 topic_classifier=topic_classifier,
+                                 session_factory=session_factory,
+                                 vecs_client=vx,
+                                 batch_size=args.batch_size)
+
+    if args.bootstrap and session_factory is not None:
+        pipeline.bootstrap(segments)
+
+    if args.dry_run:
+        for stage in args.stages:
+            logger.info(
+                f"{stage}: {len(pipeline.pending(segments, stage))} of {len(segments)} segments pending")
+        return
+
+    processed = pipeline.run(segments, args.stages)
+    logger.info(f"Processed segments: {processed}")
+    if processed.get("index"):
+        logger.info(
+            "Rebuild the local index with: python main.py --build-local-index")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+import hashlib
+import json
+import os
+
+from pathlib import Path
+from typing import Optional
+
+STAGES = ("summary", "index")
+
+
+def content_hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class Manifest:
+    """
+    Ingestion state of every transcript segment, keyed by the transcript file
+    name: the hash of its content, the content hash each stage was last completed
+    for, and what the index stage produced (the resource id and topic). A stage
+    is done for a segment when it was completed for the current content, so a
+    changed transcript is processed again and an unchanged one is skipped.
+
+    The manifest is a JSON file, replaced atomically on every `save`, so an
+    interrupted run resumes from the last checkpoint.
+    """
+
+    def __init__(self, path: Path) -> None:
+        self.path = Path(path)
+        self.entries = {}
+        if self.path.exists():
+            with open(self.path) as f:
+                self.entries = json.load(f)
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def get(self, key: str) -> Optional[dict]:
+        return self.entries.get(key)
+
+    def track(self, key: str, content_hash: str) -> dict:
+        entry = self.entries.setdefault(key, {"stages": {}})
+        entry["content_hash"] = content_hash
+        return entry
+
+    def is_done(self, key: str, stage: str, content_hash: str = None) -> bool:
+        """
+        Whether the stage was completed for the tracked (or the given) content.
+        """
+        entry = self.entries.get(key)
+        if entry is None:
+            return False
+        return entry["stages"].get(stage) == (content_hash or entry["content_hash"])
+
+    def mark_done(self, key: str, stage: str, **values) -> None:
+        entry = self.entries[key]
+        entry["stages"][stage] = entry["content_hash"]
+        entry.update(values)
+
+    def save(self) -> None:
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_name(self.path.name + ".tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(self.entries, f, indent=1, sort_keys=True)
+        os.replace(tmp_path, self.path)
@@ -0,0 +1,295 @@
+import time
+import numpy as np
+
+from loguru import logger
+from pathlib import Path
+from sqlalchemy import insert, update
+from sqlalchemy.orm import sessionmaker
+from typing import Dict, List, Sequence
+
+from .manifest import Manifest, STAGES
+from .segments import Segment
+from ..constants import DF_SUMMARY_PATH, SBERT_SUMMARY_EMBEDDINGS
+from ..db.models import ResourcesHubermanLab
+from ..llm.summary.summary_engine import SummaryEngine
+from ..store.topic_partitions import topic_collection_name
+
+
+class TopicClassifier:
+    """
+    Labels new segments with the topic whose centroid of summary embeddings is
+    nearest. The centroids come from the labeled corpus, so new episodes get the
+    same topics as the clustered one without clustering it again.
+    """
+
+    def __init__(self, topics: List[str], centroids: np.ndarray) -> None:
+        self.topics = topics
+        self.centroids = centroids / \
+            np.linalg.norm(centroids, axis=1, keepdims=True)
+
+    @classmethod
+    def from_summary_csv(cls, encoder, df_summary_path: Path = DF_SUMMARY_PATH, embeddings_path: Path = SBERT_SUMMARY_EMBEDDINGS) -> "TopicClassifier":
+        import joblib
+        import pandas as pd
+
+        df_summary = pd.read_csv(df_summary_path)
+        if Path(embeddings_path).exists():
+            embeddings = np.asarray(joblib.load(
+                embeddings_path), dtype=np.float32)[:len(df_summary)]
+            df_summary = df_summary.iloc[:len(embeddings)]
+            # The stored embeddings are in the row order, so they drop the same rows
+            embeddings = embeddings[df_summary["chatgpt_labels"].notna().to_numpy()]
+            df_summary = df_summary.dropna(subset=["chatgpt_labels"])
+        else:
+            df_summary = df_summary.dropna(subset=["chatgpt_labels"])
+            embeddings = np.asarray(encoder.encode(
+                df_summary["summary"].fillna("").tolist(), batch_size=64), dtype=np.float32)
+        embeddings /= np.linalg.norm(embeddings, axis=1, keepdims=True)
+
+        # Segments without a label don't count towards any topic
+        labels = df_summary["chatgpt_labels"].to_numpy()
+        topics = sorted(set(labels))
+        centroids = np.stack([embeddings[labels == topic].mean(axis=0)
+                              for topic in topics])
+        return cls(topics, centroids)
+
+    def predict(self, embeddings: np.ndarray) -> List[str]:
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        return [self.topics[i] for i in (embeddings @ self.centroids.T).argmax(axis=1)]
+
+
+class IngestionPipeline:
+    """
+    Takes transcript segments to ResourcesHubermanLab rows and vecs vectors in two
+    stages, each checkpointed in the manifest:
+
+    - "summary": bounded-parallel LLM summaries, written to `summaries_dir`
+    - "index": in batches, the summaries are embedded, labeled with a topic,
+      upserted as resources, vectors (in the docs and topic collections) and rows
+      of the summary CSV
+
+    Segments whose content hash already completed a stage are skipped, so a rerun
+    only processes new or changed transcripts, and an interrupted run resumes.
+    """
+
+    def __init__(self,
+                 manifest: Manifest,
+                 summaries_dir: Path,
+                 summary_engine: SummaryEngine = None,
+                 encoder=None,
+                 topic_classifier: TopicClassifier = None,
+                 session_factory: sessionmaker = None,
+                 vecs_client=None,
+                 collection_name: str = "docs",
+                 partition_by_topic: bool = True,
+                 df_summary_path: Path = DF_SUMMARY_PATH,
+                 batch_size: int = 64,
+                 checkpoint_every: int = 10) -> None:
+        self.manifest = manifest
+        self.summaries_dir = Path(summaries_dir)
+        self.summary_engine = summary_engine
+        self.encoder = encoder
+        self.topic_classifier = topic_classifier
+        self.session_factory = session_factory
+        self.vx = vecs_client
+        self.collection_name = collection_name
+        self.partition_by_topic = partition_by_topic
+        self.df_summary_path = df_summary_path
+        self.batch_size = batch_size
+        self.checkpoint_every = checkpoint_every
+        self._collections = {}
+
+    def summary_path(self, segment: Segment) -> Path:
+        return self.summaries_dir / f"(Summary) {segment.key}"
+
+    def pending(self, segments: Sequence[Segment], stage: str) -> List[Segment]:
+        return [segment for segment in segments if not self.manifest.is_done(segment.key, stage, segment.content_hash)]
+
+    def run(self, segments: Sequence[Segment], stages: Sequence[str] = STAGES) -> Dict[str, int]:
+        """
+        Runs the stages over the segments and returns how many segments each stage
+        processed.
+        """
+        # Summary files from before the manifest existed are kept
+        new_keys = {segment.key for segment in segments
+                    if self.manifest.get(segment.key) is None}
+        for segment in segments:
+            self.manifest.track(segment.key, segment.content_hash)
+            if segment.key in new_keys and self.summary_path(segment).exists():
+                self.manifest.mark_done(segment.key, "summary")
+        self.manifest.save()
+
+        processed = {}
+        if "summary" in stages:
+            processed["summary"] = self.summarize(segments)
+        if "index" in stages:
+            processed["index"] = self.index(segments)
+        return processed
+
+    def bootstrap(self, segments: Sequence[Segment]) -> int:
+        """
+        Adopts the segments that are already resources, matched by episode and
+        segment name, as indexed, so the existing corpus isn't ingested again.
+        """
+        with self.session_factory() as session:
+            existing = {(resource.episode_name, resource.segment_title): resource
+                        for resource in session.query(ResourcesHubermanLab).all()}
+
+        n_adopted = 0
+        for segment in segments:
+            resource = existing.get(
+                (segment.episode_name, segment.segment_name))
+            if resource is None or self.manifest.is_done(segment.key, "index"):
+                continue
+            self.manifest.track(segment.key, segment.content_hash)
+            self.manifest.mark_done(segment.key, "summary")
+            self.manifest.mark_done(segment.key, "index",
+                                    resource_id=resource.id, topic=resource.topic)
+            n_adopted += 1
+
+        self.manifest.save()
+        logger.info(f"Adopted {n_adopted} existing segments")
+        return n_adopted
+
+    def summarize(self, segments: Sequence[Segment]) -> int:
+        pending = {segment.key: segment for segment in self.pending(segments, "summary")}
+        if not pending:
+            return 0
+
+        logger.info(f"Summarizing {len(pending)} segments")
+        self.summaries_dir.mkdir(parents=True, exist_ok=True)
+        n_done = 0
+
+        def on_summary(key, summary):
+            nonlocal n_done
+            self.summary_path(pending[key]).write_text(summary)
+            self.manifest.mark_done(key, "summary")
+            n_done += 1
+            if n_done % self.checkpoint_every == 0:
+                self.manifest.save()
+                logger.info(f"Summarized {n_done}/{len(pending)} segments")
+
+        try:
+            self.summary_engine.summarize_many(
+                ((key, segment.text) for key, segment in pending.items()), on_summary=on_summary)
+        finally:
+            self.manifest.save()
+        return n_done
+
+    def index(self, segments: Sequence[Segment]) -> int:
+        # Only summarized segments can be indexed
+        pending = [segment for segment in self.pending(segments, "index")
+                   if self.manifest.is_done(segment.key, "summary")]
+        # Resources link to the episode video, so a segment without a video id
+        # stays pending until its episode is in the video metadata
+        no_url = [segment for segment in pending if segment.url is None]
+        if no_url:
+            logger.warning(
+                f"Not indexing {len(no_url)} segments without a video id, e.g. {no_url[0].key}")
+            pending = [segment for segment in pending if segment.url is not None]
+        if not pending:
+            return 0
+
+        logger.info(f"Indexing {len(pending)} segments")
+        for start in range(0, len(pending), self.batch_size):
+            start_time = time.time()
+            self._index_batch(pending[start:start+self.batch_size])
+            self.manifest.save()
+            logger.info(
+                f"Indexed {min(start + self.batch_size, len(pending))}/{len(pending)} segments: {round(time.time()-start_time, 2)}")
+        return len(pending)
+
+    def _index_batch(self, batch: List[Segment]) -> None:
+        summaries = [self.summary_path(segment).read_text()
+                     for segment in batch]
+        embeddings = np.asarray(self.encoder.encode(
+            summaries, batch_size=self.batch_size), dtype=np.float32)
+        topics = self.topic_classifier.predict(embeddings)
+
+        resource_ids = self._upsert_resources(batch, summaries, topics)
+        if self.vx is not None:
+            self._upsert_vectors(batch, embeddings, topics, resource_ids)
+        if self.df_summary_path is not None:
+            self._upsert_summary_rows(batch, summaries, topics)
+
+        for segment, resource_id, topic in zip(batch, resource_ids, topics):
+            self.manifest.mark_done(segment.key, "index",
+                                    resource_id=resource_id, topic=topic)
+
+    def _upsert_resources(self, batch: List[Segment], summaries: List[str], topics: List[str]) -> List[int]:
+        # Changed segments keep their resource id
+        previous_ids = [self.manifest.get(segment.key).get("resource_id")
+                        for segment in batch]
+        if self.session_factory is None:
+            return previous_ids
+
+        rows = [{"summary": summary, "episode_name": segment.episode_name, "segment_title": segment.segment_name,
+                 "url": segment.url, "topic": topic}
+                for segment, summary, topic in zip(batch, summaries, topics)]
+
+        with self.session_factory() as session:
+            new_rows = [row for row, resource_id in zip(
+                rows, previous_ids) if resource_id is None]
+            new_ids = iter(session.execute(
+                insert(ResourcesHubermanLab).returning(
+                    ResourcesHubermanLab.id, sort_by_parameter_order=True),
+                new_rows).scalars().all() if new_rows else [])
+
+            changed_rows = [{**row, "id": resource_id} for row, resource_id in zip(
+                rows, previous_ids) if resource_id is not None]
+            if changed_rows:
+                session.execute(update(ResourcesHubermanLab), changed_rows)
+            session.commit()
+
+        return [resource_id if resource_id is not None else next(new_ids) for resource_id in previous_ids]
+
+    def _collection(self, name: str):
+        if name not in self._collections:
+            self._collections[name] = self.vx.get_or_create_collection(
+                name=name, dimension=self.encoder.get_sentence_embedding_dimension())
+        return self._collections[name]
+
+    def _upsert_vectors(self, batch: List[Segment], embeddings: np.ndarray, topics: List[str], resource_ids: List[int]) -> None:
+        records = [(str(resource_id), embedding.tolist(), {"topic": topic, "episode_name": segment.episode_name})
+                   for segment, embedding, topic, resource_id in zip(batch, embeddings, topics, resource_ids)]
+        self._collection(self.collection_name).upsert(records=records)
+
+        if not self.partition_by_topic:
+            return
+        for segment, record in zip(batch, records):
+            topic = record[2]["topic"]
+            # A changed segment can move to another topic
+            previous_topic = self.manifest.get(segment.key).get("topic")
+            if previous_topic is not None and previous_topic != topic:
+                self._collection(topic_collection_name(
+                    self.collection_name, previous_topic)).delete(ids=[record[0]])
+            self._collection(topic_collection_name(
+                self.collection_name, topic)).upsert(records=[record])
+
+    def _upsert_summary_rows(self, batch: List[Segment], summaries: List[str], topics: List[str]) -> None:
+        """
+        Keeps the summary CSV, the source of the local index and the keyword search,
+        in sync. New segments are appended, so the row numbers of the existing
+        segments don't change.
+        """
+        import pandas as pd
+
+        df_summary = pd.read_csv(self.df_summary_path)
+        rows = {(episode_name, segment_name): i for i, (episode_name, segment_name) in enumerate(
+            zip(df_summary["episode_name"], df_summary["segment_name"]))}
+
+        new_rows = []
+        for segment, summary, topic in zip(batch, summaries, topics):
+            values = {"episode_name": segment.episode_name, "segment_name": segment.segment_name,
+                      "summary": summary, "url": segment.url, "chatgpt_labels": topic}
+            row = rows.get((segment.episode_name, segment.segment_name))
+            if row is None:
+                new_rows.append({**values, "keywords": ""})
+            else:
+                for column, value in values.items():
+                    df_summary.at[row, column] = value
+
+        if new_rows:
+            df_summary = pd.concat(
+                [df_summary, pd.DataFrame(new_rows)], ignore_index=True)
+        df_summary.to_csv(self.df_summary_path, index=False)
@@ -0,0 +1,92 @@
+import re
+
+from dataclasses import dataclass
+from loguru import logger
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+from .manifest import content_hash
+
+# "Episode <title>, Segment <title> (<start> <end>).txt", with ":" written as "-"
+SEGMENT_FILENAME_PATTERN = re.compile(
+    r"^Episode(?P<episode>.*?),\s*Segment(?P<segment>.*)\((?P<start>[0-9\-]+)\s(?P<end>[0-9\-]+)\)\.txt$")
+
+
+@dataclass
+class Segment:
+    key: str
+    path: Path
+    text: str
+    content_hash: str
+    episode_name: str
+    segment_name: str
+    start_seconds: int
+    url: Optional[str] = None
+
+
+def to_seconds(timestamp: str) -> int:
+    """
+    Seconds of a "ss", "mm-ss" or "hh-mm-ss" timestamp.
+    """
+    seconds = 0
+    for part in timestamp.split("-"):
+        seconds = seconds * 60 + int(part)
+    return seconds
+
+
+def normalize_title(title: str) -> str:
+    # Titles are stored the way they appear in the file names
+    return title.replace("/", " ").replace(":", "-")
+
+
+def parse_segment_filename(filename: str) -> Optional[Tuple[str, str, int]]:
+    """
+    Returns the episode name, the segment name and the start (in seconds) of a
+    transcript file name, or None if it doesn't follow the naming scheme.
+    """
+    match = SEGMENT_FILENAME_PATTERN.match(filename)
+    if match is None:
+        return None
+    return match.group("episode").strip(), match.group("segment").strip(), to_seconds(match.group("start"))
+
+
+def get_yt_url(video_id: str, start_seconds: int) -> str:
+    return f"https://www.youtube.com/watch?v={video_id}&t={start_seconds}s"
+
+
+def load_video_ids(video_metadata_path: Path) -> Dict[str, str]:
+    """
+    YouTube video ids by (normalized) episode title, from the playlist metadata CSV.
+    """
+    import pandas as pd
+
+    video_data = pd.read_csv(video_metadata_path)
+    return {normalize_title(title): video_id for title, video_id in zip(video_data["title"], video_data["videoId"])}
+
+
+def discover_segments(transcripts_dir: Path, video_ids: Dict[str, str] = None) -> List[Segment]:
+    """
+    Reads and hashes every transcript segment file. Files that don't follow the
+    naming scheme are skipped. Segments of episodes missing from `video_ids` have
+    no url and are not indexed.
+    """
+    video_ids = video_ids or {}
+    segments = []
+    for path in sorted(Path(transcripts_dir).glob("*.txt")):
+        parsed = parse_segment_filename(path.name)
+        if parsed is None:
+            logger.warning(f"Skipping transcript with an unknown name: {path.name}")
+            continue
+
+        episode_name, segment_name, start_seconds = parsed
+        text = path.read_text()
+        video_id = video_ids.get(episode_name)
+        segments.append(Segment(key=path.name,
+                                path=path,
+                                text=text,
+                                content_hash=content_hash(text),
+                                episode_name=episode_name,
+                                segment_name=segment_name,
+                                start_seconds=start_seconds,
+                                url=get_yt_url(video_id, start_seconds) if video_id is not None else None))
+    return segments
@@ -0,0 +1,153 @@
+import datetime
+import hashlib
+import json
+import threading
+import time
+
+from collections import OrderedDict
+from loguru import logger
+from sqlalchemy import delete, select
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import sessionmaker
+from typing import Optional
+
+from ..db.models import LLMResponseCacheEntry
+
+
+def llm_cache_key(**inputs) -> str:
+    """
+    Content-addressed key of an LLM call, e.g. a hash of the question, the
+    context, the model, the temperature and the prompt templates.
+    """
+    payload = json.dumps(inputs, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class LLMCache:
+    """
+    Base class of the LLM response caches. Keeps the hit/miss counters, the
+    backends implement `_get` and `_set`.
+    """
+
+    def __init__(self, ttl: Optional[float] = None) -> None:
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._counter_lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[str]:
+        value = self._get(key)
+        with self._counter_lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return value
+
+    def set(self, key: str, value: str) -> None:
+        self._set(key, value)
+
+    def stats(self) -> dict:
+        requests = self.hits + self.misses
+        return {"hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / requests if requests else 0.0}
+
+    def _get(self, key: str) -> Optional[str]:
+        raise NotImplementedError
+
+    def _set(self, key: str, value: str) -> None:
+        raise NotImplementedError
+
+
+class InMemoryLLMCache(LLMCache):
+    """
+    Process-local LRU cache of LLM responses with an optional TTL in seconds.
+    """
+
+    def __init__(self, max_size: int = 10000, ttl: Optional[float] = None) -> None:
+        super().__init__(ttl=ttl)
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _get(self, key: str) -> Optional[str]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+
+            value, created_at = entry
+            if self.ttl is not None and time.time() - created_at > self.ttl:
+                del self._entries[key]
+                return None
+
+            self._entries.move_to_end(key)
+            return value
+
+    def _set(self, key: str, value: str) -> None:
+        with self._lock:
+            self._entries[key] = (value, time.time())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+
+class SQLLLMCache(LLMCache):
+    """
+    LLM responses persisted in the `llm_response_cache` table, e.g. in Postgres or
+    SQLite, so they survive restarts and are shared between Lambda containers.
+    Once the table grows past `max_size` entries, the oldest ones are evicted.
+    """
+
+    def __init__(self,
+                 sql_engine: Engine,
+                 max_size: int = 100000,
+                 ttl: Optional[float] = None,
+                 eviction_interval: int = 100) -> None:
+        super().__init__(ttl=ttl)
+        self.max_size = max_size
+        self.eviction_interval = eviction_interval
+        self.Session = sessionmaker(bind=sql_engine)
+        self._n_sets = 0
+
+        LLMResponseCacheEntry.__table__.create(bind=sql_engine, checkfirst=True)
+
+    def _get(self, key: str) -> Optional[str]:
+        with self.Session() as session:
+            entry = session.get(LLMResponseCacheEntry, key)
+            if entry is None:
+                return None
+
+            if self.ttl is not None and (datetime.datetime.now() - entry.created_at).total_seconds() > self.ttl:
+                session.delete(entry)
+                session.commit()
+                return None
+
+            return entry.response
+
+    def _set(self, key: str, value: str) -> None:
+        try:
+            with self.Session() as session:
+                session.merge(LLMResponseCacheEntry(
+                    key=key, response=value, created_at=datetime.datetime.now()))
+                session.commit()
+
+                self._n_sets += 1
+                if self._n_sets % self.eviction_interval == 0:
+                    self._evict(session)
+        except Exception:
+            # The cache is an optimization, a failed write must not fail the request
+            logger.exception("Failed to write the LLM response cache")
+
+    def _evict(self, session) -> None:
+        oldest_kept = session.execute(
+            select(LLMResponseCacheEntry.created_at)
+            .order_by(LLMResponseCacheEntry.created_at.desc())
+            .offset(self.max_size - 1)
+            .limit(1)
+        ).scalar()
+        if oldest_kept is not None:
+            session.execute(delete(LLMResponseCacheEntry).where(
+                LLMResponseCacheEntry.created_at < oldest_kept))
+            session.commit()
@@ -0,0 +1,322 @@
+"""
+Process-wide dispatch of the chat model calls, shared by all requests:
+
+- one chat model client per API key, model, temperature and streaming mode,
+  instead of a new one per call
+- token buckets for the requests and the tokens per minute of every API key, so
+  calls wait for budget instead of being rejected with a 429
+- final answers are admitted before the segment checks waiting for budget
+- failed calls (rate limits, timeouts, 5xx) are retried with jittered exponential
+  backoff; a rate limited key pauses all of its calls for the backoff
+"""
+import asyncio
+import functools
+import heapq
+import itertools
+import random
+import threading
+import time
+
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from loguru import logger
+from typing import Awaitable, Callable, Optional
+
+from .tokens import count_tokens
+from ..tracing import metrics
+
+# Lower is admitted first
+PRIORITIES = {"final_answer": 0, "segment_grading": 1, "segment_check": 1}
+
+# The completion tokens reserved before a call, settled with the actual count after it
+EXPECTED_COMPLETION_TOKENS = {"final_answer": 400, "segment_grading": 500, "segment_check": 100}
+
+metrics.describe("qa_llm_wait_seconds",
+                 "Time the chat model calls waited for rate limit budget")
+metrics.describe("qa_llm_retries_total", "Retried chat model calls")
+
+
+class TokenBucket:
+    """
+    `per_minute` units refilled continuously, up to `capacity`. The level can go
+    negative when a call used more than it reserved; later calls wait for it.
+    """
+
+    def __init__(self, per_minute: float, capacity: float = None) -> None:
+        self.rate = per_minute / 60
+        self.capacity = capacity if capacity is not None else per_minute
+        self.level = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount: float, now: float) -> float:
+        self._refill(now)
+        return max(amount - self.level, 0) / self.rate
+
+    def take(self, amount: float) -> None:
+        self.level -= amount
+
+    def give_back(self, amount: float) -> None:
+        self.level = min(self.capacity, self.level + amount)
+
+
+class _KeyLimits:
+    # The budget of one API key, which the provider limits per organization
+
+    def __init__(self, requests_per_minute: float, tokens_per_minute: float) -> None:
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+        self.queue = []
+        self.paused_until = 0.0
+
+
+@dataclass(order=True)
+class _Ticket:
+    priority: int
+    seq: int
+    tokens: int = field(compare=False)
+    limits: _KeyLimits = field(compare=False)
+    # Called when the ticket becomes the head of the queue
+    wake: Callable[[], None] = field(compare=False, default=None)
+
+
+def api_key_kwargs(api_key: Optional[str]) -> dict:
+    """
+    The ChatOpenAI arguments that send `api_key` with every call, since ChatOpenAI
+    sets its key globally on the openai module and requests bring their own. None
+    is the key of the environment.
+    """
+    if api_key is None:
+        return {}
+    return {"openai_api_key": api_key, "model_kwargs": {"api_key": api_key}}
+
+
+@functools.lru_cache(maxsize=None)
+def _retryable_errors() -> tuple:
+    try:
+        import openai.error
+    except ImportError:
+        return (), ()
+    return ((openai.error.RateLimitError,),
+            (openai.error.Timeout, openai.error.APIConnectionError, openai.error.ServiceUnavailableError,
+             openai.error.TryAgain))
+
+
+class LLMDispatcher:
+    """
+    Admits, runs and retries the chat calls of all engines of the process. The
+    limits are the ones of the OpenAI organization, e.g. 3,500 requests and 90,000
+    tokens a minute.
+    """
+
+    def __init__(self,
+                 requests_per_minute: float = 3500,
+                 tokens_per_minute: float = 90000,
+                 max_retries: int = 5,
+                 base_delay: float = 1.0,
+                 max_delay: float = 60.0,
+                 request_timeout: float = 60,
+                 max_clients: int = 256) -> None:
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.request_timeout = request_timeout
+        self.max_clients = max_clients
+
+        self._lock = threading.Lock()
+        self._condition = threading.Condition(self._lock)
+        self._clients = OrderedDict()
+        self._limits = {}
+        self._seq = itertools.count()
+
+    def chat_model(self, model_name: str, temperature: float, streaming: bool = False, api_key: str = None):
+        """
+        The shared client of `api_key`, None for the key of the environment. Its
+        callbacks are passed per call.
+        """
+        from langchain.chat_models import ChatOpenAI
+
+        key = (api_key, model_name, temperature, streaming)
+        with self._lock:
+            chat = self._clients.get(key)
+            if chat is not None:
+                self._clients.move_to_end(key)
+                return chat
+
+        # Retries are done here
+        chat = ChatOpenAI(model_name=model_name,
+                          temperature=temperature,
+                          streaming=streaming,
+                          max_retries=0,
+                          request_timeout=self.request_timeout,
+                          **api_key_kwargs(api_key))
+        with self._lock:
+            self._clients[key] = chat
+            while len(self._clients) > self.max_clients:
+                self._clients.popitem(last=False)
+        return chat
+
+    def _key_limits(self, api_key: Optional[str]) -> _KeyLimits:
+        # Under the lock
+        if api_key not in self._limits:
+            self._limits[api_key] = _KeyLimits(
+                self.requests_per_minute, self.tokens_per_minute)
+        return self._limits[api_key]
+
+    def _ticket(self, call: str, tokens: int, api_key: Optional[str]) -> _Ticket:
+        # Under the lock. The ticket keeps the limits of the key it was issued for.
+        return _Ticket(priority=PRIORITIES.get(call, len(PRIORITIES)), seq=next(self._seq),
+                       tokens=min(tokens, self.tokens_per_minute), limits=self._key_limits(api_key))
+
+    @staticmethod
+    def _pop(ticket: _Ticket) -> None:
+        # Under the lock; wakes the next head
+        limits = ticket.limits
+        limits.queue.remove(ticket)
+        heapq.heapify(limits.queue)
+        if limits.queue:
+            limits.queue[0].wake()
+
+    def _admit(self, ticket: _Ticket) -> Optional[float]:
+        """
+        Under the lock: takes the budget of the ticket and returns 0, or returns how
+        long to wait, None if other tickets are ahead.
+        """
+        limits = ticket.limits
+        if limits.queue[0] is not ticket:
+            return None
+        now = time.monotonic()
+        wait = max(limits.paused_until - now,
+                   limits.requests.wait_time(1, now),
+                   limits.tokens.wait_time(ticket.tokens, now))
+        if wait > 0:
+            return wait
+        limits.requests.take(1)
+        limits.tokens.take(ticket.tokens)
+        self._pop(ticket)
+        return 0
+
+    def _acquire(self, call: str, tokens: int, api_key: Optional[str]) -> _Ticket:
+        start = time.perf_counter()
+        with self._condition:
+            ticket = self._ticket(call, tokens, api_key)
+            ticket.wake = self._condition.notify_all
+            heapq.heappush(ticket.limits.queue, ticket)
+            while True:
+                wait = self._admit(ticket)
+                if wait == 0:
+                    break
+                self._condition.wait(wait)
+        metrics.observe("qa_llm_wait_seconds", time.perf_counter() - start, call=call)
+        return ticket
+
+    async def _acquire_async(self, call: str, tokens: int, api_key: Optional[str]) -> _Ticket:
+        start = time.perf_counter()
+        loop = asyncio.get_running_loop()
+        woken = asyncio.Event()
+        with self._lock:
+            ticket = self._ticket(call, tokens, api_key)
+            ticket.wake = functools.partial(loop.call_soon_threadsafe, woken.set)
+            heapq.heappush(ticket.limits.queue, ticket)
+
+        admitted = False
+        try:
+            while not admitted:
+                with self._lock:
+                    woken.clear()
+                    wait = self._admit(ticket)
+                admitted = wait == 0
+                if not admitted:
+                    try:
+                        await asyncio.wait_for(woken.wait(), wait)
+                    except asyncio.TimeoutError:
+                        pass
+        finally:
+            if not admitted:
+                # Cancelled while waiting
+                with self._lock:
+                    self._pop(ticket)
+        metrics.observe("qa_llm_wait_seconds", time.perf_counter() - start, call=call)
+        return ticket
+
+    def _settle(self, ticket: _Ticket, used_tokens: int) -> None:
+        # Returns the reserved but unused tokens, or takes the overrun
+        with self._lock:
+            ticket.limits.tokens.give_back(ticket.tokens - used_tokens)
+
+    def _retry_delay(self, error: Exception, attempt: int, ticket: _Ticket, call: str) -> Optional[float]:
+        """
+        How long to wait before retrying the failed call, None if it is not retried.
+        """
+        rate_limit_errors, transient_errors = _retryable_errors()
+        rate_limited = isinstance(error, rate_limit_errors)
+        if attempt >= self.max_retries or not (rate_limited or isinstance(error, transient_errors)
+                                               or getattr(error, "http_status", None) in (500, 502, 503, 504)):
+            return None
+
+        # Full jitter, so calls that failed together don't retry together
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        retry_after = (getattr(error, "headers", None) or {}).get("retry-after")
+        if retry_after is not None:
+            try:
+                delay = max(delay, float(retry_after))
+            except ValueError:
+                pass
+
+        if rate_limited:
+            # The whole key is over its limit, not just this call
+            with self._lock:
+                ticket.limits.paused_until = max(ticket.limits.paused_until, time.monotonic() + delay)
+        metrics.increment("qa_llm_retries_total", call=call,
+                          reason="rate_limit" if rate_limited else "error")
+        logger.warning(
+            f"{call} call failed ({type(error).__name__}), retry {attempt+1} in {round(delay, 2)}s")
+        return delay
+
+    def run(self, function: Callable[[], str], call: str, model_name: str, prompt_tokens: int,
+            retryable: Callable[[], bool] = None, api_key: str = None) -> str:
+        """
+        Runs the chat call `function` once the rate limits of `api_key` allow,
+        retrying it while `retryable()`, e.g. until a streamed call emitted its
+        first token.
+        """
+        estimate = prompt_tokens + EXPECTED_COMPLETION_TOKENS.get(call, 256)
+        for attempt in itertools.count():
+            ticket = self._acquire(call, estimate, api_key)
+            try:
+                output = function()
+            except Exception as e:
+                # A failed call used no completion tokens
+                self._settle(ticket, prompt_tokens)
+                delay = self._retry_delay(e, attempt, ticket, call) if retryable is None or retryable() else None
+                if delay is None:
+                    raise
+                time.sleep(delay)
+                continue
+            self._settle(ticket, prompt_tokens + count_tokens(output, model_name))
+            return output
+
+    async def run_async(self, function: Callable[[], Awaitable[str]], call: str, model_name: str, prompt_tokens: int,
+                        retryable: Callable[[], bool] = None, api_key: str = None) -> str:
+        """
+        `run` for coroutine functions.
+        """
+        estimate = prompt_tokens + EXPECTED_COMPLETION_TOKENS.get(call, 256)
+        for attempt in itertools.count():
+            ticket = await self._acquire_async(call, estimate, api_key)
+            try:
+                output = await function()
+            except Exception as e:
+                self._settle(ticket, prompt_tokens)
+                delay = self._retry_delay(e, attempt, ticket, call) if retryable is None or retryable() else None
+                if delay is None:
+                    raise
+                await asyncio.sleep(delay)
+                continue
+            self._settle(ticket, prompt_tokens + count_tokens(output, model_name))
+            return output
@@ -0,0 +1,153 @@
+"""
+Picks the found segments worth a relevance check, so obviously unrelated segments
+never reach the chat model. The cut-offs are calibrated on the logged
+recommendations whose relevance was checked:
+
+    python -m app.src.llm.qa.candidate_selector --target-recall 0.95
+"""
+import argparse
+import json
+import math
+import os
+
+from dataclasses import asdict, dataclass
+from loguru import logger
+from pathlib import Path
+from typing import List, Optional, Tuple
+
+from ...constants import CANDIDATE_SELECTOR_PATH
+
+
+@dataclass
+class CandidateSelector:
+    """
+    Walks the found segments in the search order and drops the ones with a cosine
+    similarity below `similarity_floor`; after a drop of more than `cliff_gap`
+    from the previous segment, it stops. The first `min_candidates` segments and
+    the ones without a similarity (found by the lexical search only) are kept.
+
+    A calibrated selector also has the recall of the relevant segments and the
+    share of the non-relevant ones it dropped on the history.
+    """
+    similarity_floor: Optional[float] = None
+    cliff_gap: Optional[float] = None
+    min_candidates: int = 1
+    recall: Optional[float] = None
+    dropped_non_relevant: Optional[float] = None
+    n_questions: Optional[int] = None
+
+    def select(self, indices: dict) -> dict:
+        selected = {}
+        previous = None
+        for resource_id, similarity in indices.items():
+            if similarity is not None and len(selected) >= self.min_candidates:
+                if self.cliff_gap is not None and previous is not None and previous - similarity > self.cliff_gap:
+                    break
+                if self.similarity_floor is not None and similarity < self.similarity_floor:
+                    continue
+            selected[resource_id] = similarity
+            if similarity is not None:
+                previous = similarity
+        return selected
+
+    @classmethod
+    def calibrate(cls,
+                  outcomes: List[List[Tuple[float, Optional[bool]]]],
+                  target_recall: float = 0.95,
+                  min_candidates: int = 1,
+                  min_relevant: int = 30) -> "CandidateSelector":
+        """
+        Chooses the floor and the cliff gap that keep `target_recall` of the
+        relevant segments of past questions, given as the (similarity,
+        is_relevant) of their found segments, most similar first. Each cut-off
+        may lose half of the relevant segments the target allows.
+        """
+        relevant = sorted(similarity for history in outcomes
+                          for similarity, is_relevant in history if is_relevant)
+        if len(relevant) < min_relevant:
+            raise ValueError(
+                f"{len(relevant)} relevant segments in the history, at least {min_relevant} are needed")
+        allowed_misses = (1 - target_recall) / 2
+
+        similarity_floor = relevant[int(len(relevant) * allowed_misses)]
+
+        # A relevant segment is kept if no drop before it is larger than the gap
+        largest_drops = []
+        for history in outcomes:
+            largest_drop = 0.0
+            for position, (similarity, is_relevant) in enumerate(history):
+                if position >= min_candidates:
+                    largest_drop = max(largest_drop, history[position-1][0] - similarity)
+                if is_relevant and similarity >= similarity_floor:
+                    largest_drops.append(largest_drop)
+        largest_drops.sort()
+        cliff_gap = largest_drops[max(math.ceil(len(largest_drops) * (1 - allowed_misses)), 1) - 1]
+
+        selector = cls(similarity_floor=round(similarity_floor, 4),
+                       cliff_gap=round(cliff_gap, 4),
+                       min_candidates=min_candidates)
+
+        n_kept_relevant, n_non_relevant, n_dropped_non_relevant = 0, 0, 0
+        for history in outcomes:
+            kept = selector.select({position: similarity for position, (similarity, _) in enumerate(history)})
+            for position, (_, is_relevant) in enumerate(history):
+                if is_relevant:
+                    n_kept_relevant += position in kept
+                elif is_relevant is not None:
+                    n_non_relevant += 1
+                    n_dropped_non_relevant += position not in kept
+        selector.recall = round(n_kept_relevant / len(relevant), 4)
+        selector.dropped_non_relevant = round(
+            n_dropped_non_relevant / n_non_relevant, 4) if n_non_relevant else None
+        selector.n_questions = len(outcomes)
+        return selector
+
+    def save(self, path: Path = CANDIDATE_SELECTOR_PATH) -> None:
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(path, "w") as f:
+            json.dump(asdict(self), f, indent=1)
+
+
+def load_candidate_selector(path: Path = CANDIDATE_SELECTOR_PATH) -> Optional[CandidateSelector]:
+    """
+    The calibrated selector, or None before calibration.
+    """
+    if not Path(path).exists():
+        return None
+    with open(path) as f:
+        return CandidateSelector(**json.load(f))
+
+
+def main():
+    from dotenv import load_dotenv
+    from sqlalchemy import create_engine
+    from sqlalchemy.orm import Session
+
+    from ...db.util import get_relevance_outcomes
+
+    parser = argparse.ArgumentParser(
+        description="Calibrates the similarity cut-offs of the segments checked for relevance.")
+    parser.add_argument('--target-recall', type=float, default=0.95,
+                        help='Share of the relevant segments of past questions to keep. Default: 0.95.')
+    parser.add_argument('--min-candidates', type=int, default=1,
+                        help='Number of top segments that are always checked. Default: 1.')
+    parser.add_argument('--max-questions', type=int, default=5000,
+                        help='Number of latest checked questions to calibrate on. Default: 5000.')
+    parser.add_argument('--path', type=Path, default=CANDIDATE_SELECTOR_PATH,
+                        help='File the calibration is saved to, read by the API.')
+    args = parser.parse_args()
+
+    load_dotenv()
+    DB_CONNECTION = f"postgresql://postgres:{os.environ['POSTGRES_DB_PASS']}@{os.environ['POSTGRES_DB_HOST']}:5432/postgres"
+    with Session(create_engine(DB_CONNECTION)) as session:
+        outcomes = get_relevance_outcomes(session, args.max_questions)
+
+    selector = CandidateSelector.calibrate(outcomes, target_recall=args.target_recall,
+                                           min_candidates=args.min_candidates)
+    selector.save(args.path)
+    logger.info(f"Saved {selector} to {args.path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,36 @@
+import time
+
+from loguru import logger
+from pathlib import Path
+
+from ...constants import ENCODER_PATH, ENCODER_SNAPSHOT_PATH
+
+
+def save_encoder_snapshot(encoder, path: Path = ENCODER_SNAPSHOT_PATH) -> None:
+    """
+    Pickles the whole loaded encoder module tree, so a cold start unpickles it
+    instead of reading the model directory config and assembling the modules.
+    """
+    import torch
+
+    encoder.eval()
+    torch.save(encoder, path)
+
+
+def load_encoder_snapshot(path: Path = ENCODER_SNAPSHOT_PATH):
+    import torch
+
+    start_time = time.time()
+    encoder = torch.load(path, map_location="cpu", weights_only=False)
+    encoder.eval()
+    logger.info(
+        f"Encoder snapshot load time: {round(time.time()-start_time, 2)}")
+    return encoder
+
+
+if __name__ == "__main__":
+    # Baked into the image at build time, see the Dockerfile
+    from sentence_transformers import SentenceTransformer
+
+    save_encoder_snapshot(SentenceTransformer(str(ENCODER_PATH)))
+    logger.info(f"Saved encoder snapshot to {ENCODER_SNAPSHOT_PATH}")
@@ -0,0 +1,121 @@
+import threading
+import time
+import vecs
+
+from typing import Callable, Optional
+
+from loguru import logger
+from sqlalchemy.orm import Session
+
+from ..cache import LLMCache
+from ...db.cache import ResourceCache
+from ...constants import TOPICS
+from ...store.bm25_index import BM25Index
+from ...store.topic_partitions import load_topic_collections
+from .micro_batcher import EmbeddingMicroBatcher
+from .postgres_qa_engine import PostgresQAEngine, EmbeddingModel, load_embedding_model
+
+
+class EngineRegistry:
+    """
+    Keeps the expensive parts of the QA engine (the question encoder, the vecs
+    client and the docs collection) alive for the whole process, e.g. a Lambda
+    container, and hands out cheap per-request engines bound to a SQL session.
+    """
+
+    def __init__(self,
+                 db_connection: str,
+                 vecs_collection_name: str = "docs",
+                 embedding_model: EmbeddingModel = EmbeddingModel.SBERT,
+                 resource_cache_size: int = 10000,
+                 llm_cache: LLMCache = None,
+                 semantic_cache=None,
+                 lexical_index_factory: Callable[[], BM25Index] = None,
+                 partition_by_topic: bool = True,
+                 micro_batch_size: int = 32,
+                 micro_batch_wait_ms: float = None,
+                 **engine_kwargs) -> None:
+        self.db_connection = db_connection
+        self.vecs_collection_name = vecs_collection_name
+        self.embedding_model = embedding_model
+        self.engine_kwargs = engine_kwargs
+        # Resources are static, so their rows are shared across requests as well
+        self.resource_cache = ResourceCache(
+            max_size=resource_cache_size) if resource_cache_size else None
+        self.llm_cache = llm_cache
+        self.semantic_cache = semantic_cache
+        self.lexical_index_factory = lexical_index_factory
+        self.partition_by_topic = partition_by_topic
+        # Concurrent single-question requests are encoded together, unless None
+        self.micro_batch_size = micro_batch_size
+        self.micro_batch_wait_ms = micro_batch_wait_ms
+
+        self._lock = threading.Lock()
+        self._encoder = None
+        self._vx = None
+        self._docs = None
+        self._lexical_index = None
+        self._topic_collections = {}
+        self._micro_batcher = None
+
+    @property
+    def is_warm(self) -> bool:
+        return self._docs is not None
+
+    def warm_up(self) -> None:
+        if self.is_warm:
+            return
+
+        with self._lock:
+            if self.is_warm:
+                return
+
+            start_time = time.time()
+            encoder = load_embedding_model(self.embedding_model)
+            # The first encode initializes the tokenizer and the kernels
+            encoder.encode("warm up")
+
+            # create vector store client
+            vx = vecs.create_client(self.db_connection)
+            docs = vx.get_or_create_collection(
+                name=self.vecs_collection_name,
+                dimension=encoder.get_sentence_embedding_dimension())
+
+            if self.partition_by_topic:
+                self._topic_collections = load_topic_collections(
+                    vx, self.vecs_collection_name, TOPICS)
+
+            if self.micro_batch_wait_ms is not None:
+                self._micro_batcher = EmbeddingMicroBatcher(
+                    encoder, max_batch_size=self.micro_batch_size, max_wait_ms=self.micro_batch_wait_ms)
+
+            self._encoder, self._vx, self._docs = encoder, vx, docs
+            logger.info(
+                f"QA engine warm-up time: {round(time.time()-start_time, 2)}")
+
+    def get_lexical_index(self) -> Optional[BM25Index]:
+        """
+        Builds the lexical index on the first hybrid search, so containers that
+        only serve vector searches never load it.
+        """
+        if self._lexical_index is None and self.lexical_index_factory is not None:
+            with self._lock:
+                if self._lexical_index is None:
+                    self._lexical_index = self.lexical_index_factory()
+        return self._lexical_index
+
+    def get_engine(self, session: Session, **kwargs) -> PostgresQAEngine:
+        self.warm_up()
+        return PostgresQAEngine(embedding_model=self.embedding_model,
+                                sql_session=session,
+                                vecs_client=self._vx,
+                                vecs_collection_name=self.vecs_collection_name,
+                                encoder=self._encoder,
+                                docs_collection=self._docs,
+                                resource_cache=self.resource_cache,
+                                llm_cache=self.llm_cache,
+                                semantic_cache=self.semantic_cache,
+                                lexical_index_factory=self.get_lexical_index,
+                                topic_collections=self._topic_collections,
+                                micro_batcher=self._micro_batcher,
+                                **{**self.engine_kwargs, **kwargs})
@@ -0,0 +1,91 @@
+import joblib
+import numpy as np
+
+from loguru import logger
+from pathlib import Path
+
+from .postgres_qa_engine import PostgresQAEngine, EmbeddingModel
+from ...constants import DF_SUMMARY_PATH, LOCAL_INDEX_DIR, RESOURCES_PARQUET, SBERT_SUMMARY_EMBEDDINGS
+from ...db.activity_log import NullActivityLogger
+from ...store.bm25_index import BM25Index
+from ...store.local_vector_store import LocalVectorStore
+from ...store.resource_store import LocalResourceStore
+
+
+def build_local_index(encoder,
+                      df_summary_path: Path = DF_SUMMARY_PATH,
+                      index_dir: Path = LOCAL_INDEX_DIR,
+                      resources_path: Path = RESOURCES_PARQUET,
+                      embeddings_path: Path = SBERT_SUMMARY_EMBEDDINGS,
+                      dtype: str = "float32",
+                      quantization: str = None):
+    """
+    Builds the local vector store and resource store from the summary CSV. The
+    precomputed summary embeddings are reused when they exist, otherwise the
+    summaries are encoded with `encoder`. With `quantization` ("float16", "int8" or
+    "pq"), a compact copy of the embeddings is stored for the first search stage.
+    """
+    resource_store = LocalResourceStore.from_summary_csv(df_summary_path)
+    resource_store.save(resources_path)
+    df_resources = resource_store.df_resources
+
+    if Path(embeddings_path).exists():
+        logger.info(f"Loading summary embeddings from {embeddings_path}")
+        embeddings = np.asarray(joblib.load(embeddings_path), dtype=np.float32)
+    else:
+        logger.info(f"Encoding {len(df_resources)} summaries")
+        embeddings = encoder.encode(
+            df_resources["summary"].tolist(), batch_size=64, show_progress_bar=True)
+
+    metadata = [{"topic": topic, "episode_name": episode_name}
+                for topic, episode_name in zip(df_resources["topic"], df_resources["episode_name"])]
+    vector_store = LocalVectorStore.build(index_dir,
+                                          ids=df_resources["id"].tolist(),
+                                          embeddings=embeddings,
+                                          metadata=metadata,
+                                          dtype=dtype,
+                                          quantization=quantization)
+    return vector_store, resource_store
+
+
+class LocalQAEngine(PostgresQAEngine):
+    """
+    The QA engine without any services: the same flows as PostgresQAEngine, but the
+    segments are searched in a memory-mapped LocalVectorStore and loaded from a
+    Parquet LocalResourceStore. Nothing is logged unless an activity logger is
+    given.
+    """
+
+    def __init__(self,
+                 embedding_model: EmbeddingModel,
+                 index_dir: Path = LOCAL_INDEX_DIR,
+                 resources_path: Path = RESOURCES_PARQUET,
+                 use_faiss: bool = False,
+                 vector_store: LocalVectorStore = None,
+                 resource_store: LocalResourceStore = None,
+                 lexical_index: BM25Index = None,
+                 df_summary_path: Path = DF_SUMMARY_PATH,
+                 activity_logger=None,
+                 **kwargs) -> None:
+        if vector_store is None:
+            vector_store = LocalVectorStore.load(
+                index_dir, use_faiss=use_faiss)
+        if resource_store is None:
+            resource_store = LocalResourceStore.load(resources_path)
+        if lexical_index is None and "lexical_index_factory" not in kwargs:
+            # Only built once a request uses the hybrid search
+            kwargs["lexical_index_factory"] = lambda: BM25Index.from_summary_csv(
+                df_summary_path)
+
+        super().__init__(embedding_model=embedding_model,
+                         sql_session=None,
+                         vecs_client=None,
+                         vecs_collection_name=None,
+                         docs_collection=vector_store,
+                         lexical_index=lexical_index,
+                         activity_logger=activity_logger if activity_logger is not None else NullActivityLogger(),
+                         **kwargs)
+        self.resource_store = resource_store
+
+    def _get_resources(self, resource_ids) -> list:
+        return self.resource_store.get_resources(resource_ids)
@@ -0,0 +1,64 @@
+import queue
+import threading
+import time
+
+from concurrent.futures import Future
+from loguru import logger
+from typing import List
+
+
+class EmbeddingMicroBatcher:
+    """
+    Coalesces concurrent single-question `encode` calls into one batched forward
+    pass of the encoder. A batch is encoded once `max_batch_size` questions are
+    waiting or `max_wait_ms` milliseconds after its first question arrived.
+    """
+
+    def __init__(self, encoder, max_batch_size: int = 32, max_wait_ms: float = 5) -> None:
+        self.encoder = encoder
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+
+        self._queue = queue.Queue()
+        self._worker = threading.Thread(
+            target=self._run, name="embedding-micro-batcher", daemon=True)
+        self._worker.start()
+
+    def get_sentence_embedding_dimension(self) -> int:
+        return self.encoder.get_sentence_embedding_dimension()
+
+    def encode(self, question: str) -> list:
+        future = Future()
+        self._queue.put((question, future))
+        return future.result()
+
+    def encode_many(self, questions: List[str]) -> List[list]:
+        # An explicit batch is already a batch
+        return self.encoder.encode(questions).tolist()
+
+    def _next_batch(self) -> list:
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self) -> None:
+        while True:
+            batch = self._next_batch()
+            try:
+                embeddings = self.encoder.encode(
+                    [question for question, _ in batch]).tolist()
+                for (_, future), embedding in zip(batch, embeddings):
+                    future.set_result(embedding)
+            except Exception as e:
+                logger.exception(
+                    f"Encoding a batch of {len(batch)} questions failed")
+                for _, future in batch:
+                    future.set_exception(e)
@@ -0,0 +1,115 @@
+import argparse
+import time
+import numpy as np
+
+from loguru import logger
+from pathlib import Path
+from typing import List, Union
+
+from ...constants import ENCODER_PATH, ENCODER_ONNX_PATH, ENCODER_ONNX_INT8_PATH
+
+
+class OnnxSentenceEncoder:
+    """
+    all-MiniLM-L6-v2 on ONNX Runtime, without torch: the transformer is an ONNX
+    export (optionally int8 quantized), tokenized with the model's fast tokenizer,
+    then mean pooled and L2 normalized like the SentenceTransformer modules.
+    `encode` has the SentenceTransformer signature used by the QA engine.
+    """
+
+    def __init__(self, model_path: Path, tokenizer_dir: Path = ENCODER_PATH, max_length: int = 256, n_threads: int = None) -> None:
+        import onnxruntime
+        from tokenizers import Tokenizer
+
+        start_time = time.time()
+        options = onnxruntime.SessionOptions()
+        if n_threads is not None:
+            options.intra_op_num_threads = n_threads
+        self.session = onnxruntime.InferenceSession(
+            str(model_path), options, providers=["CPUExecutionProvider"])
+        self.input_names = {model_input.name for model_input in self.session.get_inputs()}
+
+        self.tokenizer = Tokenizer.from_file(
+            str(Path(tokenizer_dir) / "tokenizer.json"))
+        self.tokenizer.enable_truncation(max_length=max_length)
+        self.tokenizer.enable_padding()
+
+        self.dimension = self.session.get_outputs()[0].shape[-1]
+        logger.info(
+            f"ONNX encoder load time: {round(time.time()-start_time, 2)}")
+
+    def get_sentence_embedding_dimension(self) -> int:
+        return self.dimension
+
+    def _encode_batch(self, sentences: List[str]) -> np.ndarray:
+        encodings = self.tokenizer.encode_batch(sentences)
+        inputs = {"input_ids": np.array([encoding.ids for encoding in encodings], dtype=np.int64),
+                  "attention_mask": np.array([encoding.attention_mask for encoding in encodings], dtype=np.int64),
+                  "token_type_ids": np.array([encoding.type_ids for encoding in encodings], dtype=np.int64)}
+        token_embeddings = self.session.run(
+            None, {name: value for name, value in inputs.items() if name in self.input_names})[0]
+
+        # Mean pooling over the non-padding tokens, then L2 normalization
+        mask = inputs["attention_mask"][:, :, None].astype(np.float32)
+        embeddings = (token_embeddings * mask).sum(axis=1) / \
+            np.clip(mask.sum(axis=1), 1e-9, None)
+        return embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)
+
+    def encode(self, sentences: Union[str, List[str]], batch_size: int = 32, **kwargs) -> np.ndarray:
+        if isinstance(sentences, str):
+            return self._encode_batch([sentences])[0]
+
+        if not sentences:
+            return np.empty((0, self.dimension), dtype=np.float32)
+        return np.concatenate([self._encode_batch(sentences[start:start+batch_size])
+                               for start in range(0, len(sentences), batch_size)])
+
+
+def export_onnx(model_dir: Path = ENCODER_PATH,
+                output_path: Path = ENCODER_ONNX_PATH,
+                quantized_path: Path = ENCODER_ONNX_INT8_PATH,
+                quantize: bool = True) -> None:
+    """
+    Exports the transformer of the SentenceTransformer to ONNX and, with
+    `quantize`, writes a copy with dynamically quantized int8 weights. Needs torch
+    and transformers, so it runs at build time, not in the Lambda image.
+    """
+    import torch
+    from transformers import AutoModel, AutoTokenizer
+
+    tokenizer = AutoTokenizer.from_pretrained(model_dir)
+    model = AutoModel.from_pretrained(model_dir)
+    model.eval()
+
+    sample = tokenizer(["An example question"], return_tensors="pt")
+    input_names = ["input_ids", "attention_mask", "token_type_ids"]
+    dynamic_axes = {name: {0: "batch", 1: "sequence"} for name in input_names}
+    dynamic_axes["token_embeddings"] = {0: "batch", 1: "sequence"}
+
+    Path(output_path).parent.mkdir(parents=True, exist_ok=True)
+    with torch.no_grad():
+        torch.onnx.export(model,
+                          tuple(sample[name] for name in input_names),
+                          str(output_path),
+                          input_names=input_names,
+                          output_names=["token_embeddings"],
+                          dynamic_axes=dynamic_axes,
+                          opset_version=14)
+    logger.info(f"Exported ONNX encoder to {output_path}")
+
+    if quantize:
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+
+        quantize_dynamic(str(output_path), str(quantized_path),
+                         weight_type=QuantType.QInt8)
+        logger.info(f"Saved int8 ONNX encoder to {quantized_path}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Exports the question encoder to ONNX")
+    parser.add_argument("--no-quantize", action="store_true",
+                        help="Skip the int8 quantized copy")
+    args = parser.parse_args()
+
+    export_onnx(quantize=not args.no_quantize)
@@ -1,35 +1,61 @@
-import datetime
+import asyncio
+import copy
+import functools
+import hashlib
 import json
-import markdown
+import queue
+import threading
 import time
-import vecs
 import numpy as np
-import pandas as pd
+import vecs
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
 
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from dataclasses import dataclass, field
 from enum import Enum
 from loguru import logger
 from pathlib import Path
+from typing import AsyncIterator, Callable, Iterator, List, Optional, Tuple
 
-from langchain import LLMChain
-from langchain.chat_models import ChatOpenAI
-from langchain.embeddings import OpenAIEmbeddings
-from langchain.prompts.chat import (
-    ChatPromptTemplate,
-    SystemMessagePromptTemplate,
-    HumanMessagePromptTemplate,
-)
-
-from sentence_transformers import SentenceTransformer
-
+from .candidate_selector import CandidateSelector
+from .semantic_cache import CachedAnswer
+from .single_flight import SingleFlight, normalize_question
+from ...store.bm25_index import BM25Index, fuse_rankings
+from ...store.diversity import maximal_marginal_relevance
+from ...store.topic_partitions import build_filters
+from ...store.pgvector_search import DEFAULT_SEARCH_SETTINGS, SET_SEARCH_SETTING_SQL, batch_search_sql, fetch_vectors_sql, format_vector, parse_vector, rows_to_indices, search_settings_params
 from .prompts.segment_template import SEGMENT_SYSTEM_TEMPLATE, SEGMENT_HUMAN_TEMPLATE
 from .prompts.final_answer_template import FINAL_ANSWER_SYSTEM_TEMPLATE, FINAL_ANSWER_HUMAN_TEMPLATE
-from ...db.models import (
-    QuestionsHubermanLab,
-    AnswersHubermanLab,
-    ResourcesHubermanLab,
-    RecommendedResourcesHubermanLab
-)
+from .prompts.grading_template import GRADING_SYSTEM_TEMPLATE, GRADING_HUMAN_TEMPLATE, format_contexts, parse_grades
+from ..cache import LLMCache, llm_cache_key
+from ..dispatcher import LLMDispatcher, api_key_kwargs
+from ..tokens import context_window, count_tokens
+from ...tracing import in_context, metrics, record_llm_call, span
+from ...db.activity_log import ActivityLogger, QuestionLogRecord
+from ...db.cache import ResourceCache
+from ...db.util import get_resources, get_resources_async
+from ...db.models import ResourcesHubermanLab
+from ...constants import ENCODER_PATH, ENCODER_SNAPSHOT_PATH, ENCODER_ONNX_PATH, ENCODER_ONNX_INT8_PATH
+from .encoder_snapshot import load_encoder_snapshot
+from .onnx_encoder import OnnxSentenceEncoder
+
+# langchain, sentence_transformers and markdown are imported on first use, so the
+# resource routes start without them (see benchmarks/cold_start.py)
+
+# Names of the chat calls in the traces and metrics
+LLM_CALLS = {SEGMENT_SYSTEM_TEMPLATE: "segment_check",
+             GRADING_SYSTEM_TEMPLATE: "segment_grading",
+             FINAL_ANSWER_SYSTEM_TEMPLATE: "final_answer"}
+
+# Graded segments with at least this score (of 10) are relevant
+RELEVANCE_THRESHOLD = 5
+# Room left in the context window of a grading call for its reply: the scores of
+# the batch and the answers of up to `n_relevant_segments` segments
+GRADING_REPLY_TOKENS = 1200
+
+metrics.describe("qa_candidates_dropped_total",
+                 "Found segments dropped before the relevance checks")
 
 css = """
 <style>
@@ -87,11 +113,116 @@ a:hover {
 """
 
 
+@functools.lru_cache(maxsize=None)
+def _invalid_request_errors() -> tuple:
+    # e.g. a prompt over the context window of the model
+    try:
+        import openai.error
+    except ImportError:
+        return ()
+    return (openai.error.InvalidRequestError,)
+
+
+@functools.lru_cache(maxsize=None)
+def _token_callback_handler_class():
+    from langchain.callbacks.base import BaseCallbackHandler
+
+    class TokenCallbackHandler(BaseCallbackHandler):
+        def __init__(self, on_token: Callable[[str], None]) -> None:
+            self.on_token = on_token
+
+        def on_llm_new_token(self, token: str, **kwargs) -> None:
+            self.on_token(token)
+
+    return TokenCallbackHandler
+
+
+class _ChainWithCallbacks:
+    # A chain with per-call callbacks, for chat models shared by concurrent calls
+
+    def __init__(self, chain, callbacks: list) -> None:
+        self.chain = chain
+        self.callbacks = callbacks
+
+    def run(self, **inputs) -> str:
+        return self.chain.run(callbacks=self.callbacks, **inputs)
+
+    async def arun(self, **inputs) -> str:
+        return await self.chain.arun(callbacks=self.callbacks, **inputs)
+
+
 class EmbeddingModel(Enum):
     SBERT = "sbert"
+    # The same model on ONNX Runtime, with float32 or int8 quantized weights
+    SBERT_ONNX = "sbert_onnx"
+    SBERT_ONNX_INT8 = "sbert_onnx_int8"
     OPENAI = "openai"
 
 
+def load_embedding_model(embedding_model: EmbeddingModel):
+    if embedding_model.value == EmbeddingModel.SBERT.value:
+        # The pre-baked snapshot skips parsing and assembling the model directory
+        if ENCODER_SNAPSHOT_PATH.exists():
+            return load_encoder_snapshot(ENCODER_SNAPSHOT_PATH)
+
+        from sentence_transformers import SentenceTransformer
+        return SentenceTransformer(str(ENCODER_PATH))
+    elif embedding_model.value == EmbeddingModel.SBERT_ONNX.value:
+        return OnnxSentenceEncoder(ENCODER_ONNX_PATH)
+    elif embedding_model.value == EmbeddingModel.SBERT_ONNX_INT8.value:
+        return OnnxSentenceEncoder(ENCODER_ONNX_INT8_PATH)
+    else:
+        raise NotImplementedError
+
+
+class SearchMode(Enum):
+    VECTOR = "vector"
+    HYBRID = "hybrid"
+
+
+class GradingMode(Enum):
+    # One chat call per found segment, in similarity order
+    SEQUENTIAL = "sequential"
+    # One chat call scoring `n_graded` segments at once, answering the best ones
+    BATCHED = "batched"
+
+
+@dataclass(frozen=True)
+class RequestOptions:
+    """
+    What a request chooses about its answer. The options are passed along the
+    calls of the request, so one engine serves requests with different options.
+    """
+    search_mode: SearchMode = SearchMode.VECTOR
+    # How the relevance of the found segments is checked
+    grading_mode: GradingMode = GradingMode.SEQUENTIAL
+    # Restricts the search to the segments of a topic and/or an episode
+    topic: Optional[str] = None
+    episode_name: Optional[str] = None
+    # The OpenAI API key of the chat calls. None falls back to the OPENAI_API_KEY
+    # environment variable.
+    openai_api_key: Optional[str] = field(default=None, repr=False)
+
+    def __post_init__(self) -> None:
+        # The modes can be given by value, e.g. "hybrid"
+        object.__setattr__(self, "search_mode", SearchMode(self.search_mode))
+        object.__setattr__(self, "grading_mode",
+                           GradingMode(self.grading_mode))
+
+
+DEFAULT_OPTIONS = RequestOptions()
+
+
+@dataclass
+class AnswerResult:
+    answer: str
+    relevant_segments: dict
+    n_relevant: int
+    n_non_relevant: int
+    recommended_resources: dict = field(default_factory=dict)
+    from_cache: bool = False
+
+
 class PostgresQAEngine:
     def __init__(self,
                  embedding_model: EmbeddingModel,
@@ -99,51 +230,261 @@ class PostgresQAEngine:
                  vecs_client: vecs.Client,
                  vecs_collection_name: str,
                  n_search: int = 20,
+                 n_resources: int = 7,
                  n_relevant_segments: int = 3,
                  llm_model: str = 'gpt-3.5-turbo',
-                 temperature: float = 0) -> None:
-
-        if embedding_model.value == EmbeddingModel.SBERT.value:
-            self.embedding_model = SentenceTransformer(
-                'app/models/all-MiniLM-L6-v2')
-            self.embedding_ndim = self.embedding_model.get_sentence_embedding_dimension()
+                 temperature: float = 0,
+                 n_concurrent_checks: int = 1,
+                 resource_cache: ResourceCache = None,
+                 activity_logger=None,
+                 llm_cache: LLMCache = None,
+                 semantic_cache=None,
+                 lexical_index: BM25Index = None,
+                 lexical_index_factory: Callable[[], BM25Index] = None,
+                 fusion_method: str = "rrf",
+                 topic_collections: dict = None,
+                 encoder=None,
+                 docs_collection: vecs.Collection = None,
+                 micro_batcher=None,
+                 async_sql_session: AsyncSession = None,
+                 search_settings: dict = None,
+                 single_flight: SingleFlight = None,
+                 llm_dispatcher: LLMDispatcher = None,
+                 n_graded: int = 10,
+                 candidate_selector: CandidateSelector = None,
+                 mmr_lambda: float = None,
+                 duplicate_similarity: float = 0.95) -> None:
+        """
+        The engine holds the configuration shared by all requests; what a request
+        chooses (search and grading mode, filters, API key) is passed to the calls
+        as RequestOptions.
+        """
+        # A preloaded encoder and collection (see EngineRegistry) make the engine
+        # cheap to construct per request
+        if encoder is not None:
+            self.embedding_model = encoder
         else:
-            raise NotImplementedError
+            self.embedding_model = load_embedding_model(embedding_model)
+        self.embedding_ndim = self.embedding_model.get_sentence_embedding_dimension()
+        # Coalesces the single questions of concurrent requests into batched encodes
+        self.micro_batcher = micro_batcher
 
         self.session = sql_session
+        # The async request path queries the database through this session
+        self.async_session = async_sql_session
         self.vx = vecs_client
-        self.docs = self.vx.get_or_create_collection(
-            name=vecs_collection_name, dimension=self.embedding_ndim)
+        if docs_collection is not None:
+            self.docs = docs_collection
+        else:
+            self.docs = self.vx.get_or_create_collection(
+                name=vecs_collection_name, dimension=self.embedding_ndim)
 
+        # Segments searched for an answer and recommended as resources
         self.n_search = n_search
+        self.n_resources = n_resources
         self.n_relevant_segments = n_relevant_segments
         self.llm_model = llm_model
         self.temperature = temperature
+        self.n_concurrent_checks = n_concurrent_checks
+        self.resource_cache = resource_cache
+        # Question, recommendation and answer rows are written through the activity
+        # logger, which can be a shared write-behind queue
+        self.activity_logger = activity_logger if activity_logger is not None else ActivityLogger(
+            sql_session)
+        self.llm_cache = llm_cache
+        self.semantic_cache = semantic_cache
+        self.lexical_index = lexical_index
+        # Builds the lexical index on the first hybrid search when none is given
+        self.lexical_index_factory = lexical_index_factory
+        self.fusion_method = fusion_method
+        # Per-topic collections, so a topic filtered search scans only that topic
+        self.topic_collections = topic_collections or {}
+        # ANN index settings of the vector queries, e.g. {"hnsw.ef_search": 64}
+        self.search_settings = search_settings or {}
+        # Concurrent identical questions share one computation, if shared across
+        # engines (see EngineRegistry)
+        self.single_flight = single_flight
+        # Rate limited, prioritized and retried chat calls on shared clients, if
+        # shared across engines
+        self.llm_dispatcher = llm_dispatcher
+        # Segments scored by one call of the batched grading
+        self.n_graded = n_graded
+        # Drops the found segments too dissimilar to be worth a relevance check
+        self.candidate_selector = candidate_selector
+        # With `mmr_lambda`, the candidates are re-ranked by maximal marginal
+        # relevance (1 is the similarity order) and near-duplicates are dropped
+        self.mmr_lambda = mmr_lambda
+        self.duplicate_similarity = duplicate_similarity
+
+    def _llm_cache_key(self, system_template: str, human_template: str, **inputs) -> str:
+        # Only deterministic calls are answered from the cache
+        if self.llm_cache is None or self.temperature != 0:
+            return None
+        return llm_cache_key(model=self.llm_model,
+                             temperature=self.temperature,
+                             system_template=system_template,
+                             human_template=human_template,
+                             **inputs)
+
+    def _build_chain(self, system_template: str, human_template: str, on_token: Callable[[str], None] = None, api_key: str = None):
+        from langchain import LLMChain
+        from langchain.chat_models import ChatOpenAI
+        from langchain.prompts.chat import (
+            ChatPromptTemplate,
+            SystemMessagePromptTemplate,
+            HumanMessagePromptTemplate,
+        )
 
-    def segment_check_and_answer(self, question: str, context: str) -> str:
-        chat = ChatOpenAI(temperature=self.temperature,
-                          model_name=self.llm_model)
+        callbacks = None
+        if self.llm_dispatcher is not None:
+            chat = self.llm_dispatcher.chat_model(
+                self.llm_model, self.temperature, streaming=on_token is not None, api_key=api_key)
+            if on_token is not None:
+                callbacks = [_token_callback_handler_class()(on_token)]
+        elif on_token is not None:
+            # Tokens are passed to `on_token` as the chat model generates them
+            chat = ChatOpenAI(temperature=self.temperature,
+                              model_name=self.llm_model,
+                              streaming=True,
+                              callbacks=[_token_callback_handler_class()(on_token)],
+                              **api_key_kwargs(api_key))
+        else:
+            chat = ChatOpenAI(temperature=self.temperature,
+                              model_name=self.llm_model,
+                              **api_key_kwargs(api_key))
 
         system_message_prompt = SystemMessagePromptTemplate.from_template(
-            SEGMENT_SYSTEM_TEMPLATE)
+            system_template)
         human_message_prompt = HumanMessagePromptTemplate.from_template(
-            SEGMENT_HUMAN_TEMPLATE)
+            human_template)
         chat_prompt = ChatPromptTemplate.from_messages(
             [system_message_prompt, human_message_prompt])
 
         chain = LLMChain(llm=chat, prompt=chat_prompt)
-        output = chain.run(question=question, context=context)
+        return _ChainWithCallbacks(chain, callbacks) if callbacks is not None else chain
+
+    def _prompt_tokens(self, system_template: str, human_template: str, inputs: dict) -> int:
+        return count_tokens(system_template + human_template.format(**inputs), self.llm_model)
+
+    def _record_llm_call(self, system_template: str, human_template: str, inputs: dict, output: str, cached: bool = False) -> None:
+        call = LLM_CALLS.get(system_template, "chat")
+        if cached:
+            record_llm_call(call, self.llm_model, cached=True)
+            return
+        # Streamed completions report no usage, so the tokens are counted here
+        record_llm_call(call, self.llm_model,
+                        prompt_tokens=self._prompt_tokens(
+                            system_template, human_template, inputs),
+                        completion_tokens=count_tokens(output, self.llm_model))
+
+    def _dispatched_chain(self, system_template: str, human_template: str, on_token: Callable[[str], None] = None, api_key: str = None):
+        """
+        The chain of a dispatched call and whether the call can be retried, i.e. it
+        didn't stream a token yet.
+        """
+        streamed = []
+
+        def on_streamed_token(token):
+            streamed.append(token)
+            on_token(token)
 
-        return output
+        chain = self._build_chain(system_template, human_template,
+                                  on_streamed_token if on_token is not None else None, api_key)
+        return chain, lambda: not streamed
+
+    def _run_chat(self, system_template: str, human_template: str, on_token: Callable[[str], None] = None, api_key: str = None, **inputs) -> str:
+        with span(f"llm.{LLM_CALLS.get(system_template, 'chat')}", model=self.llm_model):
+            cache_key = self._llm_cache_key(
+                system_template, human_template, **inputs)
+            if cache_key is not None:
+                output = self.llm_cache.get(cache_key)
+                if output is not None:
+                    self._record_llm_call(
+                        system_template, human_template, inputs, output, cached=True)
+                    if on_token is not None:
+                        on_token(output)
+                    return output
+
+            if self.llm_dispatcher is None:
+                chain = self._build_chain(
+                    system_template, human_template, on_token, api_key)
+                output = chain.run(**inputs)
+            else:
+                chain, retryable = self._dispatched_chain(
+                    system_template, human_template, on_token, api_key)
+                output = self.llm_dispatcher.run(lambda: chain.run(**inputs), LLM_CALLS.get(system_template, "chat"), self.llm_model,
+                                                 self._prompt_tokens(system_template, human_template, inputs), retryable,
+                                                 api_key=api_key)
+            self._record_llm_call(system_template, human_template, inputs, output)
+
+            if cache_key is not None:
+                self.llm_cache.set(cache_key, output)
+            return output
+
+    async def _run_chat_async(self, system_template: str, human_template: str, on_token: Callable[[str], None] = None, api_key: str = None, **inputs) -> str:
+        with span(f"llm.{LLM_CALLS.get(system_template, 'chat')}", model=self.llm_model):
+            cache_key = self._llm_cache_key(
+                system_template, human_template, **inputs)
+            if cache_key is not None:
+                # The cache can be a SQL table, so it is read off the event loop
+                output = await asyncio.to_thread(self.llm_cache.get, cache_key)
+                if output is not None:
+                    self._record_llm_call(
+                        system_template, human_template, inputs, output, cached=True)
+                    if on_token is not None:
+                        on_token(output)
+                    return output
+
+            if self.llm_dispatcher is None:
+                chain = self._build_chain(
+                    system_template, human_template, on_token, api_key)
+                output = await chain.arun(**inputs)
+            else:
+                chain, retryable = self._dispatched_chain(
+                    system_template, human_template, on_token, api_key)
+                output = await self.llm_dispatcher.run_async(lambda: chain.arun(**inputs), LLM_CALLS.get(system_template, "chat"), self.llm_model,
+                                                             self._prompt_tokens(system_template, human_template, inputs), retryable,
+                                                             api_key=api_key)
+            self._record_llm_call(system_template, human_template, inputs, output)
+
+            if cache_key is not None:
+                await asyncio.to_thread(self.llm_cache.set, cache_key, output)
+            return output
+
+    def segment_check_and_answer(self, question: str, context: str, api_key: str = None) -> str:
+        return self._run_chat(SEGMENT_SYSTEM_TEMPLATE, SEGMENT_HUMAN_TEMPLATE, api_key=api_key,
+                              question=question, context=context)
+
+    def grade_segments(self, question: str, contexts: List[str], api_key: str = None) -> str:
+        return self._run_chat(GRADING_SYSTEM_TEMPLATE, GRADING_HUMAN_TEMPLATE, api_key=api_key,
+                              question=question, contexts=format_contexts(contexts), n_relevant=self.n_relevant_segments)
 
     def embed_question(self, question) -> list:
-        if isinstance(self.embedding_model, SentenceTransformer):
-            return self.embedding_model.encode(question).tolist()
+        with span("embed", n=1):
+            if self.micro_batcher is not None:
+                # Batched with the questions of concurrent requests
+                return self.micro_batcher.encode(question)
+
+            # SentenceTransformer-like encoders, without importing sentence_transformers
+            if hasattr(self.embedding_model, "encode"):
+                return self.embedding_model.encode(question).tolist()
+
+            # OpenAIEmbeddings
+            elif hasattr(self.embedding_model, "embed_query"):
+                return self.embedding_model.embed_query(question)
 
-        elif isinstance(self.embedding_model, OpenAIEmbeddings):
-            return self.embedding_model.embed_query(question)
+    def embed_questions(self, questions: List[str]) -> List[list]:
+        """
+        Encodes all questions in one batched forward pass.
+        """
+        with span("embed", n=len(questions)):
+            if hasattr(self.embedding_model, "encode"):
+                return self.embedding_model.encode(questions).tolist()
 
-    def search_segments(self, embedded_question: list, n: int) -> dict:
+            elif hasattr(self.embedding_model, "embed_documents"):
+                return self.embedding_model.embed_documents(questions)
+
+    def search_segments(self, embedded_question: list, n: int, topic: str = None, episode_name: str = None) -> dict:
         """
         Returns segment ids with cosine similarity, e.g.
         {
@@ -151,12 +492,25 @@ class PostgresQAEngine:
             189: 0.78,
             921: 0.77
         }
-        The values are sorted in a descending order.
+        The values are sorted in a descending order. The topic and episode filters
+        are applied inside the vector query.
         """
-        query_results = self.docs.query(
+        if self.search_settings and self.session is not None and \
+                isinstance(self._search_target(topic, episode_name)[0], vecs.Collection):
+            # The settings are applied on the SQL session, so it runs the query
+            return self.batch_search_segments([embedded_question], n, topic=topic, episode_name=episode_name)[0]
+
+        if topic is not None and topic in self.topic_collections:
+            collection = self.topic_collections[topic]
+            filters = build_filters(episode_name=episode_name)
+        else:
+            collection = self.docs
+            filters = build_filters(topic=topic, episode_name=episode_name)
+
+        query_results = collection.query(
             data=embedded_question,
             limit=n,
-            filters={},
+            filters=filters,
             measure="cosine_distance",
             include_value=True,
             include_metadata=False
@@ -166,136 +520,1005 @@ class PostgresQAEngine:
         indices_dict = dict(zip(indices, cos_similarity))
         return indices_dict
 
-    def process_found_segments(self, question: str, indices: dict):
+    def hybrid_search_segments(self, question: str, embedded_question: list, n: int, topic: str = None, episode_name: str = None) -> dict:
+        """
+        Fuses the vector search with a BM25 search over the segment summaries and
+        keywords. Returns segment ids with cosine similarity in the fused order;
+        segments found only by the lexical search have no similarity (None).
+        """
+        n_pool = max(3 * n, 50)
+        vector_hits = self.search_segments(
+            embedded_question, n_pool, topic=topic, episode_name=episode_name)
+        lexical_hits = self.lexical_index.search(
+            question, n_pool, filters={"topic": topic, "episode_name": episode_name})
+
+        fused = fuse_rankings(vector_hits, lexical_hits,
+                              method=self.fusion_method)
+        return {resource_id: vector_hits.get(resource_id) for resource_id in fused[:n]}
+
+    def batch_search_segments(self, embedded_questions: List[list], n: int, topic: str = None, episode_name: str = None) -> List[dict]:
+        """
+        `search_segments` for several questions. On a vecs collection all questions
+        are searched in one SQL round trip; other stores are searched one by one.
+        """
+        if not embedded_questions:
+            return []
+
+        collection, metadata = self._search_target(topic, episode_name)
+        if self.session is None or not isinstance(collection, vecs.Collection):
+            return [self.search_segments(embedded_question, n, topic=topic, episode_name=episode_name)
+                    for embedded_question in embedded_questions]
+
+        for params in self._search_settings_params():
+            self.session.execute(SET_SEARCH_SETTING_SQL, params)
+        rows = self.session.execute(batch_search_sql(collection.name, filtered=bool(metadata)),
+                                    self._search_params(embedded_questions, n, metadata)).all()
+        return rows_to_indices(rows, len(embedded_questions))
+
+    def _search_settings_params(self) -> List[dict]:
+        # The defaults of the vecs queries, unless tuned
+        return search_settings_params({**DEFAULT_SEARCH_SETTINGS, **self.search_settings})
+
+    def _search_target(self, topic: str = None, episode_name: str = None) -> Tuple[vecs.Collection, dict]:
+        """
+        The collection to search and the metadata its records must contain, for
+        the SQL searches that bypass the vecs client.
+        """
+        if topic is not None and topic in self.topic_collections:
+            collection = self.topic_collections[topic]
+            metadata = {"episode_name": episode_name}
+        else:
+            collection = self.docs
+            metadata = {"topic": topic, "episode_name": episode_name}
+        return collection, {key: value for key, value in metadata.items() if value is not None}
+
+    @staticmethod
+    def _search_params(embedded_questions: List[list], n: int, metadata: dict) -> dict:
+        return {"queries": [format_vector(embedded_question) for embedded_question in embedded_questions],
+                "limit": n,
+                "metadata": json.dumps(metadata)}
+
+    def find_segments_batch(self, questions: List[str], embedded_questions: List[list], n: int, options: RequestOptions = DEFAULT_OPTIONS) -> List[dict]:
+        """
+        `find_segments` for several questions. The vector searches run together;
+        the hybrid search fuses every question separately.
+        """
+        if options.search_mode == SearchMode.HYBRID:
+            return [self.find_segments(question, embedded_question, n, options)
+                    for question, embedded_question in zip(questions, embedded_questions)]
+        with span("search", mode=options.search_mode.value, n=n, n_questions=len(questions)):
+            return self.batch_search_segments(embedded_questions, n, topic=options.topic, episode_name=options.episode_name)
+
+    def _require_lexical_index(self) -> None:
+        if self.lexical_index is None and self.lexical_index_factory is not None:
+            self.lexical_index = self.lexical_index_factory()
+        if self.lexical_index is None:
+            raise ValueError("Hybrid search requires a lexical index")
+
+    def find_segments(self, question: str, embedded_question: list, n: int, options: RequestOptions = DEFAULT_OPTIONS) -> dict:
+        """
+        Searches with the search mode and topic/episode filters of the request.
+        """
+        with span("search", mode=options.search_mode.value, n=n):
+            if options.search_mode == SearchMode.HYBRID:
+                self._require_lexical_index()
+                return self.hybrid_search_segments(question, embedded_question, n, topic=options.topic, episode_name=options.episode_name)
+            return self.search_segments(embedded_question, n, topic=options.topic, episode_name=options.episode_name)
+
+    def _get_resources(self, resource_ids) -> list:
+        with span("resources", n=len(resource_ids)):
+            # Query resources via SQL in a single round trip
+            return get_resources(self.session, resource_ids, self.resource_cache)
+
+    @staticmethod
+    def _relevant_summary(resource: ResourcesHubermanLab, answer: str) -> dict:
+        return {"answer": answer,
+                "summary": resource.summary,
+                "episode_name": resource.episode_name,
+                "segment_title": resource.segment_title,
+                "url": resource.url,
+                "topic": resource.topic
+                }
+
+    def _fetch_vectors(self, resource_ids) -> dict:
+        # The stored embeddings of the segments, by id
+        with span("vectors", n=len(resource_ids)):
+            records = self.docs.fetch([str(resource_id)
+                                      for resource_id in resource_ids])
+        return {int(record[0]): record[1] for record in records}
+
+    def _check_candidates(self, indices: dict) -> dict:
+        # The found segments worth a relevance check
+        if self.candidate_selector is None:
+            return indices
+        candidates = self.candidate_selector.select(indices)
+        metrics.increment("qa_candidates_dropped_total",
+                          len(indices) - len(candidates), reason="similarity")
+        return candidates
+
+    def _diversified(self, candidates: dict, embedded_question: list, vectors: dict) -> dict:
+        # Candidates without a stored vector are kept at the end
+        resource_ids = [
+            resource_id for resource_id in candidates if resource_id in vectors]
+        if len(resource_ids) < 2:
+            return candidates
+        order = maximal_marginal_relevance(np.asarray(embedded_question, dtype=np.float32),
+                                           np.stack([np.asarray(vectors[resource_id], dtype=np.float32)
+                                                     for resource_id in resource_ids]),
+                                           lambda_mult=self.mmr_lambda,
+                                           duplicate_similarity=self.duplicate_similarity)
+        diversified = {resource_ids[row]: candidates[resource_ids[row]]
+                       for row in order}
+        metrics.increment("qa_candidates_dropped_total",
+                          len(resource_ids) - len(order), reason="duplicate")
+        for resource_id, similarity in candidates.items():
+            if resource_id not in vectors:
+                diversified[resource_id] = similarity
+        return diversified
+
+    def _use_mmr(self, candidates: dict) -> bool:
+        return self.mmr_lambda is not None and len(candidates) > 1
+
+    def select_candidates(self, indices: dict, embedded_question: list) -> dict:
+        """
+        The found segments to check for relevance, in the order they are checked:
+        the ones kept by the candidate selector, re-ranked by maximal marginal
+        relevance over their stored embeddings without near-duplicates if
+        `mmr_lambda` is set, so content repeated across episodes is checked once.
+        """
+        with span("candidates", n_found=len(indices)) as selection:
+            candidates = self._check_candidates(indices)
+            if self._use_mmr(candidates):
+                candidates = self._diversified(
+                    candidates, embedded_question, self._fetch_vectors(candidates))
+            selection.set(n_candidates=len(candidates))
+            return candidates
+
+    def process_found_segments(self, question: str, indices: dict, on_relevant_segment: Callable[[int, dict], None] = None, relevance: dict = None, options: RequestOptions = DEFAULT_OPTIONS):
+        """
+        Checks the found segments in similarity order until `n_relevant_segments`
+        relevant ones are found. `on_relevant_segment` is called with every relevant
+        segment as soon as it is known to be among them. The outcome of every check
+        is stored in `relevance` by segment id, if given.
+        """
+        with span("segment_checks", n_candidates=len(indices), grading=options.grading_mode.value) as checks:
+            result = None
+            if options.grading_mode == GradingMode.BATCHED:
+                result = self._grade_found_segments(
+                    question, indices, on_relevant_segment, relevance, options)
+            if result is None and self.n_concurrent_checks > 1:
+                result = self._process_found_segments_concurrently(
+                    question, indices, on_relevant_segment, relevance, options)
+            elif result is None:
+                result = self._process_found_segments_sequentially(
+                    question, indices, on_relevant_segment, relevance, options)
+            checks.set(n_relevant=result[1], n_non_relevant=result[2])
+            return result
+
+    def _graded_relevant(self, batch: list, output: str) -> list:
+        """
+        The relevant segments of a graded batch with their answers (None if the
+        reply didn't answer them), best score first, or None if the reply can't be
+        parsed.
+        """
+        try:
+            grades = parse_grades(output, len(batch))
+        except ValueError as e:
+            logger.warning(f"Checking the segments one by one: {e}")
+            return None
+        relevant = sorted((index for index, (score, _) in grades.items() if score >= RELEVANCE_THRESHOLD),
+                          key=lambda index: (-grades[index][0], index))
+        return [(batch[index], grades[index][1]) for index in relevant]
+
+    def _grading_batches(self, question: str, resources: list) -> Iterator[list]:
+        """
+        Splits the resources, in order, into batches of up to `n_graded` whose
+        grading prompt leaves `GRADING_REPLY_TOKENS` of the context window free. A
+        segment too long to share a call is graded alone.
+        """
+        budget = context_window(self.llm_model) - GRADING_REPLY_TOKENS - self._prompt_tokens(
+            GRADING_SYSTEM_TEMPLATE, GRADING_HUMAN_TEMPLATE, {"question": question, "contexts": ""})
+        batch, batch_tokens = [], 0
+        for resource in resources:
+            tokens = count_tokens(format_contexts(
+                [resource.summary]), self.llm_model)
+            if batch and (len(batch) >= max(self.n_graded, 1) or batch_tokens + tokens > budget):
+                yield batch
+                batch, batch_tokens = [], 0
+            batch.append(resource)
+            batch_tokens += tokens
+        if batch:
+            yield batch
+
+    def _grading_walk(self, question: str, resources: list, on_relevant_segment: Callable[[int, dict], None] = None, relevance: dict = None, api_key: str = None):
+        """
+        The batched grading of `_grade_found_segments` without the chat calls: it
+        yields every call as ("grade", inputs) or ("check", inputs) and is sent the
+        reply, so the sync and async variants only differ in how they make the
+        call. Returns the result, or None to check the segments one by one.
+        """
+        n_non_relevant_segments = 0
+        relevant_summaries = {}
+
+        for batch in self._grading_batches(question, resources):
+            if len(relevant_summaries) >= self.n_relevant_segments:
+                break
+
+            try:
+                output = yield "grade", {"question": question,
+                                         "contexts": [resource.summary for resource in batch],
+                                         "api_key": api_key}
+            except _invalid_request_errors() as e:
+                logger.warning(f"Checking the segments one by one: {e}")
+                return None
+            relevant = self._graded_relevant(batch, output)
+            if relevant is None:
+                return None
+            n_non_relevant_segments += len(batch) - len(relevant)
+            if relevance is not None:
+                graded_relevant = {resource.id for resource, _ in relevant}
+                for resource in batch:
+                    relevance[resource.id] = resource.id in graded_relevant
+
+            for resource, answer in relevant:
+                if len(relevant_summaries) >= self.n_relevant_segments:
+                    break
+                if answer is None:
+                    answer = yield "check", {"question": question, "context": resource.summary, "api_key": api_key}
+                    if answer.startswith("Not relevant"):
+                        n_non_relevant_segments += 1
+                        if relevance is not None:
+                            relevance[resource.id] = False
+                        continue
+
+                relevant_summaries[resource.id] = self._relevant_summary(
+                    resource, answer)
+                if on_relevant_segment is not None:
+                    on_relevant_segment(
+                        resource.id, relevant_summaries[resource.id])
+
+        return relevant_summaries, len(relevant_summaries), n_non_relevant_segments
+
+    def _grade_found_segments(self, question: str, indices: dict, on_relevant_segment: Callable[[int, dict], None] = None, relevance: dict = None, options: RequestOptions = DEFAULT_OPTIONS):
+        """
+        Grades the found segments up to `n_graded` at a time (as many as fit in the
+        context window of the model), in similarity order, with a single chat call
+        that also answers the best ones, until `n_relevant_segments` relevant
+        segments are found. A relevant segment the reply didn't answer is checked
+        on its own. Returns None if a reply can't be parsed or the provider rejects
+        a grading call, so the segments are checked one by one instead.
+        """
+        calls = {"grade": self.grade_segments,
+                 "check": self.segment_check_and_answer}
+
+        # Query contexts in a single round trip
+        walk = self._grading_walk(question, self._get_resources(indices),
+                                  on_relevant_segment, relevance, options.openai_api_key)
+        try:
+            call, inputs = next(walk)
+            while True:
+                try:
+                    output = calls[call](**inputs)
+                except Exception as e:
+                    call, inputs = walk.throw(e)
+                else:
+                    call, inputs = walk.send(output)
+        except StopIteration as stop:
+            return stop.value
+
+    def _process_found_segments_sequentially(self, question: str, indices: dict, on_relevant_segment: Callable[[int, dict], None] = None, relevance: dict = None, options: RequestOptions = DEFAULT_OPTIONS):
         n_relevant_segments = 0
         n_non_relevant_segments = 0
         relevant_summaries = {}
 
-        for ind in indices:
-            if n_relevant_segments < self.n_relevant_segments:
-                # Query context via SQL using SQLAlchemy ORM
-                resource = self.session.query(ResourcesHubermanLab).get(ind)
+        # Query contexts in a single round trip
+        resources = self._get_resources(indices)
 
+        for resource in resources:
+            if n_relevant_segments < self.n_relevant_segments:
                 context = resource.summary
                 answer = self.segment_check_and_answer(
-                    question=question, context=context)
+                    question=question, context=context, api_key=options.openai_api_key)
+                if relevance is not None:
+                    relevance[resource.id] = not answer.startswith(
+                        "Not relevant")
 
                 if answer.startswith("Not relevant"):
                     n_non_relevant_segments += 1
                 else:
                     n_relevant_segments += 1
-                    relevant_summaries[int(ind)] = {"answer": answer,
-                                                    "summary": resource.summary,
-                                                    "episode_name": resource.episode_name,
-                                                    "segment_title": resource.segment_title,
-                                                    "url": resource.url,
-                                                    "topic": resource.topic
-                                                    }
+                    relevant_summaries[resource.id] = self._relevant_summary(
+                        resource, answer)
+                    if on_relevant_segment is not None:
+                        on_relevant_segment(
+                            resource.id, relevant_summaries[resource.id])
 
             else:
                 return relevant_summaries, n_relevant_segments, n_non_relevant_segments
 
         return relevant_summaries, n_relevant_segments, n_non_relevant_segments
 
-    def get_final_answer(self, question: str, answers: dict):
-        chat = ChatOpenAI(temperature=self.temperature,
-                          model_name=self.llm_model)
+    def _ranked_prefix(self, checked: list, answers: dict, failures: dict):
+        """
+        Walks the checked segments in similarity order until the first one still in
+        flight, or until `n_relevant_segments` relevant ones are found. Everything
+        in the walked prefix is final, whatever the checks in flight return. A check
+        that failed is raised once it is in the prefix, and ignored when it ends up
+        ranked after the segments needed.
+        """
+        n_relevant_segments = 0
+        n_non_relevant_segments = 0
+        relevant_summaries = {}
 
-        system_message_prompt = SystemMessagePromptTemplate.from_template(
-            FINAL_ANSWER_SYSTEM_TEMPLATE)
-        human_message_prompt = HumanMessagePromptTemplate.from_template(
-            FINAL_ANSWER_HUMAN_TEMPLATE)
-        chat_prompt = ChatPromptTemplate.from_messages(
-            [system_message_prompt, human_message_prompt])
+        for rank, resource in enumerate(checked):
+            if n_relevant_segments >= self.n_relevant_segments:
+                break
+            if rank in failures:
+                raise failures[rank]
+            if rank not in answers:
+                break
+
+            answer = answers[rank]
+            if answer.startswith("Not relevant"):
+                n_non_relevant_segments += 1
+            else:
+                n_relevant_segments += 1
+                relevant_summaries[resource.id] = self._relevant_summary(
+                    resource, answer)
+
+        return relevant_summaries, n_relevant_segments, n_non_relevant_segments
+
+    def _ranked_checks(self, resources: list, n_concurrent_checks: int, on_relevant_segment: Callable[[int, dict], None] = None, relevance: dict = None):
+        """
+        The scheduling of the concurrent checks without the checks themselves: it
+        yields the segments to start checking as (rank, resource) pairs, in
+        similarity order and up to `n_concurrent_checks` in flight, and is sent the
+        finished checks as (rank, future) pairs, from an executor or asyncio. Returns
+        the result once the first `n_relevant_segments` relevant segments by rank
+        are known.
+        """
+        candidates = iter(resources)
+        checked = []
+        answers = {}
+        failures = {}
+        n_in_flight = 0
+        no_more_candidates = False
+        reported = set()
+
+        while True:
+            started = []
+            while n_in_flight + len(started) < n_concurrent_checks and not no_more_candidates:
+                resource = next(candidates, None)
+                if resource is None:
+                    no_more_candidates = True
+                    break
+                started.append((len(checked), resource))
+                checked.append(resource)
+            n_in_flight += len(started)
+
+            if n_in_flight:
+                finished = yield started
+                n_in_flight -= len(finished)
+                for rank, future in finished:
+                    if future.exception() is not None:
+                        failures[rank] = future.exception()
+                        continue
+                    answers[rank] = future.result()
+                    if relevance is not None:
+                        relevance[checked[rank].id] = not answers[rank].startswith(
+                            "Not relevant")
+
+            relevant_summaries, n_relevant_segments, n_non_relevant_segments = self._ranked_prefix(
+                checked, answers, failures)
+
+            if on_relevant_segment is not None:
+                for resource_id, summary in relevant_summaries.items():
+                    if resource_id not in reported:
+                        reported.add(resource_id)
+                        on_relevant_segment(resource_id, summary)
 
+            if n_relevant_segments >= self.n_relevant_segments or (no_more_candidates and not n_in_flight):
+                return relevant_summaries, n_relevant_segments, n_non_relevant_segments
+
+    def _process_found_segments_concurrently(self, question: str, indices: dict, on_relevant_segment: Callable[[int, dict], None] = None, relevance: dict = None, options: RequestOptions = DEFAULT_OPTIONS):
+        """
+        Same result as the sequential walk, but up to `n_concurrent_checks`
+        segments are checked at once, submitted in similarity order. Once the first
+        `n_relevant_segments` relevant segments by rank are known, the checks that
+        have not started yet are cancelled and the ones in flight are discarded.
+        """
+        # Query contexts in a single round trip
+        walk = self._ranked_checks(self._get_resources(indices), self.n_concurrent_checks,
+                                   on_relevant_segment, relevance)
+        pending = {}
+
+        executor = ThreadPoolExecutor(max_workers=self.n_concurrent_checks)
+        try:
+            started = next(walk)
+            while True:
+                for rank, resource in started:
+                    future = executor.submit(in_context(self.segment_check_and_answer),
+                                             question=question, context=resource.summary, api_key=options.openai_api_key)
+                    pending[future] = rank
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                started = walk.send([(pending.pop(future), future)
+                                     for future in done])
+        except StopIteration as stop:
+            return stop.value
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def get_final_answer(self, question: str, answers: dict, on_token: Callable[[str], None] = None, api_key: str = None):
         prompt_context = "\n".join(
             [f"ANSWER {i+1}:\n{answer['answer']}\n" for i, answer in enumerate(answers.values())])
 
-        chain = LLMChain(llm=chat, prompt=chat_prompt)
-        output = chain.run(question=question, context=prompt_context)
-        return output
+        return self._run_chat(FINAL_ANSWER_SYSTEM_TEMPLATE, FINAL_ANSWER_HUMAN_TEMPLATE,
+                              on_token=on_token, api_key=api_key, question=question, context=prompt_context)
 
-    def answer_full_flow(self, user_id, question):
-        start_time = time.time()
-        # Create a new question instance
-        new_question = QuestionsHubermanLab(
-            user_id=user_id, created_at=datetime.datetime.now(), question=question, mode="answer")
+    @staticmethod
+    def _resource_summary(resource: ResourcesHubermanLab, similarity: float = None) -> dict:
+        return {"id": resource.id,
+                "summary": resource.summary,
+                "episode_name": resource.episode_name,
+                "segment_title": resource.segment_title,
+                "url": resource.url,
+                "topic": resource.topic,
+                "similarity": similarity
+                }
 
-        # Add the question instance to the session and commit
-        self.session.add(new_question)
-        self.session.commit()
+    def _answer_from_semantic_cache(self, embedded_question: list, options: RequestOptions) -> AnswerResult:
+        with span("semantic_cache") as lookup:
+            cached = self.semantic_cache.lookup(
+                embedded_question, self._semantic_cache_metadata(options))
+            lookup.set(hit=cached is not None)
+        if cached is None:
+            return None
 
-        question_id = new_question.id
+        logger.info(
+            f"Semantic cache hit ({round(cached.similarity, 3)}): {cached.question}")
+        resources = self._get_resources(cached.resource_ids)
+        relevant_segments = {resource.id: self._relevant_summary(resource, cached.segment_answers.get(resource.id))
+                             for resource in resources}
+        return AnswerResult(answer=cached.answer,
+                            relevant_segments=relevant_segments,
+                            n_relevant=cached.n_relevant,
+                            n_non_relevant=cached.n_non_relevant,
+                            # Logged as the recommendations, without a similarity
+                            # since this question wasn't searched
+                            recommended_resources={
+                                resource_id: None for resource_id in cached.resource_ids},
+                            from_cache=True)
 
+    def _cached_result(self, embedded_question: list, options: RequestOptions, record: QuestionLogRecord = None, on_event: Callable[[str, object], None] = None) -> AnswerResult:
+        result = self._answer_from_semantic_cache(embedded_question, options)
+        if result is not None:
+            self._report_result(result, record, on_event)
+        return result
+
+    @staticmethod
+    def _report_result(result: AnswerResult, record: QuestionLogRecord = None, on_event: Callable[[str, object], None] = None) -> None:
+        # Fills in the log record and replays the events of a result that wasn't
+        # computed for this question, i.e. a cached or shared one
+        if record is not None:
+            record.recommended_resources = result.recommended_resources
+            record.answer = result.answer
+            record.n_relevant = result.n_relevant
+            record.n_non_relevant = result.n_non_relevant
+        if on_event is not None:
+            on_event("resources", [{**value, "id": resource_id}
+                                   for resource_id, value in result.relevant_segments.items()])
+            for resource_id, value in result.relevant_segments.items():
+                on_event("segment", {**value, "id": resource_id})
+            on_event("token", result.answer)
+
+    def _use_semantic_cache(self, options: RequestOptions) -> bool:
+        # Cached answers are not restricted to a topic or an episode
+        return self.semantic_cache is not None and options.topic is None and options.episode_name is None
+
+    def _single_flight_key(self, question: str, options: RequestOptions) -> tuple:
+        # Everything besides the question that changes the answer. Only requests
+        # with the same API key share an answer, so no one is answered with a key
+        # they didn't send, e.g. an invalid one; the key is kept as a hash.
+        api_key_hash = hashlib.sha256(options.openai_api_key.encode(
+            "utf-8")).hexdigest() if options.openai_api_key is not None else None
+        return (normalize_question(question), options.search_mode.value, options.grading_mode.value, options.topic,
+                options.episode_name, self.llm_model, self.temperature, api_key_hash)
+
+    def answer_question(self, question: str, record: QuestionLogRecord = None, on_event: Callable[[str, object], None] = None, options: RequestOptions = DEFAULT_OPTIONS) -> AnswerResult:
+        """
+        Answers the question from the relevant segments, with the search and
+        grading mode, filters and API key of the request `options`. A past question
+        within the semantic cache threshold is answered with its stored answer,
+        without the search and LLM calls. The log `record` is filled in along the
+        way.
+
+        With `on_event`, the progress is reported as it happens: the found
+        "resources", every relevant "segment" and the final answer "token"s.
+
+        With a single flight, a question asked again while it is being answered
+        waits for that answer. Its record is filled in and its events are
+        replayed from the shared result.
+        """
+        if self.single_flight is None:
+            return self._answer_question(question, record, on_event, options)
+
+        result, shared = self.single_flight.run(self._single_flight_key(question, options),
+                                                lambda: self._answer_question(question, record, on_event, options))
+        if shared:
+            self._report_result(result, record, on_event)
+        return result
+
+    def _answer_question(self, question: str, record: QuestionLogRecord = None, on_event: Callable[[str, object], None] = None, options: RequestOptions = DEFAULT_OPTIONS) -> AnswerResult:
         # Encoding question to embedding space
         embedded_question = self.embed_question(question)
 
+        if self._use_semantic_cache(options):
+            result = self._cached_result(
+                embedded_question, options, record, on_event)
+            if result is not None:
+                return result
+
         # Finding relevant segments
-        indices = self.search_segments(embedded_question, 20)
+        indices = self.find_segments(
+            question, embedded_question, self.n_search, options)
+        return self._answer_from_segments(question, embedded_question, indices, record, on_event, options)
+
+    @staticmethod
+    def _semantic_cache_metadata(options: RequestOptions) -> dict:
+        # A cached answer is only reused with the modes it was found with
+        return {"search_mode": options.search_mode.value, "grading_mode": options.grading_mode.value}
+
+    def _cached_answer(self, question: str, answer: str, relevant_segments: dict, n_relevant: int, n_non_relevant: int, options: RequestOptions) -> CachedAnswer:
+        return CachedAnswer(question=question,
+                            answer=answer,
+                            resource_ids=list(relevant_segments),
+                            n_relevant=n_relevant,
+                            n_non_relevant=n_non_relevant,
+                            segment_answers={resource_id: value["answer"] for resource_id, value in relevant_segments.items()},
+                            **self._semantic_cache_metadata(options))
+
+    def _answer_from_segments(self, question: str, embedded_question: list, indices: dict, record: QuestionLogRecord = None, on_event: Callable[[str, object], None] = None, options: RequestOptions = DEFAULT_OPTIONS) -> AnswerResult:
+        if record is not None:
+            record.recommended_resources = indices
+
+        on_relevant_segment = None
+        on_token = None
+        if on_event is not None:
+            on_event("resources", [self._resource_summary(resource, indices[resource.id])
+                                   for resource in self._get_resources(indices)])
+
+            def on_relevant_segment(resource_id, value):
+                on_event("segment", {**value, "id": resource_id})
 
-        # Create new recommended resource instances and add them to the session
-        for resource_id, similarity_score in indices.items():
-            new_recommended_resource = RecommendedResourcesHubermanLab(
-                question_id=question_id, resource_id=resource_id, similarity_score=similarity_score)
-            self.session.add(new_recommended_resource)
-        self.session.commit()
+            def on_token(token):
+                on_event("token", token)
 
         # Getting answers from segments
         relevant_segments, n_relevant, n_non_relevant = self.process_found_segments(
-            question, indices)
+            question, self.select_candidates(indices, embedded_question), on_relevant_segment,
+            record.relevance if record is not None else None, options)
 
         # Getting the final answer
-        answer = self.get_final_answer(question, relevant_segments)
-        answer += "\n\n## Related Videos\n\n"
-        for i, value in enumerate(relevant_segments.values()):
-            answer += f'\n{i+1}. {value["segment_title"]}\n <iframe width="770" height="400" src="{value["url"].replace("watch?v=", "embed/").replace("&t=", "?start=")[:-1]}" frameborder="0" allow="accelerometer; autoplay; clipboard-write; encrypted-media; gyroscope; picture-in-picture" allowfullscreen></iframe>\n'
+        answer = self.get_final_answer(
+            question, relevant_segments, on_token=on_token, api_key=options.openai_api_key)
+        if record is not None:
+            record.answer = answer
+            record.n_relevant = n_relevant
+            record.n_non_relevant = n_non_relevant
 
-        # Adding the answer to the AnswersHubermanLab table
-        new_answer = AnswersHubermanLab(
-            user_id=user_id, question_id=question_id, answer=answer, n_relevant=n_relevant, n_non_relevant=n_non_relevant)
-        self.session.add(new_answer)
-        self.session.commit()
+        if self._use_semantic_cache(options) and n_relevant > 0:
+            self.semantic_cache.add(embedded_question, self._cached_answer(
+                question, answer, relevant_segments, n_relevant, n_non_relevant, options))
 
-        html_raw = markdown.markdown(answer, extensions=['extra'])
+        return AnswerResult(answer=answer,
+                            relevant_segments=relevant_segments,
+                            n_relevant=n_relevant,
+                            n_non_relevant=n_non_relevant,
+                            recommended_resources=indices)
 
-        end_time = time.time()
+    def _with_prefetched_resources(self, resource_ids) -> "PostgresQAEngine":
+        """
+        A shallow copy of the engine whose resource lookups for `resource_ids` are
+        served from memory, loaded here in a single round trip, so it can be used
+        from worker threads without touching the SQL session.
+        """
+        if self.session is None:
+            return self
 
-        logger.info(f"Full QA flow time: {round(end_time-start_time, 2)}")
-        return answer, html_raw
+        resources = self._get_resources(resource_ids)
+        prefetched = ResourceCache(max_size=max(len(resources), 1))
+        prefetched.put_many(resources)
+
+        engine = copy.copy(self)
+        engine.resource_cache = prefetched
+        return engine
 
-    def resource_full_flow(self, user_id, question):
+    def answer_questions(self, questions: List[str], records: List[QuestionLogRecord] = None, n_concurrent_questions: int = 4, options: RequestOptions = DEFAULT_OPTIONS) -> List[AnswerResult]:
+        """
+        Batch version of `answer_question`. The questions are encoded in one forward
+        pass, searched together and their segments are loaded in one query; then up
+        to `n_concurrent_questions` questions are checked and answered at once.
+        """
+        records = records if records is not None else [None] * len(questions)
+
+        # Encoding questions to embedding space
+        embedded_questions = self.embed_questions(questions)
+
+        results = [None] * len(questions)
+        if self._use_semantic_cache(options):
+            for i, embedded_question in enumerate(embedded_questions):
+                results[i] = self._cached_result(
+                    embedded_question, options, records[i])
+
+        # Finding relevant segments of the questions without a cached answer
+        misses = [i for i, result in enumerate(results) if result is None]
+        if not misses:
+            return results
+        found = self.find_segments_batch([questions[i] for i in misses],
+                                         [embedded_questions[i] for i in misses], self.n_search, options)
+
+        engine = self._with_prefetched_resources(
+            {resource_id for indices in found for resource_id in indices})
+        with ThreadPoolExecutor(max_workers=max(n_concurrent_questions, 1)) as executor:
+            futures = {i: executor.submit(in_context(engine._answer_from_segments), questions[i], embedded_questions[i], indices, records[i], None, options)
+                       for i, indices in zip(misses, found)}
+            for i, future in futures.items():
+                results[i] = future.result()
+        return results
+
+    def stream_answer(self, question: str, record: QuestionLogRecord = None, options: RequestOptions = DEFAULT_OPTIONS) -> Iterator[Tuple[str, object]]:
+        """
+        Yields the (event, data) pairs reported by `answer_question` while it runs in
+        a worker thread, followed by a final "done" event (or an "error" event).
+        """
+        events = queue.Queue()
+
+        def run():
+            try:
+                result = self.answer_question(
+                    question, record, on_event=lambda event, data: events.put((event, data)), options=options)
+                events.put(("done", {"answer": result.answer,
+                                     "n_relevant": result.n_relevant,
+                                     "n_non_relevant": result.n_non_relevant,
+                                     "from_cache": result.from_cache}))
+            except Exception as e:
+                logger.exception("Streaming answer failed")
+                events.put(("error", {"detail": str(e)}))
+            finally:
+                events.put(None)
+
+        threading.Thread(target=in_context(run), daemon=True).start()
+        while True:
+            item = events.get()
+            if item is None:
+                return
+            yield item
+
+    def answer_full_flow(self, user_id, question, options: RequestOptions = DEFAULT_OPTIONS):
         start_time = time.time()
+        # Create a new question log record, written once the flow is finished
+        record = QuestionLogRecord(
+            user_id=user_id, question=question, mode="answer")
 
-        # Create a new question instance
-        new_question = QuestionsHubermanLab(
-            user_id=user_id, created_at=datetime.datetime.now(), question=question, mode="resources")
+        try:
+            result = self.answer_question(question, record, options=options)
 
-        # Add the question instance to the session and commit
-        self.session.add(new_question)
-        self.session.commit()
+            answer = result.answer
+            answer += "\n\n## Related Videos\n\n"
+            for i, value in enumerate(result.relevant_segments.values()):
+                answer += f'\n{i+1}. {value["segment_title"]}\n <iframe width="770" height="400" src="{value["url"].replace("watch?v=", "embed/").replace("&t=", "?start=")[:-1]}" frameborder="0" allow="accelerometer; autoplay; clipboard-write; encrypted-media; gyroscope; picture-in-picture" allowfullscreen></iframe>\n'
 
-        question_id = new_question.id
+            record.answer = answer
+        finally:
+            self.activity_logger.log(record)
 
-        # Encoding question to embedding space
-        embedded_question = self.embed_question(question)
+        with span("markdown"):
+            import markdown
+            html_raw = markdown.markdown(answer, extensions=['extra'])
 
-        # Finding relevant segments
-        indices = self.search_segments(embedded_question, 7)
+        end_time = time.time()
+
+        logger.info(f"Full QA flow time: {round(end_time-start_time, 2)}")
+        return answer, html_raw
+
+    def resource_full_flow(self, user_id, question, options: RequestOptions = DEFAULT_OPTIONS):
+        start_time = time.time()
 
-        # Create new recommended resource instances and add them to the session
-        for resource_id, similarity_score in indices.items():
-            new_recommended_resource = RecommendedResourcesHubermanLab(
-                question_id=question_id, resource_id=resource_id, similarity_score=similarity_score)
-            self.session.add(new_recommended_resource)
-        self.session.commit()
+        # Create a new question log record, written once the flow is finished
+        record = QuestionLogRecord(
+            user_id=user_id, question=question, mode="resources")
+
+        try:
+            # Encoding question to embedding space
+            embedded_question = self.embed_question(question)
+
+            # Finding relevant segments
+            indices = self.find_segments(
+                question, embedded_question, self.n_resources, options)
+            record.recommended_resources = indices
+        finally:
+            self.activity_logger.log(record)
 
         output = "\n\n## Related Videos\n\n"
-        for i, ind in enumerate(indices, 1):
-            resource = self.session.query(ResourcesHubermanLab).get(ind)
+        resources = self._get_resources(indices)
+        for i, resource in enumerate(resources, 1):
             output += f'\n{i+1}. {resource.segment_title}\n <iframe width="770" height="400" src="{resource.url.replace("watch?v=", "embed/").replace("&t=", "?start=")[:-1]}" frameborder="0" allow="accelerometer; autoplay; clipboard-write; encrypted-media; gyroscope; picture-in-picture" allowfullscreen></iframe>\n'
 
-        html_raw = markdown.markdown(output, extensions=['extra'])
+        with span("markdown"):
+            import markdown
+            html_raw = markdown.markdown(output, extensions=['extra'])
         end_time = time.time()
 
         logger.info(f"Resource flow time: {round(end_time-start_time, 2)}")
         return html_raw
+
+    def resources_for_questions(self, questions: List[str], records: List[QuestionLogRecord] = None, n: int = None, options: RequestOptions = DEFAULT_OPTIONS) -> List[dict]:
+        """
+        Batch version of the resource flow: returns the found segment ids with cosine
+        similarity of every question, `n_resources` by default. The log `records`
+        are filled in.
+        """
+        # Encoding questions to embedding space
+        embedded_questions = self.embed_questions(questions)
+
+        # Finding relevant segments
+        found = self.find_segments_batch(
+            questions, embedded_questions, n if n is not None else self.n_resources, options)
+        if records is not None:
+            for record, indices in zip(records, found):
+                record.recommended_resources = indices
+        return found
+
+    # The async request path: the same flow as above, but the database, vector and
+    # LLM calls are awaited, so one worker serves many questions at once
+
+    async def embed_question_async(self, question: str) -> list:
+        # Encoding is CPU bound, so it runs in a worker thread
+        return await asyncio.to_thread(self.embed_question, question)
+
+    async def search_segments_async(self, embedded_question: list, n: int, topic: str = None, episode_name: str = None) -> dict:
+        """
+        `search_segments` with the pgvector query on the async session. Without one,
+        or on another store, the sync search runs in a worker thread.
+        """
+        collection, metadata = self._search_target(topic, episode_name)
+        if self.async_session is None or not isinstance(collection, vecs.Collection):
+            return await asyncio.to_thread(self.search_segments, embedded_question, n, topic, episode_name)
+
+        for params in self._search_settings_params():
+            await self.async_session.execute(SET_SEARCH_SETTING_SQL, params)
+        rows = (await self.async_session.execute(batch_search_sql(collection.name, filtered=bool(metadata)),
+                                                 self._search_params([embedded_question], n, metadata))).all()
+        return rows_to_indices(rows, 1)[0]
+
+    async def hybrid_search_segments_async(self, question: str, embedded_question: list, n: int, topic: str = None, episode_name: str = None) -> dict:
+        n_pool = max(3 * n, 50)
+        vector_hits = await self.search_segments_async(
+            embedded_question, n_pool, topic=topic, episode_name=episode_name)
+        lexical_hits = self.lexical_index.search(
+            question, n_pool, filters={"topic": topic, "episode_name": episode_name})
+
+        fused = fuse_rankings(vector_hits, lexical_hits,
+                              method=self.fusion_method)
+        return {resource_id: vector_hits.get(resource_id) for resource_id in fused[:n]}
+
+    async def find_segments_async(self, question: str, embedded_question: list, n: int, options: RequestOptions = DEFAULT_OPTIONS) -> dict:
+        with span("search", mode=options.search_mode.value, n=n):
+            if options.search_mode == SearchMode.HYBRID:
+                self._require_lexical_index()
+                return await self.hybrid_search_segments_async(question, embedded_question, n, topic=options.topic, episode_name=options.episode_name)
+            return await self.search_segments_async(embedded_question, n, topic=options.topic, episode_name=options.episode_name)
+
+    async def get_resources_async(self, resource_ids) -> list:
+        if self.async_session is not None:
+            with span("resources", n=len(resource_ids)):
+                # Query resources via SQL in a single round trip
+                return await get_resources_async(self.async_session, resource_ids, self.resource_cache)
+        return await asyncio.to_thread(self._get_resources, list(resource_ids))
+
+    async def _fetch_vectors_async(self, resource_ids) -> dict:
+        if self.async_session is None or not isinstance(self.docs, vecs.Collection):
+            return await asyncio.to_thread(self._fetch_vectors, list(resource_ids))
+        with span("vectors", n=len(resource_ids)):
+            rows = (await self.async_session.execute(fetch_vectors_sql(self.docs.name),
+                                                     {"ids": [str(resource_id) for resource_id in resource_ids]})).all()
+        return {int(resource_id): parse_vector(vector) for resource_id, vector in rows}
+
+    async def select_candidates_async(self, indices: dict, embedded_question: list) -> dict:
+        with span("candidates", n_found=len(indices)) as selection:
+            candidates = self._check_candidates(indices)
+            if self._use_mmr(candidates):
+                candidates = self._diversified(
+                    candidates, embedded_question, await self._fetch_vectors_async(candidates))
+            selection.set(n_candidates=len(candidates))
+            return candidates
+
+    async def segment_check_and_answer_async(self, question: str, context: str, api_key: str = None) -> str:
+        return await self._run_chat_async(SEGMENT_SYSTEM_TEMPLATE, SEGMENT_HUMAN_TEMPLATE, api_key=api_key,
+                                          question=question, context=context)
+
+    async def grade_segments_async(self, question: str, contexts: List[str], api_key: str = None) -> str:
+        return await self._run_chat_async(GRADING_SYSTEM_TEMPLATE, GRADING_HUMAN_TEMPLATE, api_key=api_key,
+                                          question=question, contexts=format_contexts(contexts), n_relevant=self.n_relevant_segments)
+
+    async def get_final_answer_async(self, question: str, answers: dict, on_token: Callable[[str], None] = None, api_key: str = None) -> str:
+        prompt_context = "\n".join(
+            [f"ANSWER {i+1}:\n{answer['answer']}\n" for i, answer in enumerate(answers.values())])
+
+        return await self._run_chat_async(FINAL_ANSWER_SYSTEM_TEMPLATE, FINAL_ANSWER_HUMAN_TEMPLATE,
+                                          on_token=on_token, api_key=api_key, question=question, context=prompt_context)
+
+    async def process_found_segments_async(self, question: str, indices: dict, on_relevant_segment: Callable[[int, dict], None] = None, relevance: dict = None, options: RequestOptions = DEFAULT_OPTIONS):
+        """
+        `process_found_segments` with up to `n_concurrent_checks` checks awaited at
+        once. The result is the same as the sequential walk's; once it is known,
+        the checks still in flight are cancelled.
+        """
+        with span("segment_checks", n_candidates=len(indices), grading=options.grading_mode.value) as checks:
+            result = None
+            if options.grading_mode == GradingMode.BATCHED:
+                result = await self._grade_found_segments_async(question, indices, on_relevant_segment, relevance, options)
+            if result is None:
+                result = await self._process_found_segments_async(question, indices, on_relevant_segment, relevance, options)
+            checks.set(n_relevant=result[1], n_non_relevant=result[2])
+            return result
+
+    async def _grade_found_segments_async(self, question: str, indices: dict, on_relevant_segment: Callable[[int, dict], None] = None, relevance: dict = None, options: RequestOptions = DEFAULT_OPTIONS):
+        calls = {"grade": self.grade_segments_async,
+                 "check": self.segment_check_and_answer_async}
+
+        # Query contexts in a single round trip
+        walk = self._grading_walk(question, await self.get_resources_async(indices),
+                                  on_relevant_segment, relevance, options.openai_api_key)
+        try:
+            call, inputs = next(walk)
+            while True:
+                try:
+                    output = await calls[call](**inputs)
+                except Exception as e:
+                    call, inputs = walk.throw(e)
+                else:
+                    call, inputs = walk.send(output)
+        except StopIteration as stop:
+            return stop.value
+
+    async def _process_found_segments_async(self, question: str, indices: dict, on_relevant_segment: Callable[[int, dict], None] = None, relevance: dict = None, options: RequestOptions = DEFAULT_OPTIONS):
+        # Query contexts in a single round trip
+        walk = self._ranked_checks(await self.get_resources_async(indices), max(self.n_concurrent_checks, 1),
+                                   on_relevant_segment, relevance)
+        pending = {}
+
+        try:
+            started = next(walk)
+            while True:
+                for rank, resource in started:
+                    task = asyncio.ensure_future(self.segment_check_and_answer_async(
+                        question=question, context=resource.summary, api_key=options.openai_api_key))
+                    pending[task] = rank
+                done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                started = walk.send([(pending.pop(task), task) for task in done])
+        except StopIteration as stop:
+            return stop.value
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def _answer_from_semantic_cache_async(self, embedded_question: list, options: RequestOptions) -> AnswerResult:
+        with span("semantic_cache") as lookup:
+            cached = await asyncio.to_thread(self.semantic_cache.lookup, embedded_question, self._semantic_cache_metadata(options))
+            lookup.set(hit=cached is not None)
+        if cached is None:
+            return None
+
+        logger.info(
+            f"Semantic cache hit ({round(cached.similarity, 3)}): {cached.question}")
+        resources = await self.get_resources_async(cached.resource_ids)
+        relevant_segments = {resource.id: self._relevant_summary(resource, cached.segment_answers.get(resource.id))
+                             for resource in resources}
+        return AnswerResult(answer=cached.answer,
+                            relevant_segments=relevant_segments,
+                            n_relevant=cached.n_relevant,
+                            n_non_relevant=cached.n_non_relevant,
+                            # Logged as the recommendations, without a similarity
+                            # since this question wasn't searched
+                            recommended_resources={
+                                resource_id: None for resource_id in cached.resource_ids},
+                            from_cache=True)
+
+    async def answer_question_async(self, question: str, record: QuestionLogRecord = None, on_event: Callable[[str, object], None] = None, options: RequestOptions = DEFAULT_OPTIONS) -> AnswerResult:
+        """
+        `answer_question` on the async request path.
+        """
+        if self.single_flight is None:
+            return await self._answer_question_async(question, record, on_event, options)
+
+        result, shared = await self.single_flight.run_async(self._single_flight_key(question, options),
+                                                            lambda: self._answer_question_async(question, record, on_event, options))
+        if shared:
+            self._report_result(result, record, on_event)
+        return result
+
+    async def _answer_question_async(self, question: str, record: QuestionLogRecord = None, on_event: Callable[[str, object], None] = None, options: RequestOptions = DEFAULT_OPTIONS) -> AnswerResult:
+        # Encoding question to embedding space
+        embedded_question = await self.embed_question_async(question)
+
+        if self._use_semantic_cache(options):
+            result = await self._answer_from_semantic_cache_async(embedded_question, options)
+            if result is not None:
+                self._report_result(result, record, on_event)
+                return result
+
+        # Finding relevant segments
+        indices = await self.find_segments_async(question, embedded_question, self.n_search, options)
+        if record is not None:
+            record.recommended_resources = indices
+
+        on_relevant_segment = None
+        on_token = None
+        if on_event is not None:
+            on_event("resources", [self._resource_summary(resource, indices[resource.id])
+                                   for resource in await self.get_resources_async(indices)])
+
+            def on_relevant_segment(resource_id, value):
+                on_event("segment", {**value, "id": resource_id})
+
+            def on_token(token):
+                on_event("token", token)
+
+        # Getting answers from segments
+        relevant_segments, n_relevant, n_non_relevant = await self.process_found_segments_async(
+            question, await self.select_candidates_async(indices, embedded_question), on_relevant_segment,
+            record.relevance if record is not None else None, options)
+
+        # Getting the final answer
+        answer = await self.get_final_answer_async(
+            question, relevant_segments, on_token=on_token, api_key=options.openai_api_key)
+        if record is not None:
+            record.answer = answer
+            record.n_relevant = n_relevant
+            record.n_non_relevant = n_non_relevant
+
+        if self._use_semantic_cache(options) and n_relevant > 0:
+            await asyncio.to_thread(self.semantic_cache.add, embedded_question, self._cached_answer(
+                question, answer, relevant_segments, n_relevant, n_non_relevant, options))
+
+        return AnswerResult(answer=answer,
+                            relevant_segments=relevant_segments,
+                            n_relevant=n_relevant,
+                            n_non_relevant=n_non_relevant,
+                            recommended_resources=indices)
+
+    async def stream_answer_async(self, question: str, record: QuestionLogRecord = None, options: RequestOptions = DEFAULT_OPTIONS) -> AsyncIterator[Tuple[str, object]]:
+        """
+        `stream_answer` on the async request path. If the consumer stops early, the
+        answer task is cancelled.
+        """
+        loop = asyncio.get_running_loop()
+        events = asyncio.Queue()
+
+        def on_event(event, data):
+            # Streaming callbacks of the chat model can run in executor threads
+            loop.call_soon_threadsafe(events.put_nowait, (event, data))
+
+        async def run():
+            try:
+                result = await self.answer_question_async(question, record, on_event=on_event, options=options)
+                on_event("done", {"answer": result.answer,
+                                  "n_relevant": result.n_relevant,
+                                  "n_non_relevant": result.n_non_relevant,
+                                  "from_cache": result.from_cache})
+            except Exception as e:
+                logger.exception("Streaming answer failed")
+                on_event("error", {"detail": str(e)})
+            finally:
+                loop.call_soon_threadsafe(events.put_nowait, None)
+
+        task = asyncio.ensure_future(run())
+        try:
+            while True:
+                item = await events.get()
+                if item is None:
+                    return
+                yield item
+        finally:
+            task.cancel()
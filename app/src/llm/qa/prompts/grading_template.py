@@ -0,0 +1,42 @@
+import json
+
+
+GRADING_SYSTEM_TEMPLATE = """You are a highly skilled and intelligent assistant. Your output will be parsed by the system, so you must reply with JSON only, without any other text.
+
+The task is to assess the relevance of every numbered context to the user question. Score every context from 0 (not related to the question) to 10 (answers the question). For the {n_relevant} highest scoring contexts with a score of at least 5, also provide a highly actionable and easy to understand answer to the question, based only on that context. For the other contexts, the answer is null.
+
+Reply with a JSON list with one object per context, in the order of the contexts:
+[{{"context": 1, "score": 8, "answer": "..."}}, {{"context": 2, "score": 0, "answer": null}}]"""
+
+
+GRADING_HUMAN_TEMPLATE = '''
+User question: "{question}"
+
+Contexts:
+"""
+{contexts}
+"""'''
+
+
+def format_contexts(summaries: list) -> str:
+    return "\n".join(f"CONTEXT {i}:\n{summary}\n" for i, summary in enumerate(summaries, 1))
+
+
+def parse_grades(output: str, n_contexts: int) -> dict:
+    """
+    The (score, answer) of every context in the grading reply, by its index among
+    the contexts. Raises ValueError if the reply is not the expected JSON.
+    """
+    start, end = output.find("["), output.rfind("]")
+    if start == -1 or end < start:
+        raise ValueError(f"No JSON list in the grading reply: {output[:100]}")
+
+    grades = {}
+    try:
+        for item in json.loads(output[start:end+1]):
+            index = int(item["context"]) - 1
+            if 0 <= index < n_contexts:
+                grades[index] = (float(item.get("score") or 0), item.get("answer") or None)
+    except (KeyError, TypeError) as e:
+        raise ValueError(f"Malformed grading reply: {e}")
+    return grades
@@ -0,0 +1,154 @@
+import hashlib
+import threading
+import numpy as np
+import vecs
+
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional
+
+
+@dataclass
+class CachedAnswer:
+    question: str
+    answer: str
+    resource_ids: List[int]
+    n_relevant: int
+    n_non_relevant: int
+    segment_answers: Dict[int, str] = field(default_factory=dict)
+    # The modes the answer was found with, it is only reused for the same ones
+    search_mode: Optional[str] = None
+    grading_mode: Optional[str] = None
+    similarity: float = 1.0
+
+    def to_metadata(self) -> dict:
+        return {"question": self.question,
+                "answer": self.answer,
+                "resource_ids": self.resource_ids,
+                "n_relevant": self.n_relevant,
+                "n_non_relevant": self.n_non_relevant,
+                # JSON object keys are strings
+                "segment_answers": {str(resource_id): answer for resource_id, answer in self.segment_answers.items()},
+                "search_mode": self.search_mode,
+                "grading_mode": self.grading_mode}
+
+    @classmethod
+    def from_metadata(cls, metadata: dict, similarity: float) -> "CachedAnswer":
+        return cls(question=metadata["question"],
+                   answer=metadata["answer"],
+                   resource_ids=[int(resource_id)
+                                 for resource_id in metadata["resource_ids"]],
+                   n_relevant=metadata["n_relevant"],
+                   n_non_relevant=metadata["n_non_relevant"],
+                   segment_answers={int(resource_id): answer for resource_id, answer in metadata.get(
+                       "segment_answers", {}).items()},
+                   search_mode=metadata.get("search_mode"),
+                   grading_mode=metadata.get("grading_mode"),
+                   similarity=similarity)
+
+
+class LocalSemanticCache:
+    """
+    Answers of past questions, looked up by the cosine similarity of the question
+    embeddings. The embeddings live in an in-process NumPy matrix; once
+    `max_size` questions are stored, the oldest ones are overwritten. Only the
+    answers whose fields equal the `metadata` of the lookup are considered.
+    """
+
+    def __init__(self, threshold: float = 0.9, max_size: int = 10000) -> None:
+        self.threshold = threshold
+        self.max_size = max_size
+        self._embeddings = None
+        self._entries = []
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def lookup(self, embedded_question: list, metadata: dict = None) -> Optional[CachedAnswer]:
+        with self._lock:
+            if not self._entries:
+                return None
+
+            query = np.array(embedded_question, dtype=np.float32)
+            query /= np.linalg.norm(query)
+            similarities = self._embeddings[:len(self._entries)] @ query
+            if metadata:
+                matches = np.array([all(getattr(entry, key) == value for key, value in metadata.items())
+                                    for entry in self._entries])
+                similarities = np.where(matches, similarities, -np.inf)
+            best = int(np.argmax(similarities))
+            if similarities[best] < self.threshold:
+                return None
+
+            entry = self._entries[best]
+            return CachedAnswer(**{**entry.__dict__, "similarity": float(similarities[best])})
+
+    def add(self, embedded_question: list, entry: CachedAnswer) -> None:
+        embedding = np.array(embedded_question, dtype=np.float32)
+        embedding /= np.linalg.norm(embedding)
+
+        with self._lock:
+            if self._embeddings is None:
+                self._embeddings = np.empty(
+                    (self.max_size, embedding.shape[0]), dtype=np.float32)
+
+            self._embeddings[self._next] = embedding
+            if self._next < len(self._entries):
+                self._entries[self._next] = entry
+            else:
+                self._entries.append(entry)
+            self._next = (self._next + 1) % self.max_size
+
+
+class VecsSemanticCache:
+    """
+    Answers of past questions in a separate vecs collection, so they are shared by
+    all processes. The answer and its resources are stored as the record metadata.
+    """
+
+    def __init__(self, db_connection: str, collection_name: str = "questions", threshold: float = 0.9) -> None:
+        self.db_connection = db_connection
+        self.collection_name = collection_name
+        self.threshold = threshold
+        self._collection = None
+        self._lock = threading.Lock()
+
+    def _get_collection(self, dimension: int) -> vecs.Collection:
+        if self._collection is None:
+            with self._lock:
+                if self._collection is None:
+                    vx = vecs.create_client(self.db_connection)
+                    self._collection = vx.get_or_create_collection(
+                        name=self.collection_name, dimension=dimension)
+        return self._collection
+
+    def lookup(self, embedded_question: list, metadata: dict = None) -> Optional[CachedAnswer]:
+        # Only the answers found with the same `metadata`, e.g. the search mode
+        conditions = [{key: {"$eq": value}}
+                      for key, value in (metadata or {}).items()]
+        if len(conditions) > 1:
+            filters = {"$and": conditions}
+        else:
+            filters = conditions[0] if conditions else {}
+
+        query_results = self._get_collection(len(embedded_question)).query(
+            data=embedded_question,
+            limit=1,
+            filters=filters,
+            measure="cosine_distance",
+            include_value=True,
+            include_metadata=True
+        )
+        if not query_results:
+            return None
+
+        _, distance, metadata = query_results[0]
+        similarity = 1 - distance
+        if similarity < self.threshold:
+            return None
+        return CachedAnswer.from_metadata(metadata, similarity)
+
+    def add(self, embedded_question: list, entry: CachedAnswer) -> None:
+        # The same question text and modes always map to the same record
+        record_id = hashlib.sha256(
+            f"{entry.question.strip().lower()}|{entry.search_mode}|{entry.grading_mode}".encode("utf-8")).hexdigest()
+        self._get_collection(len(embedded_question)).upsert(
+            records=[(record_id, embedded_question, entry.to_metadata())])
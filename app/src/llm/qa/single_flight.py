@@ -0,0 +1,94 @@
+import asyncio
+import re
+import threading
+
+from concurrent.futures import Future
+from typing import Awaitable, Callable, Hashable, Tuple
+
+from ...tracing import metrics
+
+metrics.describe("qa_single_flight_total",
+                 "Questions computed (leader) or joined in flight (follower)")
+
+
+def normalize_question(question: str) -> str:
+    # Case, spacing and the closing punctuation don't change the answer
+    return re.sub(r"\s+", " ", question).strip().rstrip("?!. ").casefold()
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls with the same key: the first caller (the leader)
+    computes the result and the callers arriving while it is in flight (the
+    followers) wait for it and share it, or its exception. A key is in flight
+    only until its result is known, so later calls compute again.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._flights = {}
+        self._async_flights = {}
+
+    def run(self, key: Hashable, function: Callable[[], object]) -> Tuple[object, bool]:
+        """
+        Returns the result of `function` and whether it was shared, i.e. computed
+        by another caller.
+        """
+        with self._lock:
+            future = self._flights.get(key)
+            leader = future is None
+            if leader:
+                future = self._flights[key] = Future()
+
+        if not leader:
+            metrics.increment("qa_single_flight_total", role="follower")
+            return future.result(), True
+
+        metrics.increment("qa_single_flight_total", role="leader")
+        try:
+            result = function()
+            future.set_result(result)
+            return result, False
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+
+    async def run_async(self, key: Hashable, function: Callable[[], Awaitable]) -> Tuple[object, bool]:
+        """
+        `run` for coroutines, coalescing the calls of the running event loop. If the
+        leader is cancelled, e.g. its client disconnected, one of the followers
+        computes the result instead.
+        """
+        loop = asyncio.get_running_loop()
+        key = (id(loop), key)
+        future = self._async_flights.get(key)
+
+        if future is not None:
+            metrics.increment("qa_single_flight_total", role="follower")
+            try:
+                # Cancelling a follower must not cancel the shared flight
+                return await asyncio.shield(future), True
+            except asyncio.CancelledError:
+                if not future.cancelled():
+                    raise
+            return await self.run_async(key[1], function)
+
+        future = self._async_flights[key] = loop.create_future()
+        # Without followers, nobody retrieves the exception
+        future.add_done_callback(lambda done: done.cancelled() or done.exception())
+        metrics.increment("qa_single_flight_total", role="leader")
+        try:
+            result = await function()
+            future.set_result(result)
+            return result, False
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            del self._async_flights[key]
@@ -0,0 +1,117 @@
+import os
+import time
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from loguru import logger
+from typing import Callable, Dict, Iterable, Tuple
+
+from .prompts.summary_template import SUMMARY_TEMPLATE
+
+
+def truncate_text_to_max_tokens(text: str, max_tokens: int = 4000, model_name: str = "gpt-3.5-turbo") -> str:
+    """
+    Truncates the text to at most `max_tokens` tokens of the model's encoding.
+    """
+    import tiktoken
+
+    encoding = tiktoken.encoding_for_model(model_name)
+    tokens = encoding.encode(text)
+    if len(tokens) <= max_tokens:
+        return text
+
+    logger.info(f"Text truncated, num tokens: {len(tokens)}")
+    return encoding.decode(tokens[:max_tokens])
+
+
+class SummaryEngine:
+    """
+    Summarizes transcript segments with the bullet point summary prompt. Many
+    segments are summarized at once, with at most `max_workers` LLM calls in
+    flight; a failed call is retried `max_retries` times with backoff.
+    """
+
+    def __init__(self,
+                 model_name: str = "gpt-3.5-turbo",
+                 temperature: float = 0,
+                 max_tokens: int = 4000,
+                 max_workers: int = 4,
+                 max_retries: int = 3,
+                 prompt_template: str = SUMMARY_TEMPLATE) -> None:
+        self.model_name = model_name
+        self.temperature = temperature
+        self.max_tokens = max_tokens
+        self.max_workers = max_workers
+        self.max_retries = max_retries
+        self.prompt_template = prompt_template
+        self._chain = None
+
+    def _get_chain(self):
+        if self._chain is None:
+            from langchain import LLMChain, PromptTemplate
+            from langchain.chat_models import ChatOpenAI
+
+            llm = ChatOpenAI(model_name=self.model_name,
+                             temperature=self.temperature)
+            prompt = PromptTemplate(
+                template=self.prompt_template, input_variables=["text"])
+            self._chain = LLMChain(llm=llm, prompt=prompt)
+        return self._chain
+
+    def summarize(self, text: str) -> str:
+        text = truncate_text_to_max_tokens(
+            text, self.max_tokens, self.model_name)
+        for attempt in range(self.max_retries + 1):
+            try:
+                return self._get_chain().run(text=text)
+            except Exception:
+                if attempt == self.max_retries:
+                    raise
+                logger.warning(
+                    f"Summary failed, retrying ({attempt + 1}/{self.max_retries})")
+                time.sleep(2 ** attempt)
+
+    def summarize_many(self,
+                       texts: Iterable[Tuple[str, str]],
+                       on_summary: Callable[[str, str], None] = None) -> Dict[str, str]:
+        """
+        Summarizes (key, text) pairs concurrently. `on_summary` is called with every
+        (key, summary) as soon as it is done, in the calling thread, so progress can
+        be checkpointed. Failed segments are logged and left out of the result.
+        """
+        summaries = {}
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = {executor.submit(self.summarize, text): key
+                       for key, text in texts}
+            for future in as_completed(futures):
+                key = futures[future]
+                try:
+                    summaries[key] = future.result()
+                except Exception:
+                    logger.exception(f"Failed to summarize: {key}")
+                    continue
+                if on_summary is not None:
+                    on_summary(key, summaries[key])
+        return summaries
+
+
+def summarize_files_from_directory(input_directory: str, output_directory: str, model_name: str = "gpt-3.5-turbo", max_workers: int = 4) -> None:
+    """
+    Summarizes every transcript file without a summary file yet into
+    "(Summary) <file name>", `max_workers` files at a time.
+    """
+    engine = SummaryEngine(model_name=model_name, max_workers=max_workers)
+
+    pending = []
+    for filename in os.listdir(input_directory):
+        save_path = os.path.join(output_directory, f'(Summary) {filename}')
+        if os.path.exists(save_path):
+            logger.info(f"{filename} already summarised!")
+            continue
+        with open(os.path.join(input_directory, filename)) as f:
+            pending.append((filename, f.read()))
+
+    def save_summary(filename, summary):
+        with open(os.path.join(output_directory, f'(Summary) {filename}'), "w") as f:
+            f.write(summary)
+
+    engine.summarize_many(pending, on_summary=save_summary)
@@ -0,0 +1,43 @@
+import functools
+
+from loguru import logger
+
+# Prompt and completion tokens the chat models take, by model name prefix (the
+# longest matching one applies)
+CONTEXT_WINDOWS = {"gpt-3.5-turbo": 4096,
+                   "gpt-3.5-turbo-16k": 16384,
+                   "gpt-4": 8192,
+                   "gpt-4-32k": 32768}
+DEFAULT_CONTEXT_WINDOW = 4096
+
+
+@functools.lru_cache(maxsize=None)
+def _encoding(model_name: str):
+    # tiktoken downloads the encoding on first use, so it can be unavailable
+    try:
+        import tiktoken
+
+        try:
+            return tiktoken.encoding_for_model(model_name)
+        except KeyError:
+            return tiktoken.get_encoding("cl100k_base")
+    except Exception:
+        logger.warning(
+            f"No tiktoken encoding for {model_name}, token counts are estimated")
+        return None
+
+
+def context_window(model_name: str) -> int:
+    prefixes = [prefix for prefix in CONTEXT_WINDOWS if model_name.startswith(prefix)]
+    return CONTEXT_WINDOWS[max(prefixes, key=len)] if prefixes else DEFAULT_CONTEXT_WINDOW
+
+
+def count_tokens(text: str, model_name: str = "gpt-3.5-turbo") -> int:
+    """
+    Number of tokens of the text in the model's encoding, or an estimate of 4
+    characters a token without the encoding.
+    """
+    encoding = _encoding(model_name)
+    if encoding is None:
+        return len(text) // 4 + 1
+    return len(encoding.encode(text, disallowed_special=()))
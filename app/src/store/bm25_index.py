@@ -0,0 +1,160 @@
+import math
+import re
+import numpy as np
+
+from collections import Counter, defaultdict
+from pathlib import Path
+from typing import Dict, Iterable, List, Tuple
+
+from ..db.models import ResourcesHubermanLab
+
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+")
+STOPWORDS = {
+    "a", "an", "and", "are", "as", "at", "be", "by", "can", "do", "does", "for", "from", "how", "i", "in",
+    "is", "it", "its", "me", "my", "of", "on", "or", "our", "that", "the", "their", "this", "to", "was",
+    "what", "when", "which", "who", "why", "with", "you", "your"
+}
+
+
+def tokenize(text: str) -> List[str]:
+    return [token for token in TOKEN_PATTERN.findall(str(text).lower()) if token not in STOPWORDS]
+
+
+def load_segment_keywords(df_summary_path: Path) -> Dict[Tuple[str, str], str]:
+    """
+    Returns the keywords and ChatGPT labels of every segment in the summary CSV,
+    keyed by (episode name, segment name). Missing keywords and labels are left
+    out, and so are the segments that have neither.
+    """
+    import pandas as pd
+
+    df_summary = pd.read_csv(df_summary_path)
+    keywords = {}
+    for row in df_summary.itertuples():
+        text = " ".join(str(value) for value in (row.keywords, row.chatgpt_labels)
+                        if not pd.isna(value))
+        if text:
+            keywords[(row.episode_name, row.segment_name)] = text
+    return keywords
+
+
+class BM25Index:
+    """
+    Okapi BM25 over an inverted index of segment texts (title, summary, topic and
+    keywords). The per-posting BM25 weights are computed once at build time, so a
+    search is a sum over the postings of the query terms.
+    """
+
+    def __init__(self, ids: Iterable[int], texts: Iterable[str], metadata: List[dict] = None, k1: float = 1.5, b: float = 0.75) -> None:
+        self.ids = np.asarray(list(ids), dtype=np.int64)
+        self.metadata = metadata if metadata is not None else [
+            {} for _ in range(len(self.ids))]
+        documents = [Counter(tokenize(text)) for text in texts]
+        n_documents = len(documents)
+        document_lengths = np.array(
+            [sum(document.values()) for document in documents], dtype=np.float32)
+        average_length = float(document_lengths.mean()) if n_documents else 0.0
+
+        postings = defaultdict(list)
+        for row, document in enumerate(documents):
+            for term, term_frequency in document.items():
+                postings[term].append((row, term_frequency))
+
+        self.postings = {}
+        for term, term_postings in postings.items():
+            rows = np.array([row for row, _ in term_postings], dtype=np.int64)
+            term_frequencies = np.array(
+                [term_frequency for _, term_frequency in term_postings], dtype=np.float32)
+            idf = math.log(1 + (n_documents - len(rows) + 0.5) / (len(rows) + 0.5))
+            normalization = k1 * (1 - b + b *
+                                  document_lengths[rows] / average_length)
+            weights = idf * term_frequencies * \
+                (k1 + 1) / (term_frequencies + normalization)
+            self.postings[term] = (rows, weights.astype(np.float32))
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    @classmethod
+    def from_resources(cls, resources: Iterable[ResourcesHubermanLab], keywords: Dict[Tuple[str, str], str] = None) -> "BM25Index":
+        resources = list(resources)
+        keywords = keywords or {}
+        texts = [" ".join([resource.segment_title or "", resource.summary or "", resource.topic or "",
+                           keywords.get((resource.episode_name, resource.segment_title), "")])
+                 for resource in resources]
+        metadata = [{"topic": resource.topic, "episode_name": resource.episode_name}
+                    for resource in resources]
+        return cls([resource.id for resource in resources], texts, metadata)
+
+    @classmethod
+    def from_summary_csv(cls, df_summary_path: Path) -> "BM25Index":
+        """
+        Builds the index with the CSV row numbers as ids, like LocalResourceStore.
+        """
+        import pandas as pd
+
+        df_summary = pd.read_csv(df_summary_path)
+        texts = (df_summary["segment_name"].fillna("") + " " + df_summary["summary"].fillna("") + " " +
+                 df_summary["chatgpt_labels"].fillna("") + " " + df_summary["keywords"].fillna(""))
+        metadata = [{"topic": topic, "episode_name": episode_name}
+                    for topic, episode_name in zip(df_summary["chatgpt_labels"], df_summary["episode_name"])]
+        return cls(df_summary.index, texts, metadata)
+
+    def _filter_mask(self, filters: dict) -> np.ndarray:
+        filters = {key: value for key, value in filters.items()
+                   if value is not None}
+        return np.array([all(metadata.get(key) == value for key, value in filters.items())
+                         for metadata in self.metadata], dtype=bool)
+
+    def search(self, query: str, limit: int, filters: dict = None) -> Dict[int, float]:
+        """
+        Returns segment ids with BM25 scores, sorted in a descending order.
+        Segments that share no term with the query are left out, and so are the
+        ones whose metadata doesn't equal the (not None) `filters` values.
+        """
+        scores = np.zeros(len(self.ids), dtype=np.float32)
+        for term in tokenize(query):
+            if term in self.postings:
+                rows, weights = self.postings[term]
+                scores[rows] += weights
+
+        if filters and any(value is not None for value in filters.values()):
+            scores[~self._filter_mask(filters)] = 0
+
+        matching = np.flatnonzero(scores)
+        if len(matching) == 0:
+            return {}
+
+        limit = min(limit, len(matching))
+        top = matching[np.argpartition(-scores[matching], limit - 1)[:limit]]
+        top = top[np.argsort(-scores[top])]
+        return {int(self.ids[row]): float(scores[row]) for row in top}
+
+
+def fuse_rankings(vector_hits: Dict[int, float],
+                  lexical_hits: Dict[int, float],
+                  method: str = "rrf",
+                  rrf_k: int = 60,
+                  vector_weight: float = 0.5) -> List[int]:
+    """
+    Fuses two rankings into one list of segment ids, best first. "rrf" is
+    reciprocal-rank fusion; "weighted" mixes the min-max normalized scores with
+    `vector_weight` for the cosine similarities.
+    """
+    fused = defaultdict(float)
+    if method == "rrf":
+        for hits, weight in ((vector_hits, vector_weight), (lexical_hits, 1 - vector_weight)):
+            for rank, resource_id in enumerate(hits, 1):
+                fused[resource_id] += 2 * weight / (rrf_k + rank)
+    elif method == "weighted":
+        for hits, weight in ((vector_hits, vector_weight), (lexical_hits, 1 - vector_weight)):
+            if not hits:
+                continue
+            low, high = min(hits.values()), max(hits.values())
+            for resource_id, score in hits.items():
+                fused[resource_id] += weight * \
+                    ((score - low) / (high - low) if high > low else 1.0)
+    else:
+        raise NotImplementedError(f"Unsupported fusion method: {method}")
+
+    return sorted(fused, key=fused.get, reverse=True)
@@ -0,0 +1,42 @@
+import numpy as np
+
+
+def _normalized(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.where(norms > 0, norms, 1)
+
+
+def maximal_marginal_relevance(query: np.ndarray,
+                               embeddings: np.ndarray,
+                               lambda_mult: float = 0.7,
+                               duplicate_similarity: float = None) -> np.ndarray:
+    """
+    Orders the candidate `embeddings` by maximal marginal relevance: every pick
+    maximizes `lambda_mult` * its cosine similarity to the query minus
+    (1 - `lambda_mult`) * its largest similarity to the candidates picked before.
+    Candidates at least `duplicate_similarity` similar to a picked one are
+    dropped. Returns the picked rows, in the picked order.
+    """
+    if len(embeddings) == 0:
+        return np.array([], dtype=np.int64)
+
+    embeddings = _normalized(np.asarray(embeddings, dtype=np.float32))
+    relevance = embeddings @ _normalized(np.asarray(query, dtype=np.float32))
+    pairwise = embeddings @ embeddings.T
+
+    picked = [int(np.argmax(relevance))]
+    available = np.ones(len(embeddings), dtype=bool)
+    available[picked[0]] = False
+    redundancy = pairwise[picked[0]].copy()
+    while True:
+        if duplicate_similarity is not None:
+            available &= redundancy < duplicate_similarity
+        if not available.any():
+            break
+        scores = np.where(available, lambda_mult * relevance -
+                          (1 - lambda_mult) * redundancy, -np.inf)
+        row = int(np.argmax(scores))
+        picked.append(row)
+        available[row] = False
+        redundancy = np.maximum(redundancy, pairwise[row])
+    return np.array(picked, dtype=np.int64)
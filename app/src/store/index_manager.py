@@ -0,0 +1,384 @@
+"""
+Maintains the vector collection and its ANN index:
+
+    python -m app.src.store.index_manager status
+    python -m app.src.store.index_manager build --method hnsw --m 16 --ef-construction 64
+    python -m app.src.store.index_manager reindex --method ivfflat --lists 100
+    python -m app.src.store.index_manager tune --target-recall 0.95 --max-latency-ms 20
+"""
+import argparse
+import json
+import math
+import os
+import re
+import time
+import numpy as np
+
+from dataclasses import asdict, dataclass
+from loguru import logger
+from pathlib import Path
+from sqlalchemy import text
+from sqlalchemy.engine import Engine
+from typing import Iterable, List, Optional, Sequence, Tuple
+
+from .pgvector_search import SET_SEARCH_SETTING_SQL, batch_search_sql, format_vector, search_settings_params
+from ..constants import VECTOR_SEARCH_SETTINGS_PATH
+
+METHODS = ("hnsw", "ivfflat")
+# Operator classes of the vecs measures
+OPERATOR_CLASSES = {"cosine_distance": "vector_cosine_ops",
+                    "l2_distance": "vector_l2_ops",
+                    "max_inner_product": "vector_ip_ops"}
+# The query-time setting of every index method and the values tried when tuning
+SEARCH_SETTING = {"hnsw": "hnsw.ef_search", "ivfflat": "ivfflat.probes"}
+SEARCH_SETTING_CANDIDATES = {"hnsw": [10, 20, 40, 64, 100, 160, 250, 400],
+                             "ivfflat": [1, 2, 4, 8, 16, 32, 64, 128, 256]}
+
+
+@dataclass
+class SearchSettings:
+    """
+    The query-time setting chosen by `VectorIndexManager.tune`, with the recall
+    and latency it measured.
+    """
+    name: str
+    value: int
+    recall: float
+    p95_latency_ms: float
+
+    def as_settings(self) -> dict:
+        return {self.name: self.value}
+
+    def save(self, path: Path = VECTOR_SEARCH_SETTINGS_PATH) -> None:
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(path, "w") as f:
+            json.dump(asdict(self), f, indent=1)
+
+
+def load_search_settings(path: Path = VECTOR_SEARCH_SETTINGS_PATH) -> Optional[dict]:
+    """
+    The tuned search settings, e.g. {"hnsw.ef_search": 64}, or None before tuning.
+    """
+    if not Path(path).exists():
+        return None
+    with open(path) as f:
+        return SearchSettings(**json.load(f)).as_settings()
+
+
+def default_lists(n_rows: int) -> int:
+    # pgvector's guideline: rows / 1000 up to 1M rows, sqrt(rows) beyond
+    if n_rows <= 1_000_000:
+        return max(n_rows // 1000, 10)
+    return int(math.sqrt(n_rows))
+
+
+class VectorIndexManager:
+    """
+    Batched upserts into a vecs collection table and the lifecycle of its ANN
+    index (HNSW or IVFFlat). The index is always named "<collection>_<method>_idx",
+    so a rebuild with other parameters replaces it: `reindex` builds the new index
+    with CREATE INDEX CONCURRENTLY next to the old one, which serves the queries
+    until the new one is swapped in.
+    """
+
+    def __init__(self, engine: Engine, collection_name: str = "docs", schema: str = "vecs",
+                 measure: str = "cosine_distance") -> None:
+        self.engine = engine
+        self.collection_name = collection_name
+        self.schema = schema
+        self.measure = measure
+
+    @property
+    def table(self) -> str:
+        return f'"{self.schema}"."{self.collection_name}"'
+
+    def index_name(self, method: str) -> str:
+        return f"{self.collection_name}_{method}_idx"
+
+    def count(self) -> int:
+        with self.engine.connect() as connection:
+            return connection.execute(text(f"SELECT count(*) FROM {self.table}")).scalar()
+
+    def upsert(self, records: Iterable[Tuple[str, list, dict]], batch_size: int = 500) -> int:
+        """
+        Inserts or updates (id, vector, metadata) records, `batch_size` records per
+        round trip and transaction. Returns the number of records.
+        """
+        statement = text(f"""
+            INSERT INTO {self.table} (id, vec, metadata)
+            VALUES (:id, CAST(:vec AS vector), CAST(:metadata AS jsonb))
+            ON CONFLICT (id) DO UPDATE SET vec = EXCLUDED.vec, metadata = EXCLUDED.metadata
+        """)
+
+        n_upserted = 0
+        batch = []
+        for record_id, vec, metadata in records:
+            batch.append({"id": str(record_id),
+                          "vec": format_vector(vec),
+                          "metadata": json.dumps(metadata or {})})
+            if len(batch) == batch_size:
+                n_upserted += self._execute_batch(statement, batch)
+                batch = []
+        if batch:
+            n_upserted += self._execute_batch(statement, batch)
+        return n_upserted
+
+    def _execute_batch(self, statement, batch: List[dict]) -> int:
+        with self.engine.begin() as connection:
+            connection.execute(statement, batch)
+        return len(batch)
+
+    def indexes(self) -> List[dict]:
+        """
+        The ANN indexes of the table, with their method and definition.
+        """
+        with self.engine.connect() as connection:
+            rows = connection.execute(text("""
+                SELECT indexname, indexdef FROM pg_indexes
+                WHERE schemaname = :schema AND tablename = :table
+            """), {"schema": self.schema, "table": self.collection_name}).all()
+
+        indexes = []
+        for name, definition in rows:
+            method = re.search(r"USING (\w+)", definition, re.IGNORECASE)
+            if method is not None and method.group(1).lower() in METHODS:
+                indexes.append({"name": name, "method": method.group(1).lower(),
+                                "definition": definition})
+        return indexes
+
+    def current_method(self) -> Optional[str]:
+        indexes = self.indexes()
+        return indexes[0]["method"] if indexes else None
+
+    def _create_index_sql(self, name: str, method: str, m: int, ef_construction: int, lists: int,
+                          concurrently: bool) -> str:
+        if method not in METHODS:
+            raise ValueError(f"Unknown index method: {method}")
+        if method == "hnsw":
+            options = f"m = {int(m)}, ef_construction = {int(ef_construction)}"
+        else:
+            options = f"lists = {int(lists)}"
+        return (f'CREATE INDEX {"CONCURRENTLY " if concurrently else ""}"{name}" ON {self.table} '
+                f'USING {method} (vec {OPERATOR_CLASSES[self.measure]}) WITH ({options})')
+
+    def _autocommit(self):
+        # CREATE/DROP INDEX CONCURRENTLY can't run inside a transaction
+        return self.engine.connect().execution_options(isolation_level="AUTOCOMMIT")
+
+    def build_index(self,
+                    method: str = "hnsw",
+                    m: int = 16,
+                    ef_construction: int = 64,
+                    lists: int = None,
+                    maintenance_work_mem: str = None) -> str:
+        """
+        Builds the index if the table has none yet; an existing index is replaced
+        with `reindex`. IVFFlat clusters the rows it is built on, so it is built
+        after the initial load, with `lists` derived from the row count by default.
+        """
+        existing = self.indexes()
+        if existing:
+            logger.info(
+                f"{self.table} already has an index: {existing[0]['name']}")
+            return existing[0]["name"]
+
+        return self._build(self.index_name(method), method, m, ef_construction, lists,
+                           maintenance_work_mem, concurrently=False)
+
+    def reindex(self,
+                method: str = "hnsw",
+                m: int = 16,
+                ef_construction: int = 64,
+                lists: int = None,
+                maintenance_work_mem: str = None) -> str:
+        """
+        Rebuilds the index online: the new index is built concurrently under a
+        temporary name, so reads and writes continue on the old one, then the old
+        indexes are dropped concurrently and the new one takes the regular name.
+        """
+        old_indexes = self.indexes()
+        name = self.index_name(method)
+        building_name = f"{name}_rebuild"
+
+        with self._autocommit() as connection:
+            # A failed concurrent build leaves an invalid index behind
+            connection.execute(text(f'DROP INDEX CONCURRENTLY IF EXISTS "{self.schema}"."{building_name}"'))
+
+        self._build(building_name, method, m, ef_construction, lists,
+                    maintenance_work_mem, concurrently=True)
+
+        with self._autocommit() as connection:
+            for index in old_indexes:
+                connection.execute(text(f'DROP INDEX CONCURRENTLY IF EXISTS "{self.schema}"."{index["name"]}"'))
+            connection.execute(text(f'ALTER INDEX "{self.schema}"."{building_name}" RENAME TO "{name}"'))
+        logger.info(f"Swapped in {name}")
+        return name
+
+    def _build(self, name: str, method: str, m: int, ef_construction: int, lists: int,
+               maintenance_work_mem: str, concurrently: bool) -> str:
+        if method == "ivfflat" and lists is None:
+            lists = default_lists(self.count())
+
+        sql = self._create_index_sql(
+            name, method, m, ef_construction, lists, concurrently)
+        logger.info(f"Building index: {sql}")
+        start_time = time.time()
+        with self._autocommit() as connection:
+            if maintenance_work_mem is not None:
+                connection.execute(text("SELECT set_config('maintenance_work_mem', :value, false)"),
+                                   {"value": maintenance_work_mem})
+            connection.execute(text(sql))
+        logger.info(f"Index build time: {round(time.time()-start_time, 2)}")
+        return name
+
+    def sample_vectors(self, n: int, collection_name: str = None) -> List[list]:
+        """
+        Random stored vectors, e.g. of the cached questions, as tuning queries.
+        """
+        table = f'"{self.schema}"."{collection_name or self.collection_name}"'
+        with self.engine.connect() as connection:
+            rows = connection.execute(text(f"SELECT vec::text FROM {table} ORDER BY random() LIMIT :n"),
+                                      {"n": n}).scalars().all()
+        return [json.loads(row) for row in rows]
+
+    def _search(self, queries: Sequence[list], k: int, settings: dict = None, exact: bool = False) -> Tuple[List[set], List[float]]:
+        """
+        Runs every query in its own transaction, with the given search settings, or
+        as a sequential scan when `exact`. Returns the ids found and the latencies.
+        """
+        statement = batch_search_sql(self.collection_name, schema=self.schema)
+        found, latencies = [], []
+        for query in queries:
+            with self.engine.begin() as connection:
+                if exact:
+                    for name in ("enable_indexscan", "enable_bitmapscan"):
+                        connection.execute(SET_SEARCH_SETTING_SQL, {"name": name, "value": "off"})
+                for params in search_settings_params(settings or {}):
+                    connection.execute(SET_SEARCH_SETTING_SQL, params)
+
+                start_time = time.perf_counter()
+                rows = connection.execute(statement, {"queries": [format_vector(query)],
+                                                      "limit": k, "metadata": "{}"}).all()
+                latencies.append((time.perf_counter() - start_time) * 1000)
+            found.append({row[1] for row in rows})
+        return found, latencies
+
+    def tune(self,
+             queries: Sequence[list],
+             k: int = 20,
+             target_recall: float = 0.95,
+             max_latency_ms: float = None) -> SearchSettings:
+        """
+        Measures recall@k (against an exact scan) and p95 latency of the query
+        setting of the current index for increasing values, and returns the first
+        value that reaches `target_recall`. If none does within `max_latency_ms`,
+        the value with the best recall within the budget is returned.
+        """
+        method = self.current_method()
+        if method is None:
+            raise ValueError(f"{self.table} has no ANN index to tune")
+
+        exact, _ = self._search(queries, k, exact=True)
+        name = SEARCH_SETTING[method]
+        candidates = SEARCH_SETTING_CANDIDATES[method]
+        if method == "ivfflat":
+            # More probes than lists don't change the result
+            lists = self._index_lists()
+            if lists is not None:
+                candidates = [value for value in candidates
+                              if value < lists] + [lists]
+
+        best = None
+        for value in candidates:
+            found, latencies = self._search(queries, k, settings={name: value})
+            recall = float(np.mean([len(hits & truth) / max(len(truth), 1)
+                                    for hits, truth in zip(found, exact)]))
+            settings = SearchSettings(name, value, round(recall, 4),
+                                      round(float(np.percentile(latencies, 95)), 2))
+            logger.info(f"{name}={value}: recall@{k} {settings.recall}, p95 {settings.p95_latency_ms} ms")
+
+            if max_latency_ms is not None and settings.p95_latency_ms > max_latency_ms:
+                break
+            if best is None or settings.recall > best.recall:
+                best = settings
+            if settings.recall >= target_recall:
+                break
+
+        if best is None:
+            raise ValueError(
+                f"No {name} value is within {max_latency_ms} ms")
+        if best.recall < target_recall:
+            logger.warning(
+                f"Recall target {target_recall} not reached, best: {best.recall} at {name}={best.value}")
+        return best
+
+    def _index_lists(self) -> Optional[int]:
+        for index in self.indexes():
+            lists = re.search(r"lists\s*=\s*'?(\d+)", index["definition"])
+            if index["method"] == "ivfflat" and lists is not None:
+                return int(lists.group(1))
+        return None
+
+
+def main():
+    from dotenv import load_dotenv
+    from sqlalchemy import create_engine
+
+    parser = argparse.ArgumentParser(
+        description="Builds, rebuilds and tunes the ANN index of a vecs collection.")
+    parser.add_argument('command', choices=["status", "build", "reindex", "tune"])
+    parser.add_argument('--collection', default="docs",
+                        help='vecs collection. Default: docs.')
+    parser.add_argument('--method', default="hnsw", choices=METHODS,
+                        help='Index method. Default: hnsw.')
+    parser.add_argument('--m', type=int, default=16,
+                        help='HNSW: links per node. Default: 16.')
+    parser.add_argument('--ef-construction', type=int, default=64,
+                        help='HNSW: candidate list size while building. Default: 64.')
+    parser.add_argument('--lists', type=int, default=None,
+                        help='IVFFlat: number of lists. Default: derived from the row count.')
+    parser.add_argument('--maintenance-work-mem', default=None,
+                        help='Memory for the index build, e.g. 1GB.')
+    parser.add_argument('--target-recall', type=float, default=0.95,
+                        help='Tune: recall@k to reach. Default: 0.95.')
+    parser.add_argument('--max-latency-ms', type=float, default=None,
+                        help='Tune: p95 latency budget per query.')
+    parser.add_argument('--k', type=int, default=20,
+                        help='Tune: number of neighbours the recall is measured at. Default: 20.')
+    parser.add_argument('--n-queries', type=int, default=100,
+                        help='Tune: number of sampled queries. Default: 100.')
+    parser.add_argument('--queries-from', default="questions",
+                        help='Tune: collection the queries are sampled from (the semantic cache '
+                             'of asked questions); the searched collection if it is empty.')
+    parser.add_argument('--settings-path', type=Path, default=VECTOR_SEARCH_SETTINGS_PATH,
+                        help='Tune: file the chosen setting is saved to, read by the API.')
+    args = parser.parse_args()
+
+    load_dotenv()
+    DB_CONNECTION = f"postgresql://postgres:{os.environ['POSTGRES_DB_PASS']}@{os.environ['POSTGRES_DB_HOST']}:5432/postgres"
+    manager = VectorIndexManager(create_engine(DB_CONNECTION), args.collection)
+
+    if args.command == "status":
+        logger.info(f"{manager.table}: {manager.count()} rows")
+        for index in manager.indexes():
+            logger.info(index["definition"])
+    elif args.command in ("build", "reindex"):
+        build = manager.build_index if args.command == "build" else manager.reindex
+        build(method=args.method, m=args.m, ef_construction=args.ef_construction,
+              lists=args.lists, maintenance_work_mem=args.maintenance_work_mem)
+    else:
+        try:
+            queries = manager.sample_vectors(args.n_queries, args.queries_from)
+        except Exception:
+            queries = []
+        if len(queries) < args.n_queries:
+            queries += manager.sample_vectors(args.n_queries - len(queries))
+        settings = manager.tune(queries, k=args.k, target_recall=args.target_recall,
+                                max_latency_ms=args.max_latency_ms)
+        settings.save(args.settings_path)
+        logger.info(f"Saved {settings} to {args.settings_path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,233 @@
+import json
+import numpy as np
+
+from pathlib import Path
+from typing import List, Optional
+
+from .quantized_embeddings import QuantizedEmbeddings
+
+
+class LocalVectorStore:
+    """
+    In-process stand-in for a vecs collection. The L2-normalized embeddings are
+    kept as a memory-mapped float32 or float16 `.npy` matrix and searched with an
+    exact, vectorised dot-product top-k (or a FAISS flat index when available).
+    `query` has the same signature and return format as `vecs.Collection.query`.
+
+    With a quantized copy of the embeddings, the search is two-stage: the compact
+    codes are scanned for `rescore_factor * limit` candidates, which are then
+    re-scored exactly against the full-precision matrix, of which only the
+    candidate rows are read.
+    """
+
+    EMBEDDINGS_FILE = "embeddings.npy"
+    IDS_FILE = "ids.npy"
+    METADATA_FILE = "metadata.json"
+    QUANTIZED_FILE = "embeddings.qvec"
+
+    def __init__(self,
+                 ids: np.ndarray,
+                 embeddings: np.ndarray,
+                 metadata: Optional[List[dict]] = None,
+                 use_faiss: bool = False,
+                 block_size: int = 65536,
+                 quantized: QuantizedEmbeddings = None,
+                 rescore_factor: int = None) -> None:
+        self.ids = np.asarray(ids, dtype=np.int64)
+        self.embeddings = embeddings
+        self.metadata = metadata if metadata is not None else [
+            {} for _ in range(len(self.ids))]
+        self.dimension = embeddings.shape[1]
+        self.block_size = block_size
+        self.quantized = quantized
+        # Product quantization is coarser, so more of its candidates are re-scored
+        if rescore_factor is None:
+            rescore_factor = 16 if quantized is not None and quantized.kind == "pq" else 4
+        self.rescore_factor = rescore_factor
+        # Rows matching a filter, e.g. one topic, are computed once per filter
+        self._partitions = {}
+        # Row of every id, built on the first fetch
+        self._rows = None
+
+        self.faiss_index = None
+        if use_faiss:
+            import faiss
+            self.faiss_index = faiss.IndexFlatIP(self.dimension)
+            self.faiss_index.add(np.ascontiguousarray(
+                embeddings, dtype=np.float32))
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    @classmethod
+    def build(cls,
+              path: Path,
+              ids: List[int],
+              embeddings: np.ndarray,
+              metadata: Optional[List[dict]] = None,
+              dtype: str = "float32",
+              quantization: str = None,
+              n_subspaces: int = 48) -> "LocalVectorStore":
+        path = Path(path)
+        path.mkdir(parents=True, exist_ok=True)
+
+        embeddings = np.array(embeddings, dtype=np.float32)
+        embeddings /= np.linalg.norm(embeddings, axis=1, keepdims=True)
+
+        np.save(path / cls.EMBEDDINGS_FILE, embeddings.astype(dtype))
+        np.save(path / cls.IDS_FILE, np.asarray(ids, dtype=np.int64))
+        with open(path / cls.METADATA_FILE, "w") as f:
+            json.dump(metadata if metadata is not None else [
+                      {} for _ in ids], f)
+
+        quantized_path = path / cls.QUANTIZED_FILE
+        if quantization is not None:
+            QuantizedEmbeddings.quantize(
+                embeddings, quantization, n_subspaces=n_subspaces).save(quantized_path)
+        elif quantized_path.exists():
+            # A stale quantized copy of the previous embeddings
+            quantized_path.unlink()
+
+        return cls.load(path)
+
+    @classmethod
+    def load(cls, path: Path, use_faiss: bool = False, use_quantized: bool = True, rescore_factor: int = None) -> "LocalVectorStore":
+        path = Path(path)
+        embeddings = np.load(path / cls.EMBEDDINGS_FILE, mmap_mode="r")
+        ids = np.load(path / cls.IDS_FILE)
+        metadata = None
+        if (path / cls.METADATA_FILE).exists():
+            with open(path / cls.METADATA_FILE) as f:
+                metadata = json.load(f)
+        quantized = None
+        if use_quantized and (path / cls.QUANTIZED_FILE).exists():
+            quantized = QuantizedEmbeddings.load(path / cls.QUANTIZED_FILE)
+        return cls(ids, embeddings, metadata, use_faiss=use_faiss, quantized=quantized, rescore_factor=rescore_factor)
+
+    def _matches(self, metadata: dict, filters: dict) -> bool:
+        for key, condition in filters.items():
+            if key == "$and":
+                if not all(self._matches(metadata, sub_filter) for sub_filter in condition):
+                    return False
+            elif key == "$or":
+                if not any(self._matches(metadata, sub_filter) for sub_filter in condition):
+                    return False
+            else:
+                ((operator, value),) = condition.items()
+                if operator == "$eq" and metadata.get(key) != value:
+                    return False
+                elif operator == "$ne" and metadata.get(key) == value:
+                    return False
+                elif operator == "$in" and metadata.get(key) not in value:
+                    return False
+                elif operator not in ("$eq", "$ne", "$in"):
+                    raise NotImplementedError(
+                        f"Unsupported filter operator: {operator}")
+        return True
+
+    def _candidate_rows(self, filters: dict) -> Optional[np.ndarray]:
+        if not filters:
+            return None
+
+        key = json.dumps(filters, sort_keys=True)
+        if key not in self._partitions:
+            self._partitions[key] = np.array([row for row, metadata in enumerate(
+                self.metadata) if self._matches(metadata, filters)], dtype=np.int64)
+        return self._partitions[key]
+
+    def _scores(self, query: np.ndarray, rows: Optional[np.ndarray]) -> np.ndarray:
+        if rows is not None:
+            return np.asarray(self.embeddings[rows], dtype=np.float32) @ query
+
+        # Scoring in blocks keeps float16 matrices from being upcast as a whole
+        scores = np.empty(len(self.ids), dtype=np.float32)
+        for start in range(0, len(self.ids), self.block_size):
+            block = np.asarray(
+                self.embeddings[start:start+self.block_size], dtype=np.float32)
+            scores[start:start+len(block)] = block @ query
+        return scores
+
+    def search(self, query: list, limit: int, filters: dict = None):
+        """
+        Returns the rows and cosine similarities of the `limit` nearest
+        embeddings, sorted in a descending order.
+        """
+        query = np.array(query, dtype=np.float32)
+        query /= np.linalg.norm(query)
+
+        rows = self._candidate_rows(filters)
+        if self.faiss_index is not None and rows is None:
+            similarities, found_rows = self.faiss_index.search(
+                query[None, :], min(limit, len(self.ids)))
+            return found_rows[0], similarities[0]
+
+        if self.quantized is not None:
+            return self._search_quantized(query, limit, rows)
+
+        scores = self._scores(query, rows)
+        limit = min(limit, len(scores))
+        if limit == 0:
+            return np.array([], dtype=np.int64), np.array([], dtype=np.float32)
+
+        top = np.argpartition(-scores, limit - 1)[:limit]
+        top = top[np.argsort(-scores[top])]
+        found_rows = rows[top] if rows is not None else top
+        return found_rows, scores[top]
+
+    def _search_quantized(self, query: np.ndarray, limit: int, rows: Optional[np.ndarray]):
+        # First stage: approximate scores from the compact codes
+        approximate_scores = self.quantized.scores(query, rows)
+        n_candidates = min(limit * self.rescore_factor, len(approximate_scores))
+        if n_candidates == 0 or limit == 0:
+            return np.array([], dtype=np.int64), np.array([], dtype=np.float32)
+
+        candidates = np.argpartition(-approximate_scores,
+                                     n_candidates - 1)[:n_candidates]
+        candidate_rows = rows[candidates] if rows is not None else candidates
+
+        # Second stage: exact scores of the candidates, read in row order
+        candidate_rows = np.sort(candidate_rows)
+        scores = np.asarray(
+            self.embeddings[candidate_rows], dtype=np.float32) @ query
+
+        limit = min(limit, len(scores))
+        top = np.argpartition(-scores, limit - 1)[:limit]
+        top = top[np.argsort(-scores[top])]
+        return candidate_rows[top], scores[top]
+
+    def fetch(self, ids: List[str]):
+        """
+        The (id, embedding, metadata) records of `ids`, like `vecs.Collection.fetch`.
+        Unknown ids are skipped.
+        """
+        if self._rows is None:
+            self._rows = {int(id_): row for row, id_ in enumerate(self.ids)}
+        rows = [self._rows[int(id_)] for id_ in ids if int(id_) in self._rows]
+        return [(str(self.ids[row]), np.asarray(self.embeddings[row], dtype=np.float32), self.metadata[row])
+                for row in rows]
+
+    def query(self,
+              data: list,
+              limit: int = 10,
+              filters: dict = None,
+              measure: str = "cosine_distance",
+              include_value: bool = False,
+              include_metadata: bool = False):
+        found_rows, similarities = self.search(data, limit, filters)
+
+        if measure == "cosine_distance":
+            values = 1 - similarities
+        elif measure == "max_inner_product":
+            values = -similarities
+        else:
+            raise NotImplementedError(f"Unsupported measure: {measure}")
+
+        results = []
+        for row, value in zip(found_rows, values):
+            result = (str(self.ids[row]),)
+            if include_value:
+                result += (float(value),)
+            if include_metadata:
+                result += (self.metadata[row],)
+            results.append(result if len(result) > 1 else result[0])
+        return results
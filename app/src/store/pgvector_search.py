@@ -0,0 +1,80 @@
+from sqlalchemy import text
+from typing import Dict, List
+
+# Query-time settings of the ANN indexes, e.g. {"hnsw.ef_search": 80}
+SEARCH_SETTINGS = ("hnsw.ef_search", "ivfflat.probes")
+# The probes vecs sets for its queries, so the SQL searches match them before
+# tuning. The HNSW ef_search keeps the pgvector default (40), like in vecs.
+DEFAULT_SEARCH_SETTINGS = {"ivfflat.probes": 10}
+SET_SEARCH_SETTING_SQL = text("SELECT set_config(:name, :value, true)")
+
+
+def format_vector(vector: list) -> str:
+    """
+    pgvector text representation of a vector, e.g. "[0.1,0.2,0.3]".
+    """
+    return "[" + ",".join(str(float(value)) for value in vector) + "]"
+
+
+def batch_search_sql(collection_name: str, filtered: bool = False, schema: str = "vecs"):
+    """
+    Nearest neighbours (cosine distance) of several query vectors against a vecs
+    collection table in one statement: the query vectors are unnested and every
+    one of them is searched in a LATERAL subquery, which can use the vector index.
+    Parameters: `queries` (pgvector text representations), `limit` and, when
+    `filtered`, `metadata` (a JSON object the record metadata must contain).
+    """
+    where = "WHERE docs.metadata @> CAST(:metadata AS jsonb)" if filtered else ""
+    return text(f"""
+        SELECT q.ord - 1 AS query_index, d.id, d.distance
+        FROM unnest(CAST(:queries AS text[])) WITH ORDINALITY AS q(vec, ord)
+        CROSS JOIN LATERAL (
+            SELECT docs.id, docs.vec <=> CAST(q.vec AS vector) AS distance
+            FROM "{schema}"."{collection_name}" AS docs
+            {where}
+            ORDER BY docs.vec <=> CAST(q.vec AS vector)
+            LIMIT :limit
+        ) AS d
+        ORDER BY q.ord, d.distance
+    """)
+
+
+def fetch_vectors_sql(collection_name: str, schema: str = "vecs"):
+    """
+    The stored vectors of the records with the ids `ids` (a list of strings), as
+    (id, pgvector text representation) rows.
+    """
+    return text(f"""
+        SELECT docs.id, CAST(docs.vec AS text)
+        FROM "{schema}"."{collection_name}" AS docs
+        WHERE docs.id = ANY(CAST(:ids AS text[]))
+    """)
+
+
+def parse_vector(value: str) -> List[float]:
+    """
+    The inverse of `format_vector`.
+    """
+    return [float(component) for component in value.strip("[]").split(",")]
+
+
+def rows_to_indices(rows, n_queries: int) -> List[dict]:
+    """
+    Groups (query_index, id, distance) rows into one {segment id: cosine similarity}
+    dict per query, like `search_segments` returns.
+    """
+    indices = [{} for _ in range(n_queries)]
+    for query_index, resource_id, distance in rows:
+        indices[query_index][int(resource_id)] = 1 - distance
+    return indices
+
+
+def search_settings_params(settings: Dict[str, int]) -> List[dict]:
+    """
+    Parameters of `SET_SEARCH_SETTING_SQL` for every setting. The settings are
+    transaction local, so they only apply to the queries of the current request.
+    """
+    unknown = set(settings) - set(SEARCH_SETTINGS)
+    if unknown:
+        raise ValueError(f"Unknown search settings: {sorted(unknown)}")
+    return [{"name": name, "value": str(value)} for name, value in settings.items()]
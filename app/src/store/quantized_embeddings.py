@@ -0,0 +1,205 @@
+import struct
+import numpy as np
+
+from pathlib import Path
+from typing import Optional
+
+MAGIC = b"QVEC"
+VERSION = 1
+# magic, version, kind, dimension, count, n_subspaces, n_centroids
+HEADER = struct.Struct("<4sHHIQII")
+HEADER_SIZE = 64
+KINDS = {"float16": 0, "int8": 1, "pq": 2}
+
+
+def _aligned(offset: int, alignment: int = 64) -> int:
+    return (offset + alignment - 1) // alignment * alignment
+
+
+def train_kmeans(vectors: np.ndarray, n_centroids: int, n_iterations: int = 20, seed: int = 0) -> np.ndarray:
+    """
+    Plain Lloyd's k-means, initialized with random distinct vectors. Empty clusters
+    are re-seeded with random vectors.
+    """
+    rng = np.random.default_rng(seed)
+    n_centroids = min(n_centroids, len(vectors))
+    centroids = vectors[rng.choice(
+        len(vectors), n_centroids, replace=False)].copy()
+
+    for _ in range(n_iterations):
+        distances = (vectors ** 2).sum(axis=1)[:, None] - 2 * vectors @ centroids.T + \
+            (centroids ** 2).sum(axis=1)[None, :]
+        assignment = distances.argmin(axis=1)
+
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignment, vectors)
+        counts = np.bincount(assignment, minlength=n_centroids)
+        empty = counts == 0
+        centroids[~empty] = sums[~empty] / counts[~empty, None]
+        centroids[empty] = vectors[rng.integers(len(vectors), size=empty.sum())]
+    return centroids
+
+
+class QuantizedEmbeddings:
+    """
+    A compact, memory-mappable copy of the L2-normalized embeddings, for a fast
+    approximate first-stage scan:
+
+    - "float16": half precision, 2 bytes per dimension
+    - "int8": per-dimension affine scalar quantization, 1 byte per dimension
+    - "pq": product quantization, 1 byte per subspace of `dimension / n_subspaces`
+      dimensions, scored with a per-query lookup table
+
+    The file is a 64 byte header followed by the 64 byte aligned arrays, so the
+    codes are memory-mapped, not read into RAM.
+    """
+
+    def __init__(self,
+                 kind: str,
+                 codes: np.ndarray,
+                 dimension: int,
+                 scale: np.ndarray = None,
+                 offset: np.ndarray = None,
+                 codebooks: np.ndarray = None,
+                 block_size: int = 65536) -> None:
+        self.kind = kind
+        self.codes = codes
+        self.dimension = dimension
+        self.scale = scale
+        self.offset = offset
+        self.codebooks = codebooks
+        self.block_size = block_size
+
+    def __len__(self) -> int:
+        return len(self.codes)
+
+    @property
+    def nbytes(self) -> int:
+        return sum(array.nbytes for array in (self.codes, self.scale, self.offset, self.codebooks) if array is not None)
+
+    @classmethod
+    def quantize(cls, embeddings: np.ndarray, kind: str = "int8", n_subspaces: int = 48, n_centroids: int = 256,
+                 n_training: int = 50000) -> "QuantizedEmbeddings":
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        dimension = embeddings.shape[1]
+
+        if kind == "float16":
+            return cls(kind, embeddings.astype(np.float16), dimension)
+
+        if kind == "int8":
+            low, high = embeddings.min(axis=0), embeddings.max(axis=0)
+            scale = np.maximum(high - low, 1e-12) / 255
+            codes = np.round((embeddings - low) / scale).astype(np.uint8)
+            return cls(kind, codes, dimension, scale=scale.astype(np.float32), offset=low.astype(np.float32))
+
+        if kind == "pq":
+            if dimension % n_subspaces:
+                raise ValueError(
+                    f"Dimension {dimension} is not divisible by {n_subspaces} subspaces")
+            if n_centroids > 256:
+                raise ValueError("PQ codes are one byte per subspace")
+
+            subspace_dimension = dimension // n_subspaces
+            rng = np.random.default_rng(0)
+            training = embeddings[rng.choice(len(embeddings), min(
+                n_training, len(embeddings)), replace=False)]
+
+            codebooks = np.zeros(
+                (n_subspaces, n_centroids, subspace_dimension), dtype=np.float32)
+            codes = np.empty((len(embeddings), n_subspaces), dtype=np.uint8)
+            for subspace in range(n_subspaces):
+                columns = slice(subspace * subspace_dimension,
+                                (subspace + 1) * subspace_dimension)
+                centroids = train_kmeans(training[:, columns], n_centroids)
+                codebooks[subspace, :len(centroids)] = centroids
+                # Centroids beyond the trained ones are never assigned
+                for start in range(0, len(embeddings), 65536):
+                    vectors = embeddings[start:start+65536, columns]
+                    distances = -2 * vectors @ centroids.T + \
+                        (centroids ** 2).sum(axis=1)[None, :]
+                    codes[start:start+len(vectors),
+                          subspace] = distances.argmin(axis=1)
+            return cls(kind, codes, dimension, codebooks=codebooks)
+
+        raise NotImplementedError(f"Unsupported quantization: {kind}")
+
+    def save(self, path: Path) -> None:
+        n_subspaces, n_centroids = (self.codebooks.shape[0], self.codebooks.shape[1]) \
+            if self.codebooks is not None else (0, 0)
+        header = HEADER.pack(MAGIC, VERSION, KINDS[self.kind], self.dimension, len(self.codes),
+                             n_subspaces, n_centroids)
+
+        with open(path, "wb") as f:
+            f.write(header.ljust(HEADER_SIZE, b"\0"))
+            for array in (self.scale, self.offset, self.codebooks, self.codes):
+                if array is None:
+                    continue
+                f.write(b"\0" * (_aligned(f.tell()) - f.tell()))
+                f.write(np.ascontiguousarray(array).tobytes())
+
+    @classmethod
+    def load(cls, path: Path) -> "QuantizedEmbeddings":
+        with open(path, "rb") as f:
+            magic, version, kind_id, dimension, count, n_subspaces, n_centroids = HEADER.unpack(
+                f.read(HEADER.size))
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"Not a version {VERSION} QVEC file: {path}")
+        kind = {kind_id: name for name, kind_id in KINDS.items()}[kind_id]
+
+        offset = HEADER_SIZE
+
+        def array(dtype, shape):
+            nonlocal offset
+            offset = _aligned(offset)
+            mapped = np.memmap(path, dtype=dtype, mode="r",
+                               offset=offset, shape=shape)
+            offset += mapped.nbytes
+            return mapped
+
+        if kind == "float16":
+            return cls(kind, array(np.float16, (count, dimension)), dimension)
+        if kind == "int8":
+            scale = np.array(array(np.float32, (dimension,)))
+            low = np.array(array(np.float32, (dimension,)))
+            return cls(kind, array(np.uint8, (count, dimension)), dimension, scale=scale, offset=low)
+
+        codebooks = np.array(array(np.float32, (n_subspaces, n_centroids,
+                                                dimension // n_subspaces)))
+        return cls(kind, array(np.uint8, (count, n_subspaces)), dimension, codebooks=codebooks)
+
+    def _score_codes(self, codes: np.ndarray, query: np.ndarray, prepared) -> np.ndarray:
+        if self.kind == "float16":
+            return np.asarray(codes, dtype=np.float32) @ query
+        if self.kind == "int8":
+            # q . (low + scale * codes) = q . low + (q * scale) . codes
+            scaled_query, constant = prepared
+            return np.asarray(codes, dtype=np.float32) @ scaled_query + constant
+
+        # Sum of the query-centroid inner products of every subspace
+        lookup_table = prepared
+        return lookup_table[np.arange(codes.shape[1]), codes].sum(axis=1)
+
+    def _prepare(self, query: np.ndarray):
+        if self.kind == "int8":
+            return query * self.scale, float(query @ self.offset)
+        if self.kind == "pq":
+            subspace_queries = query.reshape(self.codebooks.shape[0], -1)
+            return np.einsum("sd,scd->sc", subspace_queries, self.codebooks)
+        return None
+
+    def scores(self, query: np.ndarray, rows: Optional[np.ndarray] = None) -> np.ndarray:
+        """
+        Approximate inner products of the (normalized) query with all rows, or with
+        the given `rows`.
+        """
+        prepared = self._prepare(query)
+        if rows is not None:
+            return self._score_codes(self.codes[rows], query, prepared)
+
+        # Scoring in blocks keeps the codes from being upcast as a whole
+        scores = np.empty(len(self.codes), dtype=np.float32)
+        for start in range(0, len(self.codes), self.block_size):
+            block = self.codes[start:start+self.block_size]
+            scores[start:start+len(block)] = self._score_codes(block,
+                                                               query, prepared)
+        return scores
@@ -0,0 +1,55 @@
+import pandas as pd
+
+from loguru import logger
+from pathlib import Path
+from typing import Iterable, List
+
+from ..db.models import ResourcesHubermanLab
+
+RESOURCE_COLUMNS = ["id", "summary", "episode_name",
+                    "segment_title", "url", "topic"]
+
+
+class LocalResourceStore:
+    """
+    The resources table as a local Parquet file, for the engines and tools that
+    run without Postgres. Resources are returned as transient ResourcesHubermanLab
+    objects, so the engine code is the same as with a SQL session.
+    """
+
+    def __init__(self, df_resources: pd.DataFrame) -> None:
+        self.df_resources = df_resources.set_index("id", drop=False)
+
+    @classmethod
+    def load(cls, path: Path) -> "LocalResourceStore":
+        return cls(pd.read_parquet(path, columns=RESOURCE_COLUMNS))
+
+    @classmethod
+    def from_summary_csv(cls, df_summary_path: Path) -> "LocalResourceStore":
+        """
+        Builds the resources from the summary CSV, using the row number as the id,
+        the ChatGPT cluster label as the topic and the segment name as the title.
+        """
+        df_summary = pd.read_csv(df_summary_path)
+        df_resources = pd.DataFrame({"id": df_summary.index.astype("int64"),
+                                     "summary": df_summary["summary"],
+                                     "episode_name": df_summary["episode_name"],
+                                     "segment_title": df_summary["segment_name"],
+                                     "url": df_summary["url"],
+                                     "topic": df_summary["chatgpt_labels"]})
+        return cls(df_resources)
+
+    def save(self, path: Path) -> None:
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self.df_resources[RESOURCE_COLUMNS].to_parquet(path, index=False)
+
+    def get_resources(self, resource_ids: Iterable[int]) -> List[ResourcesHubermanLab]:
+        resource_ids = [int(resource_id) for resource_id in resource_ids]
+        found_ids = [
+            resource_id for resource_id in resource_ids if resource_id in self.df_resources.index]
+        if len(found_ids) < len(resource_ids):
+            logger.warning(
+                f"Resources not found: {sorted(set(resource_ids) - set(found_ids))}")
+
+        rows = self.df_resources.loc[found_ids, RESOURCE_COLUMNS]
+        return [ResourcesHubermanLab(**row) for row in rows.to_dict("records")]
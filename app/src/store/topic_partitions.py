@@ -0,0 +1,107 @@
+import os
+import re
+import vecs
+
+from collections import defaultdict
+from loguru import logger
+from sqlalchemy.orm import Session
+from typing import Dict, Iterable, Optional
+
+from ..db.models import ResourcesHubermanLab
+
+
+def topic_collection_name(collection_name: str, topic: str) -> str:
+    """
+    Name of the collection holding only the segments of one topic, e.g.
+    "docs_sleep_circadian_rhythms_and_light".
+    """
+    slug = re.sub(r"[^a-z0-9]+", "_", topic.lower()).strip("_")
+    return f"{collection_name}_{slug[:40]}"
+
+
+def build_filters(topic: Optional[str] = None, episode_name: Optional[str] = None) -> dict:
+    """
+    vecs metadata filters of a topic and/or episode restricted search.
+    """
+    filters = []
+    if topic is not None:
+        filters.append({"topic": {"$eq": topic}})
+    if episode_name is not None:
+        filters.append({"episode_name": {"$eq": episode_name}})
+
+    if not filters:
+        return {}
+    if len(filters) == 1:
+        return filters[0]
+    return {"$and": filters}
+
+
+def load_topic_collections(vx: vecs.Client, collection_name: str, topics: Iterable[str]) -> Dict[str, vecs.Collection]:
+    """
+    Returns the existing per-topic collections. Topics without a collection are
+    searched in the main collection with a metadata filter instead.
+    """
+    topic_collections = {}
+    for topic in topics:
+        try:
+            topic_collections[topic] = vx.get_collection(
+                topic_collection_name(collection_name, topic))
+        except Exception:
+            logger.warning(f"No collection for topic: {topic}")
+    return topic_collections
+
+
+def sync_docs_metadata(vx: vecs.Client,
+                       session: Session,
+                       collection_name: str = "docs",
+                       dimension: int = 384,
+                       partition_by_topic: bool = True,
+                       batch_size: int = 500) -> None:
+    """
+    Stores the topic and the episode of every segment as the metadata of its
+    vector, so filters are applied inside the vector query, and copies every
+    segment into the collection of its topic, so a topic filtered search only
+    scans that topic.
+    """
+    docs = vx.get_or_create_collection(
+        name=collection_name, dimension=dimension)
+    resources = {str(resource.id): resource for resource in session.query(
+        ResourcesHubermanLab).all()}
+    topic_collections = {}
+
+    resource_ids = list(resources)
+    for start in range(0, len(resource_ids), batch_size):
+        records = docs.fetch(ids=resource_ids[start:start+batch_size])
+
+        updated_records = []
+        topic_records = defaultdict(list)
+        for resource_id, vec, metadata in records:
+            resource = resources[resource_id]
+            record = (resource_id, vec, {**(metadata or {}),
+                                         "topic": resource.topic,
+                                         "episode_name": resource.episode_name})
+            updated_records.append(record)
+            topic_records[resource.topic].append(record)
+
+        docs.upsert(records=updated_records)
+
+        if partition_by_topic:
+            for topic, records_of_topic in topic_records.items():
+                if topic not in topic_collections:
+                    topic_collections[topic] = vx.get_or_create_collection(
+                        name=topic_collection_name(collection_name, topic), dimension=dimension)
+                topic_collections[topic].upsert(records=records_of_topic)
+
+        logger.info(
+            f"Synced metadata of {start + len(records)}/{len(resource_ids)} segments")
+
+
+if __name__ == "__main__":
+    from dotenv import load_dotenv
+    from sqlalchemy import create_engine
+
+    load_dotenv()
+    DB_CONNECTION = f"postgresql://postgres:{os.environ['POSTGRES_DB_PASS']}@{os.environ['POSTGRES_DB_HOST']}:5432/postgres"
+
+    with Session(create_engine(DB_CONNECTION)) as session:
+        sync_docs_metadata(vecs.create_client(DB_CONNECTION), session)
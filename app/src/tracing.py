@@ -0,0 +1,233 @@
+"""
+Per-stage instrumentation of the QA flow. Every stage runs in a `span`, which
+
+- is added to the trace of the current request, if one was started with
+  `start_trace`, for a per-request timing breakdown
+- is observed in the in-process `metrics`, rendered in the Prometheus text format
+- is exported as an OpenTelemetry span, once `enable_opentelemetry` was called
+
+The current trace and span are context variables, so spans of asyncio tasks are
+attributed to their request. Worker threads see them when their function is
+wrapped with `in_context`.
+"""
+import contextvars
+import functools
+import threading
+import time
+
+from contextlib import contextmanager, nullcontext
+from dataclasses import dataclass, field
+from loguru import logger
+from typing import Callable, Dict, List, Optional, Tuple
+
+_current_trace = contextvars.ContextVar("qa_trace", default=None)
+_current_span = contextvars.ContextVar("qa_span", default=None)
+_tracer = None
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+                    0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+@dataclass
+class Span:
+    name: str
+    start: float
+    parent: Optional[str] = None
+    duration_ms: Optional[float] = None
+    attributes: dict = field(default_factory=dict)
+    otel_span: object = None
+
+    def set(self, **attributes) -> None:
+        self.attributes.update(attributes)
+        if self.otel_span is not None:
+            for key, value in _otel_attributes(attributes).items():
+                self.otel_span.set_attribute(key, value)
+
+
+class Trace:
+    """
+    The finished spans of one request.
+    """
+
+    def __init__(self) -> None:
+        self.start = time.perf_counter()
+        self.spans: List[Span] = []
+        self._lock = threading.Lock()
+
+    def add(self, span: Span) -> None:
+        with self._lock:
+            self.spans.append(span)
+
+    def timings(self) -> List[dict]:
+        """
+        The spans in start order, with their start relative to the request.
+        """
+        with self._lock:
+            spans = sorted(self.spans, key=lambda span: span.start)
+        return [{"name": span.name,
+                 "parent": span.parent,
+                 "start_ms": round((span.start - self.start) * 1000, 2),
+                 "duration_ms": round(span.duration_ms, 2),
+                 "attributes": span.attributes}
+                for span in spans]
+
+
+class Metrics:
+    """
+    Counters and histograms keyed by name and labels, rendered in the Prometheus
+    text exposition format. The values are per process, e.g. per Lambda container.
+    """
+
+    def __init__(self, buckets: Tuple[float, ...] = DURATION_BUCKETS) -> None:
+        self.buckets = buckets
+        self.descriptions = {}
+        self._counters: Dict[str, Dict[tuple, float]] = {}
+        self._histograms: Dict[str, Dict[tuple, list]] = {}
+        self._lock = threading.Lock()
+
+    def describe(self, name: str, description: str) -> None:
+        self.descriptions[name] = description
+
+    def increment(self, name: str, value: float = 1, **labels) -> None:
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            counter = self._counters.setdefault(name, {})
+            counter[key] = counter.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            histogram = self._histograms.setdefault(name, {})
+            # Bucket counts, then sum and count
+            state = histogram.setdefault(key, [0] * len(self.buckets) + [0.0, 0])
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[i] += 1
+            state[-2] += value
+            state[-1] += 1
+
+    @staticmethod
+    def _labels(key: tuple, **extra) -> str:
+        labels = list(key) + list(extra.items())
+        if not labels:
+            return ""
+        escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+                   for _, value in labels)
+        return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(labels, escaped)) + "}"
+
+    def render(self) -> str:
+        lines = []
+        with self._lock:
+            for name, counter in sorted(self._counters.items()):
+                lines.append(f"# HELP {name} {self.descriptions.get(name, name)}")
+                lines.append(f"# TYPE {name} counter")
+                for key, value in counter.items():
+                    lines.append(f"{name}{self._labels(key)} {value}")
+
+            for name, histogram in sorted(self._histograms.items()):
+                lines.append(f"# HELP {name} {self.descriptions.get(name, name)}")
+                lines.append(f"# TYPE {name} histogram")
+                for key, state in histogram.items():
+                    for bound, count in zip(self.buckets, state):
+                        lines.append(f"{name}_bucket{self._labels(key, le=bound)} {count}")
+                    lines.append(f"{name}_bucket{self._labels(key, le='+Inf')} {state[-1]}")
+                    lines.append(f"{name}_sum{self._labels(key)} {state[-2]}")
+                    lines.append(f"{name}_count{self._labels(key)} {state[-1]}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
+metrics.describe("qa_stage_duration_seconds", "Duration of the QA flow stages")
+metrics.describe("qa_llm_calls_total", "Chat model calls, by call and cache hit")
+metrics.describe("qa_llm_tokens_total", "Prompt and completion tokens of the chat model calls")
+metrics.describe("http_request_duration_seconds", "Duration of the API requests")
+
+
+def enable_opentelemetry(tracer_name: str = "podcast-qa") -> bool:
+    """
+    Exports every span through the OpenTelemetry API as well. The exporter is
+    configured by the OpenTelemetry SDK, e.g. with the OTEL_* environment variables.
+    """
+    global _tracer
+    try:
+        from opentelemetry import trace as otel_trace
+    except ImportError:
+        logger.warning("opentelemetry is not installed, spans are not exported")
+        return False
+    _tracer = otel_trace.get_tracer(tracer_name)
+    return True
+
+
+def _otel_attributes(attributes: dict) -> dict:
+    return {key: value for key, value in attributes.items()
+            if isinstance(value, (str, bool, int, float))}
+
+
+@contextmanager
+def start_trace():
+    """
+    Collects the spans of the enclosed code, e.g. one request, in a new Trace.
+    """
+    trace = Trace()
+    token = _current_trace.set(trace)
+    try:
+        yield trace
+    finally:
+        _current_trace.reset(token)
+
+
+def current_trace() -> Optional[Trace]:
+    return _current_trace.get()
+
+
+def current_span() -> Optional[Span]:
+    return _current_span.get()
+
+
+@contextmanager
+def span(name: str, **attributes):
+    """
+    Times the enclosed stage. Attributes known only later, e.g. token counts, are
+    added with `Span.set`.
+    """
+    parent = _current_span.get()
+    current = Span(name=name, start=time.perf_counter(),
+                   parent=parent.name if parent is not None else None, attributes=attributes)
+    token = _current_span.set(current)
+
+    otel_context = _tracer.start_as_current_span(
+        name, attributes=_otel_attributes(attributes)) if _tracer is not None else nullcontext()
+    try:
+        with otel_context as otel_span:
+            current.otel_span = otel_span
+            yield current
+    finally:
+        _current_span.reset(token)
+        current.duration_ms = (time.perf_counter() - current.start) * 1000
+        current.otel_span = None
+        metrics.observe("qa_stage_duration_seconds",
+                        current.duration_ms / 1000, stage=name)
+        trace = _current_trace.get()
+        if trace is not None:
+            trace.add(current)
+
+
+def record_llm_call(call: str, model: str, prompt_tokens: int = 0, completion_tokens: int = 0, cached: bool = False) -> None:
+    metrics.increment("qa_llm_calls_total", call=call, model=model, cached=str(cached).lower())
+    if not cached:
+        metrics.increment("qa_llm_tokens_total", prompt_tokens, model=model, kind="prompt")
+        metrics.increment("qa_llm_tokens_total", completion_tokens, model=model, kind="completion")
+
+    current = _current_span.get()
+    if current is not None:
+        current.set(cached=cached, prompt_tokens=prompt_tokens,
+                    completion_tokens=completion_tokens)
+
+
+def in_context(function: Callable) -> Callable:
+    """
+    `function` bound to a copy of the current context, so it sees the current
+    trace and span when it runs in another thread. A context can't be entered
+    twice at once, so every submitted call needs its own wrapper.
+    """
+    return functools.partial(contextvars.copy_context().run, function)
@@ -0,0 +1,123 @@
+"""
+Cold-start benchmark of the Lambda entry point `app.api.handler`.
+
+Every run starts a fresh interpreter (like a new Lambda container) that imports
+`app.api`, then invokes the handler with an API Gateway event for a resource
+request. It reports the import time, the first invocation time, the slowest
+imported modules (`python -X importtime`) and whether langchain was imported on
+the resource path. Results are appended to a JSON lines file, so the numbers can
+be tracked across commits.
+
+    python benchmarks/cold_start.py --runs 5 --path /hubermanlab/resource
+"""
+import argparse
+import datetime
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[1]
+
+CHILD = """
+import json, sys, time
+start_time = time.perf_counter()
+from app.api import handler
+import_time = time.perf_counter() - start_time
+
+event = json.loads(sys.argv[1])
+start_time = time.perf_counter()
+response = handler(event, None)
+invoke_time = time.perf_counter() - start_time
+
+print("COLD_START " + json.dumps({"import_time": import_time,
+                                  "invoke_time": invoke_time,
+                                  "status_code": response["statusCode"],
+                                  "langchain_imported": "langchain" in sys.modules,
+                                  "sentence_transformers_imported": "sentence_transformers" in sys.modules}))
+"""
+
+
+def api_gateway_event(path: str, query: dict) -> dict:
+    return {"version": "2.0",
+            "routeKey": "$default",
+            "rawPath": path,
+            "rawQueryString": "&".join(f"{key}={value}" for key, value in query.items()),
+            "queryStringParameters": query,
+            "headers": {"host": "localhost"},
+            "requestContext": {"http": {"method": "POST", "path": path, "sourceIp": "127.0.0.1", "protocol": "HTTP/1.1"},
+                               "stage": "$default"},
+            "isBase64Encoded": False,
+            "body": ""}
+
+
+def parse_import_times(stderr: str, top: int) -> list:
+    """
+    The `top` modules with the largest cumulative import time (microseconds).
+    """
+    modules = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        # import time: self [us] | cumulative | imported package
+        _, cumulative_us, name = line.split(":", 1)[1].split("|")
+        modules.append((name.strip(), int(cumulative_us)))
+    return sorted(modules, key=lambda module: module[1], reverse=True)[:top]
+
+
+def run_once(event: dict, top: int) -> dict:
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", CHILD, json.dumps(event)],
+                            cwd=ROOT, env=os.environ.copy(), capture_output=True, text=True)
+    lines = [line for line in result.stdout.splitlines()
+             if line.startswith("COLD_START ")]
+    if result.returncode != 0 or not lines:
+        raise RuntimeError(f"Cold-start run failed:\n{result.stderr[-2000:]}")
+
+    measurement = json.loads(lines[-1][len("COLD_START "):])
+    measurement["slowest_imports"] = parse_import_times(result.stderr, top)
+    return measurement
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Measures the cold start of app.api.handler")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--path", type=str, default="/hubermanlab/resource")
+    parser.add_argument("--question", type=str,
+                        default="How does light exposure affect sleep?")
+    parser.add_argument("--top", type=int, default=15,
+                        help="Number of slowest imports to report")
+    parser.add_argument("--output", type=Path,
+                        default=ROOT / "benchmarks" / "results" / "cold_start.jsonl")
+    args = parser.parse_args()
+
+    event = api_gateway_event(
+        args.path, {"user_id": "0", "question": args.question})
+    runs = [run_once(event, args.top) for _ in range(args.runs)]
+
+    import_times = [run["import_time"] for run in runs]
+    invoke_times = [run["invoke_time"] for run in runs]
+    summary = {"timestamp": datetime.datetime.now().isoformat(),
+               "commit": subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT,
+                                        capture_output=True, text=True).stdout.strip(),
+               "path": args.path,
+               "runs": args.runs,
+               "import_time_median": statistics.median(import_times),
+               "import_time_max": max(import_times),
+               "invoke_time_median": statistics.median(invoke_times),
+               "invoke_time_max": max(invoke_times),
+               "langchain_imported": any(run["langchain_imported"] for run in runs),
+               "slowest_imports": runs[-1]["slowest_imports"]}
+
+    print(f"import: median {summary['import_time_median']:.2f}s, max {summary['import_time_max']:.2f}s")
+    print(f"first invoke: median {summary['invoke_time_median']:.2f}s, max {summary['invoke_time_max']:.2f}s")
+    print(f"langchain imported: {summary['langchain_imported']}")
+    for name, cumulative_us in summary["slowest_imports"]:
+        print(f"  {cumulative_us / 1e6:8.3f}s  {name}")
+
+    args.output.parent.mkdir(parents=True, exist_ok=True)
+    with open(args.output, "a") as f:
+        f.write(json.dumps(summary) + "\n")
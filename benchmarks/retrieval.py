@@ -0,0 +1,385 @@
+"""
+Latency, throughput and recall benchmark of the QA flows, without an OpenAI or
+Supabase account. The production engine runs against local stand-ins (see
+benchmarks/standins.py): the segment corpus in a LocalVectorStore, the tables in
+SQLite and a fake chat model with a configurable latency. It reports:
+
+- p50/p95/p99 latency and DB round trips of every stage (encode, search, load
+  resources, segment checks, final answer) and of the full answer and resource
+  flows
+- throughput and latency of the answer flow at several concurrency levels
+- candidates, chat calls, tokens and latency of the relevance grading modes (a chat call per
+  segment or one batched JSON call), from the found segments to the final answer
+- recall@k of the approximate (quantized) search against the exact search
+
+The questions are segment titles. Results are appended to a JSON lines file, so
+the numbers can be compared before and after a change.
+
+    python benchmarks/retrieval.py --encoder hashing --chat-latency-ms 300 --concurrency 1 4 16
+    python benchmarks/retrieval.py --encoder sbert --ann pq --scale 20
+    python benchmarks/retrieval.py --grading-modes sequential batched --n-concurrent-checks 1
+    python benchmarks/retrieval.py --scale 3 --mmr-lambda 0.7 --duplicate-similarity 0.9
+"""
+import argparse
+import datetime
+import json
+import subprocess
+import sys
+import tempfile
+import time
+import numpy as np
+
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT))
+
+from app.src.constants import DF_SUMMARY_PATH  # noqa: E402
+from app.src.db.activity_log import ActivityLogger, WriteBehindActivityLogger  # noqa: E402
+from app.src.db.cache import ResourceCache  # noqa: E402
+from app.src.db.models import ResourcesHubermanLab  # noqa: E402
+from app.src.llm.dispatcher import LLMDispatcher  # noqa: E402
+from app.src.llm.qa.candidate_selector import load_candidate_selector  # noqa: E402
+from app.src.llm.qa.postgres_qa_engine import EmbeddingModel, GradingMode, RequestOptions, load_embedding_model  # noqa: E402
+from app.src.store.local_vector_store import LocalVectorStore  # noqa: E402
+from app.src.store.quantized_embeddings import QuantizedEmbeddings  # noqa: E402
+from app.src.store.resource_store import LocalResourceStore  # noqa: E402
+from benchmarks.standins import BenchmarkQAEngine, FakeChatModel, HashingEncoder, RoundTripCounter, sqlite_database  # noqa: E402
+
+STAGES = ["encode", "search", "load_resources", "process_segments",
+          "final_answer", "resource_flow", "answer_flow"]
+
+
+def latency_stats(latencies_ms: list) -> dict:
+    if not latencies_ms:
+        return {}
+    p50, p95, p99 = np.percentile(latencies_ms, [50, 95, 99])
+    return {"n": len(latencies_ms), "mean": round(float(np.mean(latencies_ms)), 2),
+            "p50": round(float(p50), 2), "p95": round(float(p95), 2), "p99": round(float(p99), 2)}
+
+
+def load_encoder(name: str):
+    if name == "hashing":
+        return HashingEncoder()
+    return load_embedding_model(EmbeddingModel(name))
+
+
+def load_corpus(encoder, df_summary_path: Path, scale: int = 1, seed: int = 0):
+    """
+    The segment resources and their summary embeddings. With `scale` > 1 every
+    segment is repeated with a slightly perturbed embedding, to benchmark the
+    search on a larger collection.
+    """
+    df_resources = LocalResourceStore.from_summary_csv(
+        df_summary_path).df_resources
+    df_resources["summary"] = df_resources["summary"].fillna("")
+    embeddings = np.asarray(encoder.encode(
+        df_resources["summary"].tolist(), batch_size=64), dtype=np.float32)
+    embeddings /= np.maximum(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12)
+
+    records = df_resources.to_dict("records")
+    resources = [ResourcesHubermanLab(**record) for record in records]
+    ids = df_resources["id"].to_numpy(dtype=np.int64)
+    metadata = [{"topic": record["topic"], "episode_name": record["episode_name"]}
+                for record in records]
+
+    rng = np.random.default_rng(seed)
+    all_ids, all_embeddings, all_metadata = [ids], [embeddings], list(metadata)
+    for copy in range(1, scale):
+        offset = copy * (int(ids.max()) + 1)
+        noisy = embeddings + rng.normal(0, 0.02, embeddings.shape).astype(np.float32)
+        all_ids.append(ids + offset)
+        all_embeddings.append(noisy / np.linalg.norm(noisy, axis=1, keepdims=True))
+        all_metadata += metadata
+        resources += [ResourcesHubermanLab(**{**record, "id": record["id"] + offset})
+                      for record in records]
+
+    return resources, np.concatenate(all_ids), np.concatenate(all_embeddings), all_metadata
+
+
+def sample_questions(resources: list, n: int, seed: int = 0) -> list:
+    titles = sorted({resource.segment_title for resource in resources if resource.segment_title})
+    rng = np.random.default_rng(seed)
+    return [str(title) for title in rng.choice(titles, min(n, len(titles)), replace=False)]
+
+
+def recall_at_k(exact_store: LocalVectorStore, ann_store: LocalVectorStore, queries: np.ndarray, ks: list) -> dict:
+    """
+    Mean share of the exact top-k ids the approximate search finds, and the search
+    latencies of both stores.
+    """
+    k_max = max(ks)
+    recalls = {k: [] for k in ks}
+    exact_latencies, ann_latencies = [], []
+    for query in queries:
+        start_time = time.perf_counter()
+        exact_rows, _ = exact_store.search(query, k_max)
+        exact_latencies.append((time.perf_counter() - start_time) * 1000)
+
+        start_time = time.perf_counter()
+        ann_rows, _ = ann_store.search(query, k_max)
+        ann_latencies.append((time.perf_counter() - start_time) * 1000)
+
+        for k in ks:
+            recalls[k].append(len(set(exact_rows[:k]) & set(ann_rows[:k])) / k)
+
+    return {"recall": {f"@{k}": round(float(np.mean(values)), 4) for k, values in recalls.items()},
+            "exact_search_ms": latency_stats(exact_latencies),
+            "ann_search_ms": latency_stats(ann_latencies)}
+
+
+class Benchmark:
+    def __init__(self, args, encoder, store: LocalVectorStore, session_factory, counter: RoundTripCounter) -> None:
+        self.args = args
+        self.encoder = encoder
+        self.store = store
+        self.session_factory = session_factory
+        self.counter = counter
+        self.fake_chat = FakeChatModel(latency_ms=args.chat_latency_ms,
+                                       jitter_ms=args.chat_jitter_ms,
+                                       relevant_rate=args.relevant_rate)
+        # Shared across requests, like in EngineRegistry
+        self.resource_cache = ResourceCache(
+            max_size=args.resource_cache_size) if args.resource_cache_size else None
+        self.write_behind = WriteBehindActivityLogger(
+            session_factory) if args.write_behind else None
+        self.llm_dispatcher = LLMDispatcher(requests_per_minute=args.llm_rpm,
+                                            tokens_per_minute=args.llm_tpm) if args.llm_rpm else None
+        self.candidate_selector = load_candidate_selector(
+            args.candidate_selector) if args.candidate_selector else None
+
+    def engine(self, session) -> BenchmarkQAEngine:
+        return BenchmarkQAEngine(embedding_model=EmbeddingModel.SBERT,
+                                 sql_session=session,
+                                 vecs_client=None,
+                                 vecs_collection_name=None,
+                                 encoder=self.encoder,
+                                 docs_collection=self.store,
+                                 n_search=self.args.n_search,
+                                 n_concurrent_checks=self.args.n_concurrent_checks,
+                                 resource_cache=self.resource_cache,
+                                 activity_logger=self.write_behind or ActivityLogger(session),
+                                 llm_dispatcher=self.llm_dispatcher,
+                                 candidate_selector=self.candidate_selector,
+                                 mmr_lambda=self.args.mmr_lambda,
+                                 duplicate_similarity=self.args.duplicate_similarity,
+                                 fake_chat=self.fake_chat)
+
+    def _timed(self, stage: str, latencies: dict, round_trips: dict, function, *args):
+        start_time = time.perf_counter()
+        with self.counter.measure(round_trips[stage]):
+            result = function(*args)
+        latencies[stage].append((time.perf_counter() - start_time) * 1000)
+        return result
+
+    def stages(self, questions: list) -> dict:
+        """
+        Runs the stages of every question one after another.
+        """
+        latencies = {stage: [] for stage in STAGES}
+        round_trips = {stage: [] for stage in STAGES}
+
+        with self.session_factory() as session:
+            engine = self.engine(session)
+            for _ in range(self.args.repeats):
+                for question in questions:
+                    embedded_question = self._timed(
+                        "encode", latencies, round_trips, engine.embed_question, question)
+                    indices = self._timed("search", latencies, round_trips, engine.find_segments,
+                                          question, embedded_question, self.args.n_search)
+                    self._timed("load_resources", latencies,
+                                round_trips, engine._get_resources, indices)
+                    relevant_segments, _, _ = self._timed("process_segments", latencies, round_trips,
+                                                          engine.process_found_segments, question, indices)
+                    self._timed("final_answer", latencies, round_trips,
+                                engine.get_final_answer, question, relevant_segments)
+                    self._timed("resource_flow", latencies, round_trips,
+                                engine.resource_full_flow, 0, question)
+                    self._timed("answer_flow", latencies, round_trips,
+                                engine.answer_full_flow, 0, question)
+
+        return {stage: {**latency_stats(latencies[stage]),
+                        "round_trips": round(float(np.mean(round_trips[stage])), 2)}
+                for stage in STAGES}
+
+    def grading(self, questions: list, grading_mode: GradingMode) -> dict:
+        """
+        Grades the found segments of every question with `grading_mode` and writes
+        the final answer, counting the chat calls and tokens.
+        """
+        latencies = []
+        relevant = {}
+        n_candidates = []
+        n_calls, n_prompt_tokens, n_completion_tokens = (self.fake_chat.n_calls, self.fake_chat.n_prompt_tokens,
+                                                         self.fake_chat.n_completion_tokens)
+
+        options = RequestOptions(grading_mode=grading_mode)
+        with self.session_factory() as session:
+            engine = self.engine(session)
+            for question in questions:
+                embedded_question = engine.embed_question(question)
+                indices = engine.find_segments(
+                    question, embedded_question, self.args.n_search, options)
+                start_time = time.perf_counter()
+                candidates = engine.select_candidates(indices, embedded_question)
+                relevant_segments, _, _ = engine.process_found_segments(
+                    question, candidates, options=options)
+                engine.get_final_answer(question, relevant_segments)
+                latencies.append((time.perf_counter() - start_time) * 1000)
+                relevant[question] = sorted(relevant_segments)
+                n_candidates.append(len(candidates))
+
+        n_questions = len(questions)
+        return {"grading_mode": grading_mode.value,
+                "latency_ms": latency_stats(latencies),
+                "candidates_per_question": round(float(np.mean(n_candidates)), 2),
+                "chat_calls_per_question": round((self.fake_chat.n_calls - n_calls) / n_questions, 2),
+                "prompt_tokens_per_question": round((self.fake_chat.n_prompt_tokens - n_prompt_tokens) / n_questions, 1),
+                "completion_tokens_per_question": round((self.fake_chat.n_completion_tokens - n_completion_tokens) / n_questions, 1),
+                "relevant_segments": relevant}
+
+    def _answer_request(self, question: str):
+        round_trips = []
+        start_time = time.perf_counter()
+        with self.session_factory() as session, self.counter.measure(round_trips):
+            self.engine(session).answer_full_flow(0, question)
+        return (time.perf_counter() - start_time) * 1000, round_trips[0]
+
+    def throughput(self, questions: list, concurrency: int) -> dict:
+        """
+        Answers `requests_per_worker * concurrency` questions with `concurrency`
+        requests in flight, each with its own session and engine.
+        """
+        n_requests = self.args.requests_per_worker * concurrency
+        requests = [questions[i % len(questions)] for i in range(n_requests)]
+        n_chat_calls = self.fake_chat.n_calls
+
+        start_time = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            results = list(executor.map(self._answer_request, requests))
+        elapsed = time.perf_counter() - start_time
+
+        latencies, round_trips = zip(*results)
+        return {"concurrency": concurrency,
+                "requests": n_requests,
+                "requests_per_second": round(n_requests / elapsed, 2),
+                "latency_ms": latency_stats(list(latencies)),
+                "round_trips_per_request": round(float(np.mean(round_trips)), 2),
+                "chat_calls_per_request": round((self.fake_chat.n_calls - n_chat_calls) / n_requests, 2)}
+
+
+def print_report(report: dict) -> None:
+    print(f"\n{'stage':<18}{'p50':>10}{'p95':>10}{'p99':>10}{'round trips':>14}")
+    for stage, stats in report["stages"].items():
+        print(f"{stage:<18}{stats['p50']:>10.1f}{stats['p95']:>10.1f}{stats['p99']:>10.1f}{stats['round_trips']:>14.1f}")
+
+    print(f"\n{'concurrency':<14}{'req/s':>10}{'p50':>10}{'p95':>10}{'p99':>10}{'round trips':>14}")
+    for run in report["throughput"]:
+        latency = run["latency_ms"]
+        print(f"{run['concurrency']:<14}{run['requests_per_second']:>10.2f}{latency['p50']:>10.1f}"
+              f"{latency['p95']:>10.1f}{latency['p99']:>10.1f}{run['round_trips_per_request']:>14.1f}")
+
+    if report.get("grading"):
+        print(f"\n{'grading':<14}{'candidates':>12}{'calls':>10}{'prompt tok':>12}{'compl tok':>12}{'p50':>10}{'p95':>10}{'same segments':>16}")
+        baseline = report["grading"][0]["relevant_segments"]
+        for run in report["grading"]:
+            latency = run["latency_ms"]
+            same = np.mean([run["relevant_segments"][question] == segments
+                            for question, segments in baseline.items()])
+            print(f"{run['grading_mode']:<14}{run['candidates_per_question']:>12.2f}{run['chat_calls_per_question']:>10.2f}{run['prompt_tokens_per_question']:>12.1f}"
+                  f"{run['completion_tokens_per_question']:>12.1f}{latency['p50']:>10.1f}{latency['p95']:>10.1f}{same:>16.0%}")
+
+    if report.get("ann") is not None:
+        ann = report["ann"]
+        print(f"\n{report['args']['ann']} search recall: {ann['recall']}, "
+              f"p50 {ann['ann_search_ms']['p50']} ms (exact p50 {ann['exact_search_ms']['p50']} ms)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmarks the QA flows against local stand-ins")
+    parser.add_argument("--encoder", default="hashing",
+                        choices=["hashing", "sbert", "sbert_onnx", "sbert_onnx_int8"],
+                        help="Question encoder. hashing needs no model files.")
+    parser.add_argument("--ann", default="int8", choices=["none", "float16", "int8", "pq"],
+                        help="Quantization of the searched store; recall is measured against the exact search.")
+    parser.add_argument("--rescore-factor", type=int, default=None)
+    parser.add_argument("--scale", type=int, default=1,
+                        help="Number of perturbed copies of the segment corpus")
+    parser.add_argument("--n-questions", type=int, default=30)
+    parser.add_argument("--repeats", type=int, default=1)
+    parser.add_argument("--n-search", type=int, default=20)
+    parser.add_argument("--recall-k", type=int, nargs="+", default=[7, 20])
+    parser.add_argument("--n-concurrent-checks", type=int, default=4)
+    parser.add_argument("--chat-latency-ms", type=float, default=300)
+    parser.add_argument("--chat-jitter-ms", type=float, default=100)
+    parser.add_argument("--relevant-rate", type=float, default=0.5,
+                        help="Share of the segment checks the fake chat model finds relevant")
+    parser.add_argument("--resource-cache-size", type=int, default=10000,
+                        help="0 disables the shared resource cache")
+    parser.add_argument("--write-behind", action="store_true",
+                        help="Log questions through the write-behind activity logger")
+    parser.add_argument("--llm-rpm", type=float, default=None,
+                        help="Rate limit the chat calls through an LLMDispatcher, in requests per minute")
+    parser.add_argument("--llm-tpm", type=float, default=90000,
+                        help="Tokens per minute of the LLMDispatcher")
+    parser.add_argument("--candidate-selector", type=Path, default=None,
+                        help="Check only the segments picked by this calibrated CandidateSelector")
+    parser.add_argument("--mmr-lambda", type=float, default=None,
+                        help="Re-rank the candidates by maximal marginal relevance with this lambda")
+    parser.add_argument("--duplicate-similarity", type=float, default=0.95,
+                        help="With --mmr-lambda, drop the candidates this similar to a better ranked one")
+    parser.add_argument("--grading-modes", nargs="*", default=["sequential", "batched"],
+                        choices=[mode.value for mode in GradingMode],
+                        help="Relevance grading modes to compare, the first one is the baseline")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 16])
+    parser.add_argument("--requests-per-worker", type=int, default=3)
+    parser.add_argument("--df-summary-path", type=Path, default=ROOT / DF_SUMMARY_PATH)
+    parser.add_argument("--output", type=Path,
+                        default=ROOT / "benchmarks" / "results" / "retrieval.jsonl")
+    args = parser.parse_args()
+
+    encoder = load_encoder(args.encoder)
+    resources, ids, embeddings, metadata = load_corpus(
+        encoder, args.df_summary_path, scale=args.scale)
+    questions = sample_questions(resources, args.n_questions)
+
+    exact_store = LocalVectorStore(ids, embeddings, metadata)
+    store = exact_store
+    ann = None
+    if args.ann != "none":
+        store = LocalVectorStore(ids, embeddings, metadata,
+                                 quantized=QuantizedEmbeddings.quantize(embeddings, kind=args.ann),
+                                 rescore_factor=args.rescore_factor)
+        queries = np.asarray(encoder.encode(questions), dtype=np.float32)
+        ann = recall_at_k(exact_store, store, queries, args.recall_k)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        session_factory = sqlite_database(Path(tmp_dir) / "benchmark.db", resources)
+        counter = RoundTripCounter(session_factory.kw["bind"])
+        benchmark = Benchmark(args, encoder, store, session_factory, counter)
+
+        stages = benchmark.stages(questions)
+        grading = [benchmark.grading(questions, GradingMode(mode))
+                   for mode in args.grading_modes]
+        throughput = [benchmark.throughput(questions, concurrency)
+                      for concurrency in args.concurrency]
+        if benchmark.write_behind is not None:
+            benchmark.write_behind.close()
+
+    report = {"timestamp": datetime.datetime.now().isoformat(),
+              "commit": subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT,
+                                       capture_output=True, text=True).stdout.strip(),
+              "args": {key: str(value) if isinstance(value, Path) else value
+                       for key, value in vars(args).items()},
+              "n_segments": len(ids),
+              "stages": stages,
+              "throughput": throughput,
+              "grading": grading,
+              "ann": ann}
+    print_report(report)
+
+    args.output.parent.mkdir(parents=True, exist_ok=True)
+    with open(args.output, "a") as f:
+        f.write(json.dumps(report) + "\n")
@@ -0,0 +1,218 @@
+"""
+Local stand-ins for the services of the QA engine, so the flows can be benchmarked
+without an OpenAI or Supabase account:
+
+- `HashingEncoder`: a deterministic bag-of-words encoder, for runs without the
+  sentence-transformers model
+- `FakeChatModel`: a chat model with configurable latency and relevance rate, which
+  counts its calls and tokens
+- `BenchmarkQAEngine`: PostgresQAEngine whose chains call the fake chat model
+- `sqlite_database`: the ORM tables in SQLite, filled with the resources
+- `RoundTripCounter`: counts the SQL statements sent, per thread
+"""
+import asyncio
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+import numpy as np
+
+from contextlib import contextmanager
+from pathlib import Path
+from sqlalchemy import create_engine, event, insert
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import sessionmaker
+from typing import Callable, List
+
+from app.src.db.models import Base, ResourcesHubermanLab, Users
+from app.src.llm.qa.postgres_qa_engine import PostgresQAEngine
+from app.src.llm.qa.prompts.grading_template import GRADING_SYSTEM_TEMPLATE
+from app.src.llm.qa.prompts.segment_template import SEGMENT_SYSTEM_TEMPLATE
+from app.src.llm.tokens import count_tokens
+
+
+def _stable_hash(*values: str) -> int:
+    return int.from_bytes(hashlib.blake2b("\0".join(values).encode("utf-8"), digest_size=8).digest(), "little")
+
+
+class HashingEncoder:
+    """
+    Signed feature hashing of the lowercase words, L2-normalized. Texts sharing
+    words get similar vectors, which is enough for a meaningful search.
+    """
+
+    def __init__(self, dimension: int = 384) -> None:
+        self.dimension = dimension
+
+    def get_sentence_embedding_dimension(self) -> int:
+        return self.dimension
+
+    def _encode_one(self, text: str) -> np.ndarray:
+        vector = np.zeros(self.dimension, dtype=np.float32)
+        for word in re.findall(r"[a-z0-9]+", text.lower()):
+            hashed = _stable_hash(word)
+            vector[hashed % self.dimension] += 1 if hashed >> 63 else -1
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def encode(self, texts, batch_size: int = 32, **kwargs) -> np.ndarray:
+        if isinstance(texts, str):
+            return self._encode_one(texts)
+        return np.stack([self._encode_one(text) for text in texts])
+
+
+class FakeChatModel:
+    """
+    Answers after `latency_ms` (+- `jitter_ms`). A segment check is relevant for a
+    deterministic `relevant_rate` share of the (question, context) pairs, so every
+    run makes the same decisions, and a batched grading call grades the same pairs
+    relevant. Streamed answers are emitted word by word.
+    """
+
+    def __init__(self, latency_ms: float = 500, jitter_ms: float = 100, relevant_rate: float = 0.5,
+                 seed: int = 0) -> None:
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.relevant_rate = relevant_rate
+        self.seed = seed
+        self.n_calls = 0
+        self.n_prompt_tokens = 0
+        self.n_completion_tokens = 0
+        self._lock = threading.Lock()
+
+    def _latency(self, inputs: dict) -> float:
+        jitter = random.Random(_stable_hash(str(self.seed), *map(str, inputs.values()))).uniform(-1, 1)
+        return max(self.latency_ms + jitter * self.jitter_ms, 0) / 1000
+
+    def _is_relevant(self, question: str, context: str) -> bool:
+        return _stable_hash(str(self.seed), question, context) % 1000 < self.relevant_rate * 1000
+
+    def _grades(self, question: str, contexts: str, n_relevant: int) -> str:
+        grades = []
+        n_answered = 0
+        for i, context in enumerate(re.split(r"CONTEXT \d+:\n", contexts)[1:], 1):
+            relevant = self._is_relevant(question, context.rstrip("\n"))
+            answer = None
+            if relevant and n_answered < n_relevant:
+                answer = f"The context answers: {question}"
+                n_answered += 1
+            grades.append({"context": i, "score": 8 if relevant else 1, "answer": answer})
+        return json.dumps(grades)
+
+    def _reply(self, system_template: str, human_template: str, inputs: dict) -> str:
+        question, context = inputs.get("question", ""), inputs.get("context", "")
+        if system_template == GRADING_SYSTEM_TEMPLATE:
+            reply = self._grades(question, inputs["contexts"], inputs["n_relevant"])
+        elif system_template != SEGMENT_SYSTEM_TEMPLATE:
+            reply = f"Final answer to: {question}"
+        elif self._is_relevant(question, context):
+            reply = f"The context answers: {question}"
+        else:
+            reply = "Not relevant. The context is about something else."
+
+        prompt_tokens = count_tokens(system_template + human_template.format(**inputs))
+        with self._lock:
+            self.n_calls += 1
+            self.n_prompt_tokens += prompt_tokens
+            self.n_completion_tokens += count_tokens(reply)
+        return reply
+
+    def complete(self, system_template: str, human_template: str, on_token: Callable[[str], None] = None, **inputs) -> str:
+        time.sleep(self._latency(inputs))
+        reply = self._reply(system_template, human_template, inputs)
+        if on_token is not None:
+            for word in reply.split(" "):
+                on_token(word + " ")
+        return reply
+
+    async def acomplete(self, system_template: str, human_template: str, on_token: Callable[[str], None] = None, **inputs) -> str:
+        await asyncio.sleep(self._latency(inputs))
+        reply = self._reply(system_template, human_template, inputs)
+        if on_token is not None:
+            for word in reply.split(" "):
+                on_token(word + " ")
+        return reply
+
+
+class FakeChain:
+    # The part of LLMChain the engine uses
+
+    def __init__(self, chat: FakeChatModel, system_template: str, human_template: str, on_token: Callable[[str], None] = None) -> None:
+        self.chat = chat
+        self.system_template = system_template
+        self.human_template = human_template
+        self.on_token = on_token
+
+    def run(self, **inputs) -> str:
+        return self.chat.complete(self.system_template, self.human_template, self.on_token, **inputs)
+
+    async def arun(self, **inputs) -> str:
+        return await self.chat.acomplete(self.system_template, self.human_template, self.on_token, **inputs)
+
+
+class BenchmarkQAEngine(PostgresQAEngine):
+    """
+    The production engine, with every chat call answered by `fake_chat`. The LLM
+    cache and the rest of the flow are unchanged.
+    """
+
+    def __init__(self, *args, fake_chat: FakeChatModel, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.fake_chat = fake_chat
+
+    def _build_chain(self, system_template: str, human_template: str, on_token: Callable[[str], None] = None, api_key: str = None):
+        return FakeChain(self.fake_chat, system_template, human_template, on_token)
+
+
+class RoundTripCounter:
+    """
+    Counts the statements every thread sends to the database, so the round trips
+    of one request can be measured while other requests run concurrently.
+    """
+
+    def __init__(self, engine: Engine) -> None:
+        self.total = 0
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        event.listen(engine, "before_cursor_execute", self._on_execute)
+
+    def _on_execute(self, *args) -> None:
+        self._local.count = getattr(self._local, "count", 0) + 1
+        with self._lock:
+            self.total += 1
+
+    @property
+    def count(self) -> int:
+        # Statements sent by the current thread
+        return getattr(self._local, "count", 0)
+
+    @contextmanager
+    def measure(self, counts: List[int]):
+        start = self.count
+        try:
+            yield
+        finally:
+            counts.append(self.count - start)
+
+
+def sqlite_database(path: Path, resources: List[ResourcesHubermanLab]) -> sessionmaker:
+    """
+    A fresh SQLite database with the ORM tables, the resources and user 0. It is a
+    file, so every session gets its own connection.
+    """
+    path = Path(path)
+    if path.exists():
+        path.unlink()
+    engine = create_engine(f"sqlite:///{path}",
+                           connect_args={"check_same_thread": False, "timeout": 30})
+    Base.metadata.create_all(engine)
+
+    with engine.begin() as connection:
+        connection.execute(insert(Users), [{"id": 0, "name": "benchmark"}])
+        connection.execute(insert(ResourcesHubermanLab),
+                           [{"id": resource.id, "summary": resource.summary, "episode_name": resource.episode_name,
+                             "segment_title": resource.segment_title, "url": resource.url, "topic": resource.topic}
+                            for resource in resources])
+    return sessionmaker(autocommit=False, autoflush=False, bind=engine)
@@ -8,12 +8,13 @@ import pandas as pd
 
 from app.src.constants import (
     DF_SUMMARY_PATH,
-    OPENAI_FAISS_INDEX,
     QA_OUTPUT_DIR,
     IMAGES_DIR,
-    SBERT_FAISS_INDEX
+    LOCAL_INDEX_DIR,
+    RESOURCES_PARQUET
 )
-from app.src.llm.qa.local_qa_engine import QAEngine, EmbeddingModel
+from app.src.llm.qa.local_qa_engine import LocalQAEngine, build_local_index
+from app.src.llm.qa.postgres_qa_engine import EmbeddingModel, RequestOptions, load_embedding_model
 
 # Load environment variables from .env file
 load_dotenv()
@@ -32,7 +33,7 @@ def create_parser():
     parser.add_argument('-q', '--question', help='Ask a question.')
     parser.add_argument('-r', '--resources', help='Search resources.')
     parser.add_argument('--embedding_model', default='sbert', choices=[
-                        'sbert', 'openai'], help='Choose the embedding model. Options: "sbert", "openai". Default: "sbert".')
+                        'sbert', 'sbert_onnx', 'sbert_onnx_int8', 'openai'], help='Choose the embedding model. Options: "sbert", "sbert_onnx", "sbert_onnx_int8", "openai". Default: "sbert".')
     parser.add_argument('--n_search', type=int, default=20,
                         help='Number of segments to search for. Default: 20.')
     parser.add_argument('--n_relevant_segments', type=int,
@@ -41,6 +42,22 @@ def create_parser():
                         help='Language model to use. Default: "gpt-3.5-turbo".')
     parser.add_argument('--temperature', type=float, default=0,
                         help='Temperature for the model. Default: 0.')
+    parser.add_argument('--build-local-index', action='store_true',
+                        help='(Re)build the local vector and resource stores from the summary CSV.')
+    parser.add_argument('--index-dtype', default='float32', choices=['float32', 'float16'],
+                        help='Storage type of the local embeddings. Default: "float32".')
+    parser.add_argument('--index-quantization', default=None, choices=['float16', 'int8', 'pq'],
+                        help='Also store a quantized copy of the local embeddings, scanned first and re-scored exactly.')
+    parser.add_argument('--use-faiss', action='store_true',
+                        help='Search the local embeddings with a FAISS index.')
+    parser.add_argument('--topic', default=None,
+                        help='Search only the segments of this topic, e.g. "Sleep, Circadian Rhythms and Light".')
+    parser.add_argument('--episode_name', default=None,
+                        help='Search only the segments of this episode.')
+    parser.add_argument('--search_mode', default='vector', choices=['vector', 'hybrid'],
+                        help='Vector search only, or fused with a BM25 search over summaries and keywords. Default: "vector".')
+    parser.add_argument('--grading_mode', default='sequential', choices=['sequential', 'batched'],
+                        help='Check the found segments with one ChatGPT call each, or the top ones in a single call. Default: "sequential".')
     return parser
 
 
@@ -69,42 +86,59 @@ def main():
     images_output_path = Path(os.getenv('IMAGES_DIR', IMAGES_DIR))
 
     embedding_model = EmbeddingModel(args.embedding_model)
-    index_path = SBERT_FAISS_INDEX if embedding_model == EmbeddingModel.SBERT else OPENAI_FAISS_INDEX
-
-    qa_engine = QAEngine(embedding_model=embedding_model,
-                         df_summary_path=DF_SUMMARY_PATH,
-                         index_path=index_path,
-                         qa_output_path=qa_output_path,
-                         images_output_path=images_output_path,
-                         n_search=args.n_search,
-                         n_relevant_segments=args.n_relevant_segments,
-                         llm_model=args.llm_model,
-                         temperature=args.temperature)
-
-    df_summary = pd.read_csv(DF_SUMMARY_PATH)
+    encoder = load_embedding_model(embedding_model)
+
+    if args.build_local_index or not LOCAL_INDEX_DIR.exists() or not RESOURCES_PARQUET.exists():
+        build_local_index(encoder,
+                          index_dir=LOCAL_INDEX_DIR,
+                          resources_path=RESOURCES_PARQUET,
+                          dtype=args.index_dtype,
+                          quantization=args.index_quantization)
+        print(f"Local index was built in {LOCAL_INDEX_DIR}")
+
+    qa_engine = LocalQAEngine(embedding_model=embedding_model,
+                              index_dir=LOCAL_INDEX_DIR,
+                              resources_path=RESOURCES_PARQUET,
+                              use_faiss=args.use_faiss,
+                              encoder=encoder,
+                              n_search=args.n_search,
+                              n_relevant_segments=args.n_relevant_segments,
+                              llm_model=args.llm_model,
+                              temperature=args.temperature)
+    options = RequestOptions(search_mode=args.search_mode,
+                             grading_mode=args.grading_mode,
+                             topic=args.topic,
+                             episode_name=args.episode_name)
 
     if args.question:
-        answer = qa_engine.qa_full_flow(args.question)
+        answer, html_raw = qa_engine.answer_full_flow(
+            None, args.question, options)
+
+        qa_output_path.mkdir(parents=True, exist_ok=True)
+        with open(qa_output_path / f"{args.question}-final-answer.txt", "w") as f:
+            f.write(answer)
+        with open(qa_output_path / f"{args.question}-final-answer.html", "w") as f:
+            f.write(html_raw)
         print(
             f"Your question was answered and the answer is saved in {qa_output_path}")
         print(answer)
 
     if args.resources:
+        df_summary = pd.read_csv(DF_SUMMARY_PATH)
+
         embedded_question = qa_engine.embed_question(args.resources)
-        similarity, indices = qa_engine.search_segments(embedded_question)
+        indices = qa_engine.find_segments(
+            args.resources, embedded_question, args.n_search, options)
 
-        relevant_segments = df_summary.iloc[indices[0]].copy()
+        relevant_segments = df_summary.loc[list(indices)].copy()
 
-        # Add the distances to the dataframe
-        relevant_segments['similarity'] = similarity[0]
+        # Add the similarities to the dataframe, the rows are already in the search order
+        relevant_segments['similarity'] = list(indices.values())
 
         relevant_segments = relevant_segments[[
             'episode_name', 'segment_name', 'summary', 'url', 'keywords', 'similarity']]
 
-        # Sort by distances
-        relevant_segments.sort_values(
-            by='similarity', ascending=False, inplace=True)
-
+        qa_output_path.mkdir(parents=True, exist_ok=True)
         relevant_segments.to_csv(
             qa_output_path / 'relevant_segments.csv', index=False)
         print(
@@ -0,0 +1,77 @@
+"""
+BM25 ranking of the segment texts and its fusion with the vector search.
+"""
+import pytest
+
+from app.src.store.bm25_index import BM25Index, fuse_rankings, tokenize
+
+TEXTS = {
+    1: "Caffeine and sleep: how caffeine blocks adenosine",
+    2: "Morning sunlight sets the circadian clock",
+    3: "Caffeine timing for focus",
+    4: "Cold exposure and dopamine",
+}
+METADATA = [{"topic": "Sleep"}, {"topic": "Sleep"}, {"topic": "Focus"}, {"topic": "Cold"}]
+
+
+@pytest.fixture
+def index() -> BM25Index:
+    return BM25Index(TEXTS.keys(), TEXTS.values(), METADATA)
+
+
+def test_tokenize_drops_stopwords_and_punctuation():
+    assert tokenize("How does Caffeine affect the sleep?") == ["caffeine", "affect", "sleep"]
+
+
+def test_search_ranks_by_term_frequency(index):
+    hits = index.search("caffeine", 10)
+    assert list(hits) == [1, 3]
+    assert hits[1] > hits[3] > 0
+
+
+def test_rare_terms_weigh_more(index):
+    hits = index.search("caffeine sleep", 10)
+    assert list(hits)[0] == 1
+
+
+def test_search_leaves_out_segments_without_query_terms(index):
+    assert index.search("zone 2 cardio", 10) == {}
+    assert set(index.search("caffeine dopamine", 10)) == {1, 3, 4}
+
+
+def test_search_limit(index):
+    hits = index.search("caffeine dopamine", 10)
+    assert index.search("caffeine dopamine", 2) == dict(list(hits.items())[:2])
+
+
+def test_search_filters(index):
+    assert list(index.search("caffeine", 10, {"topic": "Focus"})) == [3]
+    assert list(index.search("caffeine", 10, {"topic": None})) == [1, 3]
+
+
+def test_rrf_rewards_segments_found_by_both():
+    vector_hits = {10: 0.9, 20: 0.8, 30: 0.7}
+    lexical_hits = {30: 12.0, 40: 8.0}
+    assert fuse_rankings(vector_hits, lexical_hits) == [30, 10, 20, 40]
+
+
+def test_rrf_uses_ranks_not_scores():
+    assert fuse_rankings({1: 0.9, 2: 0.1}, {}) == fuse_rankings({1: 0.5, 2: 0.49}, {}) == [1, 2]
+
+
+def test_rrf_vector_weight():
+    vector_hits, lexical_hits = {1: 0.9}, {2: 10.0}
+    assert fuse_rankings(vector_hits, lexical_hits, vector_weight=0.8) == [1, 2]
+    assert fuse_rankings(vector_hits, lexical_hits, vector_weight=0.2) == [2, 1]
+
+
+def test_weighted_fusion_normalizes_scores():
+    vector_hits = {1: 0.9, 2: 0.8, 3: 0.5}
+    lexical_hits = {2: 20.0, 4: 10.0}
+    # 2 is second on the cosine scale and first on the BM25 scale
+    assert fuse_rankings(vector_hits, lexical_hits, method="weighted")[:2] == [2, 1]
+
+
+def test_unknown_fusion_method():
+    with pytest.raises(NotImplementedError):
+        fuse_rankings({1: 0.9}, {1: 1.0}, method="max")
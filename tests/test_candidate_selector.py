@@ -0,0 +1,56 @@
+"""
+Calibration of the candidate selector cut-offs on the relevance history.
+"""
+import pytest
+
+from app.src.llm.qa.candidate_selector import CandidateSelector, load_candidate_selector
+
+
+# The similarities are exact binary fractions, so the drops between them are exact
+def history(n_questions: int = 40) -> list:
+    # Relevant segments score 0.5 and above, then a cliff down to non-relevant ones
+    return [[(0.75, True), (0.625, True), (0.5 + (question % 4) / 64, True), (0.25, False), (0.1875, False), (0.125, None)]
+            for question in range(n_questions)]
+
+
+def test_calibrate_keeps_the_relevant_segments():
+    selector = CandidateSelector.calibrate(history(), target_recall=0.95)
+
+    assert 0.25 < selector.similarity_floor <= 0.5
+    assert selector.cliff_gap == 0.125
+    assert selector.recall == 1.0
+    assert selector.dropped_non_relevant == 1.0
+    assert selector.n_questions == 40
+
+
+def test_calibrated_selector_drops_after_the_cliff():
+    selector = CandidateSelector.calibrate(history(), target_recall=0.95)
+    assert list(selector.select({1: 0.75, 2: 0.625, 3: 0.53125, 4: 0.25, 5: 0.1875})) == [1, 2, 3]
+
+
+def test_calibrate_lowers_the_floor_for_a_higher_recall():
+    outcomes = [[(0.875 - i / 128, True), (0.5 - i / 128, True), (0.125, False)] for i in range(40)]
+    strict = CandidateSelector.calibrate(outcomes, target_recall=0.5)
+    lenient = CandidateSelector.calibrate(outcomes, target_recall=1.0)
+
+    assert lenient.similarity_floor < strict.similarity_floor
+    assert lenient.recall == 1.0
+    assert strict.recall < 1.0
+
+
+def test_calibrate_needs_enough_relevant_segments():
+    with pytest.raises(ValueError):
+        CandidateSelector.calibrate(history(5), min_relevant=30)
+
+
+def test_select_keeps_min_candidates_and_lexical_hits():
+    selector = CandidateSelector(similarity_floor=0.5, cliff_gap=0.2, min_candidates=2)
+    assert list(selector.select({1: 0.3, 2: 0.2, 3: None, 4: 0.1})) == [1, 2, 3]
+
+
+def test_saved_selector_loads(tmp_path):
+    selector = CandidateSelector.calibrate(history())
+    selector.save(tmp_path / "candidate_selector.json")
+
+    assert load_candidate_selector(tmp_path / "candidate_selector.json") == selector
+    assert load_candidate_selector(tmp_path / "missing.json") is None
@@ -0,0 +1,41 @@
+"""
+Framing of the server-sent events of the streamed answers.
+"""
+from app.src.api.client import SSEDecoder, iter_sse_events
+
+
+def test_blank_line_ends_an_event():
+    decoder = SSEDecoder()
+    assert decoder.feed("event: token") is None
+    assert decoder.feed('data: "Hello"') is None
+    assert decoder.feed("") == ("token", "Hello")
+
+
+def test_event_defaults_to_message_and_resets():
+    decoder = SSEDecoder()
+    decoder.feed("event: done")
+    decoder.feed("data: {}")
+    decoder.feed("")
+
+    decoder.feed("data: 1")
+    assert decoder.feed("") == ("message", 1)
+
+
+def test_data_lines_are_joined():
+    decoder = SSEDecoder()
+    decoder.feed('data: {"answer":')
+    decoder.feed('data: "sleep"}')
+    assert decoder.feed("") == ("message", {"answer": "sleep"})
+
+
+def test_blank_lines_without_data_are_ignored():
+    decoder = SSEDecoder()
+    assert decoder.feed("") is None
+    decoder.feed("event: ping")
+    assert decoder.feed("") is None
+
+
+def test_unterminated_event_is_flushed_at_the_end():
+    lines = ["event: resources", 'data: [{"id": 1}]', "", "event: token", 'data: "a"', "",
+             "event: done", "data: null"]
+    assert list(iter_sse_events(lines)) == [("resources", [{"id": 1}]), ("token", "a"), ("done", None)]
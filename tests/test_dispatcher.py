@@ -0,0 +1,75 @@
+"""
+Admission of the chat calls by the LLMDispatcher token buckets.
+"""
+import threading
+import time
+
+import pytest
+
+from app.src.llm.dispatcher import LLMDispatcher, TokenBucket
+
+
+def drain(dispatcher: LLMDispatcher, api_key: str = None, seconds: float = 0.3) -> None:
+    # Leaves the request bucket of the key `seconds` away from the next request
+    with dispatcher._lock:
+        bucket = dispatcher._key_limits(api_key).requests
+        bucket.level = 1 - seconds * bucket.rate
+        bucket.updated = time.monotonic()
+
+
+def queue_calls(dispatcher: LLMDispatcher, calls: list, api_key: str = None) -> list:
+    """
+    Queues the `calls` in their order while the key has no budget and returns
+    their positions in the order they ran.
+    """
+    order = []
+    threads = []
+    for position, call in enumerate(calls):
+        thread = threading.Thread(target=dispatcher.run, kwargs={
+            "function": lambda position=position: order.append(position) or "", "call": call,
+            "model_name": "gpt-3.5-turbo", "prompt_tokens": 10, "api_key": api_key})
+        thread.start()
+        threads.append(thread)
+        # Queued before the next one
+        while len(dispatcher._key_limits(api_key).queue) < len(threads):
+            time.sleep(0.001)
+    for thread in threads:
+        thread.join(5)
+    return order
+
+
+def test_final_answers_are_admitted_before_segment_checks():
+    dispatcher = LLMDispatcher(requests_per_minute=600)
+    drain(dispatcher)
+
+    order = queue_calls(dispatcher, ["segment_check", "segment_grading", "final_answer", "segment_check"])
+    assert order == [2, 0, 1, 3]
+
+
+def test_calls_of_the_same_priority_are_admitted_in_arrival_order():
+    dispatcher = LLMDispatcher(requests_per_minute=600)
+    drain(dispatcher)
+
+    order = queue_calls(dispatcher, ["segment_check"] * 5)
+    assert order == [0, 1, 2, 3, 4]
+
+
+def test_api_keys_have_their_own_budget():
+    dispatcher = LLMDispatcher(requests_per_minute=600)
+    drain(dispatcher, "exhausted", seconds=30)
+
+    start = time.monotonic()
+    dispatcher.run(lambda: "", "segment_check", "gpt-3.5-turbo", 10, api_key="other")
+    assert time.monotonic() - start < 1
+
+
+def test_token_bucket_wait_time():
+    bucket = TokenBucket(per_minute=60)
+    now = bucket.updated
+    assert bucket.wait_time(60, now) == 0
+    bucket.take(60)
+    assert bucket.wait_time(1, now) == pytest.approx(1)
+    assert bucket.wait_time(1, now + 1) == pytest.approx(0)
+    # Overruns push the level below zero
+    bucket.take(10)
+    assert bucket.wait_time(1, now + 1) == pytest.approx(10)
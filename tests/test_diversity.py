@@ -0,0 +1,37 @@
+"""
+Maximal marginal relevance ordering of the found segments.
+"""
+import numpy as np
+
+from app.src.store.diversity import maximal_marginal_relevance
+
+QUERY = np.array([1.0, 0.0, 0.0])
+EMBEDDINGS = np.array([
+    [0.9, 0.1, 0.0],
+    [0.9, 0.11, 0.0],  # near duplicate of the first
+    [0.7, 0.0, 0.7],
+    [0.0, 1.0, 0.0],
+])
+
+
+def test_pure_relevance_keeps_the_similarity_order():
+    assert maximal_marginal_relevance(QUERY, EMBEDDINGS, lambda_mult=1.0).tolist() == [0, 1, 2, 3]
+
+
+def test_redundant_segments_are_pushed_down():
+    assert maximal_marginal_relevance(QUERY, EMBEDDINGS, lambda_mult=0.5).tolist() == [0, 2, 1, 3]
+
+
+def test_duplicates_are_dropped():
+    picked = maximal_marginal_relevance(QUERY, EMBEDDINGS, lambda_mult=1.0, duplicate_similarity=0.99)
+    assert picked.tolist() == [0, 2, 3]
+
+
+def test_embeddings_need_not_be_normalized():
+    assert (maximal_marginal_relevance(QUERY * 3, EMBEDDINGS * 5, lambda_mult=0.5).tolist()
+            == maximal_marginal_relevance(QUERY, EMBEDDINGS, lambda_mult=0.5).tolist())
+
+
+def test_no_candidates():
+    picked = maximal_marginal_relevance(QUERY, np.empty((0, 3)))
+    assert picked.tolist() == [] and picked.dtype == np.int64
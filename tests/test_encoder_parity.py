@@ -0,0 +1,54 @@
+"""
+Parity of the ONNX question encoders with the PyTorch SentenceTransformer. Needs
+the exported models (`python -m app.src.llm.qa.onnx_encoder`) and the torch extra,
+it is skipped otherwise.
+"""
+import numpy as np
+import pytest
+
+from app.src.constants import ENCODER_PATH, ENCODER_ONNX_PATH, ENCODER_ONNX_INT8_PATH
+
+# Largest allowed difference of a cosine score
+TOLERANCE = 0.03
+
+TEXTS = [
+    "How does caffeine affect sleep?",
+    "What is the best time of day to get sunlight?",
+    "Cold exposure increases dopamine for hours after the plunge.",
+    "Deliberate heat exposure in the sauna and growth hormone release.",
+    "Protocols to improve focus and learn faster.",
+    "Alcohol disrupts sleep architecture, especially REM sleep.",
+    "How much zone 2 cardio should I do per week?",
+    "The role of the gut microbiome in mood and mental health.",
+]
+
+
+@pytest.fixture(scope="module")
+def reference():
+    sentence_transformers = pytest.importorskip("sentence_transformers")
+    if not ENCODER_PATH.exists():
+        pytest.skip(f"{ENCODER_PATH} is missing")
+    encoder = sentence_transformers.SentenceTransformer(str(ENCODER_PATH))
+    return normalize(encoder.encode(TEXTS))
+
+
+def normalize(embeddings) -> np.ndarray:
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    return embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)
+
+
+@pytest.mark.parametrize("model_path", [ENCODER_ONNX_PATH, ENCODER_ONNX_INT8_PATH],
+                         ids=["sbert_onnx", "sbert_onnx_int8"])
+def test_onnx_encoder_matches_sentence_transformer(reference, model_path):
+    pytest.importorskip("onnxruntime")
+    if not model_path.exists():
+        pytest.skip(f"{model_path} is missing")
+    from app.src.llm.qa.onnx_encoder import OnnxSentenceEncoder
+
+    embeddings = normalize(OnnxSentenceEncoder(model_path).encode(TEXTS))
+
+    same_text = (reference * embeddings).sum(axis=1)
+    assert same_text.min() >= 1 - TOLERANCE
+    # The scores the vector search ranks by
+    score_diff = np.abs(reference @ reference.T - embeddings @ embeddings.T)
+    assert score_diff.max() <= TOLERANCE
@@ -0,0 +1,80 @@
+"""
+The in-memory LLM response cache and its content-addressed keys.
+"""
+import pytest
+
+from app.src.llm import cache
+from app.src.llm.cache import InMemoryLLMCache, llm_cache_key
+
+INPUTS = {"model": "gpt-3.5-turbo", "temperature": 0, "system_template": "system",
+          "human_template": "human", "question": "How does caffeine affect sleep?",
+          "context": "Caffeine blocks adenosine."}
+
+
+class Clock:
+
+    def __init__(self) -> None:
+        self.now = 1000.0
+
+    def time(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch) -> Clock:
+    clock = Clock()
+    monkeypatch.setattr(cache, "time", clock)
+    return clock
+
+
+def test_entries_expire_after_ttl(clock):
+    llm_cache = InMemoryLLMCache(ttl=60)
+    llm_cache.set("key", "answer")
+
+    clock.now += 59
+    assert llm_cache.get("key") == "answer"
+    clock.now += 2
+    assert llm_cache.get("key") is None
+    assert llm_cache.stats() == {"hits": 1, "misses": 1, "hit_rate": 0.5}
+
+
+def test_entries_without_ttl_do_not_expire(clock):
+    llm_cache = InMemoryLLMCache()
+    llm_cache.set("key", "answer")
+
+    clock.now += 10 ** 9
+    assert llm_cache.get("key") == "answer"
+
+
+def test_least_recently_used_entry_is_evicted():
+    llm_cache = InMemoryLLMCache(max_size=2)
+    llm_cache.set("a", "1")
+    llm_cache.set("b", "2")
+    # Reading "a" makes "b" the least recently used
+    assert llm_cache.get("a") == "1"
+    llm_cache.set("c", "3")
+
+    assert llm_cache.get("b") is None
+    assert llm_cache.get("a") == "1"
+    assert llm_cache.get("c") == "3"
+
+
+def test_overwritten_entry_is_most_recently_used():
+    llm_cache = InMemoryLLMCache(max_size=2)
+    llm_cache.set("a", "1")
+    llm_cache.set("b", "2")
+    llm_cache.set("a", "updated")
+    llm_cache.set("c", "3")
+
+    assert llm_cache.get("b") is None
+    assert llm_cache.get("a") == "updated"
+
+
+def test_key_ignores_input_order():
+    assert llm_cache_key(**INPUTS) == llm_cache_key(**dict(reversed(list(INPUTS.items()))))
+
+
+@pytest.mark.parametrize("name", list(INPUTS))
+def test_key_changes_with_every_input(name):
+    changed = {**INPUTS, name: 0.7 if name == "temperature" else INPUTS[name] + " changed"}
+    assert llm_cache_key(**changed) != llm_cache_key(**INPUTS)
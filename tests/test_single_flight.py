@@ -0,0 +1,124 @@
+"""
+Coalescing of concurrent questions by SingleFlight.
+"""
+import asyncio
+import threading
+
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import pytest
+
+from app.src.llm.qa import single_flight as single_flight_module
+from app.src.llm.qa.single_flight import SingleFlight, normalize_question
+
+N_CALLERS = 8
+
+
+class WaitedFuture(Future):
+    # Counts the followers waiting for the result of the flight
+    waiting = threading.Semaphore(0)
+
+    def result(self, timeout=None):
+        WaitedFuture.waiting.release()
+        return super().result(timeout)
+
+
+@pytest.fixture
+def waiting(monkeypatch) -> threading.Semaphore:
+    monkeypatch.setattr(single_flight_module, "Future", WaitedFuture)
+    WaitedFuture.waiting = threading.Semaphore(0)
+    return WaitedFuture.waiting
+
+
+def test_concurrent_callers_share_one_result(waiting):
+    single_flight = SingleFlight()
+    started, release = threading.Event(), threading.Event()
+    calls = []
+
+    def compute():
+        calls.append(1)
+        started.set()
+        release.wait(5)
+        return "answer"
+
+    with ThreadPoolExecutor(N_CALLERS) as executor:
+        leader = executor.submit(single_flight.run, "key", compute)
+        assert started.wait(5)
+        followers = [executor.submit(single_flight.run, "key", compute)
+                     for _ in range(N_CALLERS - 1)]
+        for _ in followers:
+            assert waiting.acquire(timeout=5)
+        release.set()
+
+        assert leader.result(5) == ("answer", False)
+        assert [future.result(5) for future in followers] == [("answer", True)] * (N_CALLERS - 1)
+    assert len(calls) == 1
+
+
+def test_followers_share_the_exception(waiting):
+    single_flight = SingleFlight()
+    started, release = threading.Event(), threading.Event()
+
+    def fail():
+        started.set()
+        release.wait(5)
+        raise RuntimeError("rate limited")
+
+    with ThreadPoolExecutor(2) as executor:
+        leader = executor.submit(single_flight.run, "key", fail)
+        assert started.wait(5)
+        follower = executor.submit(single_flight.run, "key", fail)
+        assert waiting.acquire(timeout=5)
+        release.set()
+
+        for future in (leader, follower):
+            with pytest.raises(RuntimeError):
+                future.result(5)
+
+
+def test_later_calls_compute_again():
+    single_flight = SingleFlight()
+    assert single_flight.run("key", lambda: 1) == (1, False)
+    assert single_flight.run("key", lambda: 2) == (2, False)
+
+
+def test_concurrent_coroutines_share_one_result():
+    single_flight = SingleFlight()
+    calls = []
+
+    async def compute():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return "answer"
+
+    async def main():
+        return await asyncio.gather(*[single_flight.run_async("key", compute) for _ in range(N_CALLERS)])
+
+    results = asyncio.run(main())
+    assert results == [("answer", False)] + [("answer", True)] * (N_CALLERS - 1)
+    assert len(calls) == 1
+
+
+def test_cancelled_leader_hands_over_to_a_follower():
+    single_flight = SingleFlight()
+    calls = []
+
+    async def compute():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        return "answer"
+
+    async def main():
+        leader = asyncio.create_task(single_flight.run_async("key", compute))
+        await asyncio.sleep(0)
+        follower = asyncio.create_task(single_flight.run_async("key", compute))
+        await asyncio.sleep(0.01)
+        leader.cancel()
+        return await follower
+
+    assert asyncio.run(main()) == ("answer", False)
+    assert len(calls) == 2
+
+
+def test_questions_differing_in_case_and_punctuation_are_one_key():
+    assert normalize_question("  How does  caffeine affect sleep? ") == normalize_question("how does caffeine affect sleep")